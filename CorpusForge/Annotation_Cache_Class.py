@@ -0,0 +1,109 @@
+# CASS Annotation Cache #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# Entries are gzip files of pickle frames, one frame per sentence holding (word, character offset, *attribute values)
+# for every SpaCy attribute, so any attribute selection, metadata or output format can be produced without the model.
+# Entries are keyed by the text and everything that changes the annotation, the access time is the entry's mtime.
+
+
+import os
+import gzip
+import json
+import hashlib
+import pickle as pkl
+
+
+class annotationCache:
+
+    def __init__(self, cache_dir, fields, key_info, max_mb=10240):
+        self.cache_dir = cache_dir
+        self.fields = list(fields)
+        self.max_bytes = max_mb * 1048576
+        # Anything that changes the annotation of a text is hashed into every key
+        self.key_prefix = hashlib.sha256(json.dumps({'fields': self.fields, **key_info}, sort_keys=True, default=str).encode("UTF-8")).digest()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, _, size in self.entries())
+
+    def key(self, text):
+        digest = hashlib.sha256(self.key_prefix)
+        digest.update(text.encode("UTF-8", errors="surrogatepass"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".pkl.gz")
+
+    def entries(self):
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".pkl.gz"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        # Returns a generator of cached sentences, None on a miss
+        path = self.path(key)
+        try:
+            file = gzip.open(path, "rb")
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.read(file)
+
+    def read(self, file):
+        with file:
+            fields = pkl.load(file)
+            while True:
+                try:
+                    sentence = pkl.load(file)
+                except EOFError:
+                    return
+                yield [(token[0], token[1], dict(zip(fields, token[2:]))) for token in sentence]
+
+    def store(self, key, sentences):
+        # Passes the sentences through while writing them, the entry only appears once the document is complete
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_file = f"{path}.{os.getpid()}.part"
+        complete = False
+        try:
+            with gzip.open(partial_file, "wb", compresslevel=3) as file:
+                pkl.dump(self.fields, file, protocol=pkl.HIGHEST_PROTOCOL)
+                for sentence in sentences:
+                    pkl.dump([(text, offset, *[attributes[field] for field in self.fields]) for text, offset, attributes in sentence], file, protocol=pkl.HIGHEST_PROTOCOL)
+                    yield sentence
+            os.replace(partial_file, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(partial_file):
+                os.remove(partial_file)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Least recently used entries go first, down to 90% of the limit so eviction is not run for every new entry
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
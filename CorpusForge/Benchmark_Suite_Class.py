@@ -0,0 +1,263 @@
+# CASS Pipeline Benchmark Suite #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from tqdm import tqdm
+from CorpusForge.Stream_XML_Writer_Class import streamXMLWriter
+from CorpusForge.Columnar_Output_Class import columnarWriter
+from CorpusForge.Text_Normalizer_Class import textNormalizer, benchmark_normalizer
+
+
+class benchmarkSuite:
+
+    # Stages in pipeline order, epub_extraction replaces read for EPUB files
+    stages = ['read', 'epub_extraction', 'build_xml', 'normalize', 'spacy', 'pymusas', 'feature_extraction', 'serialize', 'compress', 'columnar']
+
+    def __init__(self, pipeline, synthetic_sizes=[1000, 10000, 100000], sample_size=5, repeats=3, seed=13,
+                 trace_memory=True, results_file="benchmark_results.json", baseline_file=None, tolerance=0.1):
+        if not isinstance(repeats, int) or repeats < 1:
+            raise ValueError(f"Invalid benchmark repeats '{repeats}', needs to be an integer of at least 1")
+        self.pipeline = pipeline
+        self.synthetic_sizes = synthetic_sizes
+        self.sample_size = sample_size
+        self.repeats = repeats
+        self.seed = seed
+        self.trace_memory = trace_memory
+        self.results_file = results_file
+        self.baseline_file = baseline_file
+        self.tolerance = tolerance
+        self.results = None
+        self.regressions = []
+
+    # Corpora
+
+    def synthetic_corpus(self, directory):
+        # Deterministic English-like text, sizes are in words
+        rng = random.Random(self.seed)
+        vocabulary = ("the of and a to in he was that it his her you as had with for she not at but be my on have him is said me which by so this all from they no were if would or when what there been one could very an who them do we now more out such up into then man some time their like your can little").split()
+        files = []
+        for size in self.synthetic_sizes:
+            paragraphs = []
+            words = 0
+            while words < size:
+                sentences = []
+                for _ in range(rng.randint(1, 6)):
+                    length = rng.randint(4, 25)
+                    sentence = " ".join(rng.choice(vocabulary) for _ in range(length))
+                    sentences.append(sentence[0].upper() + sentence[1:] + rng.choice(['.', '.', '.', '?', '!']))
+                    words += length
+                paragraphs.append(" ".join(sentences))
+            file = os.path.join(directory, f"synthetic_{size}.txt")
+            with open(file, "w") as file_write:
+                file_write.write("\n\n".join(paragraphs))
+            files.append(file)
+        return files
+
+    def sampled_corpus(self):
+        # Evenly spaced across the size distribution, sizes from os.stat so the corpus is never read
+        files = sorted(self.pipeline.proc_files, key=lambda file: (os.path.getsize(file), file))
+        if len(files) <= self.sample_size:
+            return files
+        step = (len(files) - 1) / max(self.sample_size - 1, 1)
+        return [files[round(index * step)] for index in range(self.sample_size)]
+
+    # Measurement
+
+    def measure(self, record, stage, function, *args):
+        # Traced passes only record memory (Python heap, including SpaCy's Doc allocations), tracing would skew the timings
+        stats = record.setdefault(stage, {'seconds': [], 'peak_memory_bytes': 0})
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+            result = function(*args)
+            stats['peak_memory_bytes'] = max(stats['peak_memory_bytes'], tracemalloc.get_traced_memory()[1] - memory_start)
+        else:
+            start = time.perf_counter()
+            result = function(*args)
+            stats['seconds'].append(time.perf_counter() - start)
+        return result
+
+    def run_file(self, input_file, work_dir):
+        pipeline = self.pipeline
+        nlp = pipeline.nlp
+        record = {}
+        is_epub = pipeline.get_filetype(input_file) == ".epub"
+        pymusas_pipes = [name for name in nlp.pipe_names if name.startswith('pymusas')]
+        output_file = os.path.join(work_dir, "benchmark.xml")
+
+        for repeat in range(self.repeats + (1 if self.trace_memory else 0)):
+            if repeat == self.repeats:
+                tracemalloc.start()
+            content, is_xml, extra_metadata = self.measure(record, 'epub_extraction' if is_epub else 'read', pipeline.read_input, input_file)
+            soup, text_content, valid_ID = self.measure(record, 'build_xml', pipeline.prepare_xml, input_file, content, is_xml, 0, extra_metadata, False)
+            if pipeline.normalizer is not None:
+                text_content = self.measure(record, 'normalize', pipeline.normalizer.normalize, text_content)
+            # Texts longer than chunk_size are annotated in the pipeline's chunks, nlp.max_length is chunk_size
+            chunks = list(pipeline.split_chunks(text_content)) if pipeline.chunk_size is not None else [(0, text_content)]
+            with nlp.select_pipes(disable=pymusas_pipes):
+                docs = self.measure(record, 'spacy', lambda: [nlp(chunk) for _, chunk in chunks])
+            for name in pymusas_pipes:
+                docs = self.measure(record, 'pymusas', lambda pipe, docs: [pipe(doc) for doc in docs], nlp.get_pipe(name), docs)
+            sentences = self.measure(record, 'feature_extraction', lambda: [sentence for (offset, _), doc in zip(chunks, docs) for sentence in pipeline.doc_sentences(doc, offset)])
+
+            def serialize():
+                writer = streamXMLWriter(output_file)
+                writer.open(soup, pipeline.xml_text_node)
+                for sentence in sentences:
+                    writer.write_sentence(sentence)
+                writer.close()
+            self.measure(record, 'serialize', serialize)
+
+            def compress():
+                with open(output_file, "rb") as file_read:
+                    return zlib.compress(file_read.read())
+            compressed = self.measure(record, 'compress', compress)
+
+            def columnar():
+                writer = columnarWriter(os.path.join(work_dir, "benchmark.cfc"))
+                writer.open({})
+                for sentence in sentences:
+                    writer.write_sentence(sentence)
+                writer.close()
+                return writer.file_size
+            columnar_size = self.measure(record, 'columnar', columnar)
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+        n_tokens = sum(len(doc) for doc in docs)
+        summary = {'tokens': n_tokens, 'bytes': os.path.getsize(input_file), 'xml_bytes': os.path.getsize(output_file),
+                   'compressed_bytes': len(compressed), 'columnar_bytes': columnar_size, 'stages': {}}
+        for stage, stats in record.items():
+            seconds = sorted(stats['seconds'])[len(stats['seconds']) // 2]
+            summary['stages'][stage] = {'seconds': seconds, 'tokens_per_second': n_tokens / seconds if seconds > 0 else None,
+                                        'peak_memory_bytes': stats['peak_memory_bytes'] if self.trace_memory else None}
+        return summary
+
+    def normalizer_cost(self, files):
+        # Milliseconds per MB of the pipeline's normalizer (the fiction clean up when none is set) over the unnormalised texts of the files
+        pipeline = self.pipeline
+        normalizer = pipeline.normalizer if pipeline.normalizer is not None else textNormalizer.preset("fiction")
+        texts = []
+        for input_file in files:
+            content, is_xml, extra_metadata = pipeline.read_input(input_file)
+            texts.append(pipeline.prepare_xml(input_file, content, is_xml, 0, extra_metadata, False)[1])
+        results = benchmark_normalizer(normalizer, "\n".join(texts), max(self.repeats, 1))
+        results['config'] = normalizer.config()
+        return results
+
+    def aggregate(self, files):
+        # Per stage totals across the files of one corpus
+        stages = {}
+        n_tokens = sum(file['tokens'] for file in files.values())
+        for file in files.values():
+            for stage, stats in file['stages'].items():
+                total = stages.setdefault(stage, {'seconds': 0.0, 'tokens_per_second': None, 'peak_memory_bytes': 0})
+                total['seconds'] += stats['seconds']
+                if stats['peak_memory_bytes'] is not None:
+                    total['peak_memory_bytes'] = max(total['peak_memory_bytes'], stats['peak_memory_bytes'])
+        for total in stages.values():
+            total['tokens_per_second'] = n_tokens / total['seconds'] if total['seconds'] > 0 else None
+        return {'tokens': n_tokens, 'stages': stages, 'files': files}
+
+    def environment(self):
+        from importlib import metadata as importlib_metadata
+        packages = {}
+        from CorpusForge.SpaCy_Pipeline_Class import model_profiles
+        for package in ['spacy', 'pymusas', model_profiles[self.pipeline.model_profile], 'en_dual_none_contextual', 'beautifulsoup4', 'lxml']:
+            try:
+                packages[package] = importlib_metadata.version(package)
+            except importlib_metadata.PackageNotFoundError:
+                packages[package] = None
+        return {'python': sys.version.split()[0], 'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'packages': packages}
+
+    def run(self):
+        if self.pipeline.init_status == False:
+            print("### Initialisation Failed - See Warnings for Details ###")
+            return None
+        from CorpusForge.CorpusForge import startup_time, STARTUP_TARGET_SECONDS
+        self.pipeline.load_models()
+
+        work_dir = tempfile.mkdtemp(prefix="corpusforge_benchmark_")
+        try:
+            corpora = {'synthetic': self.synthetic_corpus(work_dir), 'sampled': self.sampled_corpus()}
+            # Warm up the model so one-off initialisation is not counted against the first file
+            self.pipeline.nlp("Warm up sentence for the benchmark suite.")
+            self.results = {'created': datetime.now().isoformat(timespec='seconds'), 'environment': self.environment(),
+                            'config': {'attributes': self.pipeline.attributes, 'model_profile': self.pipeline.model_profile, 'repeats': self.repeats, 'seed': self.seed,
+                                       'synthetic_sizes': self.synthetic_sizes, 'chunk_size': self.pipeline.chunk_size,
+                                       'normalize': self.pipeline.normalizer.config() if self.pipeline.normalizer is not None else None},
+                            'startup': {'seconds': startup_time(), 'target_seconds': STARTUP_TARGET_SECONDS}, 'corpora': {}, 'normalizer': {}}
+            for name, files in corpora.items():
+                file_results = {}
+                for file in tqdm(files, desc=name):
+                    file_results[os.path.basename(file) if name == 'synthetic' else file] = self.run_file(file, work_dir)
+                self.results['corpora'][name] = self.aggregate(file_results)
+                self.results['normalizer'][name] = self.normalizer_cost(files)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        with open(self.results_file, "w") as results_write:
+            json.dump(self.results, results_write, indent=2)
+        print(f"### Benchmark Results Written to '{self.results_file}' ###")
+        self.print_summary()
+
+        if self.baseline_file is not None:
+            self.compare(self.baseline_file)
+        return self.results
+
+    def print_summary(self):
+        for name, corpus in self.results['corpora'].items():
+            print(f"### {name} corpus, {corpus['tokens']} tokens ###")
+            for stage in self.stages:
+                if stage in corpus['stages']:
+                    stats = corpus['stages'][stage]
+                    memory = "" if not self.trace_memory else f", peak {stats['peak_memory_bytes'] / 1048576:.1f} MB"
+                    print(f"{stage:<20} {stats['seconds']:>10.3f}s {stats['tokens_per_second'] or 0:>14.0f} tokens/s{memory}")
+        for name, cost in self.results.get('normalizer', {}).items():
+            print(f"normalizer ({name}, {cost['megabytes']:.2f} MB) fused {cost['fused_ms_per_mb'] or 0:.1f} ms/MB, "
+                  f"one pass per rule {cost['stepwise_ms_per_mb'] or 0:.1f} ms/MB, streamed {cost['streamed_ms_per_mb'] or 0:.1f} ms/MB")
+        startup = self.results['startup']
+        print(f"CLI startup {startup['seconds']:.3f}s (target {startup['target_seconds']}s)")
+
+    def compare(self, baseline_file):
+        # A stage regresses when it is slower, or uses more memory, than the baseline by more than the tolerance
+        with open(baseline_file) as baseline_read:
+            baseline = json.load(baseline_read)
+        self.regressions = []
+        limit = 1 + self.tolerance
+        for name, corpus in self.results['corpora'].items():
+            baseline_corpus = baseline.get('corpora', {}).get(name)
+            if baseline_corpus is None:
+                continue
+            for stage, stats in corpus['stages'].items():
+                baseline_stats = baseline_corpus['stages'].get(stage)
+                if baseline_stats is None:
+                    continue
+                if baseline_stats['tokens_per_second'] and stats['tokens_per_second'] and stats['tokens_per_second'] * limit < baseline_stats['tokens_per_second']:
+                    self.regressions.append(f"{name}/{stage}: {stats['tokens_per_second']:.0f} tokens/s vs baseline {baseline_stats['tokens_per_second']:.0f}")
+                if baseline_stats.get('peak_memory_bytes') and stats.get('peak_memory_bytes') and stats['peak_memory_bytes'] > baseline_stats['peak_memory_bytes'] * limit:
+                    self.regressions.append(f"{name}/{stage}: peak memory {stats['peak_memory_bytes']} bytes vs baseline {baseline_stats['peak_memory_bytes']}")
+        startup = self.results['startup']
+        if startup['seconds'] > startup['target_seconds']:
+            self.regressions.append(f"startup: {startup['seconds']:.3f}s exceeds target {startup['target_seconds']}s")
+
+        if len(self.regressions) > 0:
+            print(f"### {len(self.regressions)} Performance Regression(s) Against '{baseline_file}' ###")
+            for regression in self.regressions:
+                print(regression)
+        else:
+            print(f"### No Performance Regressions Against '{baseline_file}' ###")
+        return self.regressions
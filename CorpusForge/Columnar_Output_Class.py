@@ -0,0 +1,227 @@
+# CASS Columnar Output Format #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# File layout (little endian):
+#   8 byte magic, uint64 header length, JSON header, padding to 8 bytes, then the data sections.
+#   Each token attribute is one array, string attributes hold uint32 IDs into the document's interned string table
+#   and boolean attributes are uint8. Token character offsets are uint64. Sentence offsets hold the first token of each sentence plus the token count.
+#   Section offsets in the header are relative to the start of the data sections.
+
+
+import os
+import json
+import mmap
+import struct
+from array import array
+from CorpusForge.Run_Manifest_Class import hashingWriter
+
+
+MAGIC = b"CFCOL\x00\x01\x00"
+BOOL_ATTRIBUTES = ['is_alpha', 'is_stop']
+INT_ATTRIBUTES = ['offset']
+
+
+class columnarWriter:
+
+    def __init__(self, output_file, stream=None):
+        self.output_file = output_file
+        # A binary stream (a shard) the file is written to instead of output_file
+        self.stream = stream
+        self.strings = {}
+        self.columns = {}
+        self.column_order = []
+        self.sentence_offsets = array('Q', [0])
+        self.n_tokens = 0
+        self.metadata = {}
+        self.file_size = 0
+        # {'hash', 'size'} of the output file once it is closed, for the run manifest
+        self.output_digest = None
+
+    def open(self, metadata):
+        self.metadata = dict(metadata)
+
+    def intern(self, value):
+        string_ID = self.strings.get(value)
+        if string_ID is None:
+            string_ID = len(self.strings)
+            self.strings[value] = string_ID
+        return string_ID
+
+    def column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            # Columns seen part way through a document are back filled so every column has one value per token
+            typecode = 'B' if name in BOOL_ATTRIBUTES else 'Q' if name in INT_ATTRIBUTES else 'I'
+            column = array(typecode, [self.missing(typecode)] * self.n_tokens)
+            self.columns[name] = column
+            self.column_order.append(name)
+        return column
+
+    def missing(self, typecode):
+        # The value of a token without the attribute, an empty string for string columns
+        return self.intern("") if typecode == 'I' else 0
+
+    def write_sentence(self, sentence):
+        word_column = self.column('word')
+        offset_column = self.column('offset')
+        for text, offset, attributes in sentence:
+            word_column.append(self.intern(text))
+            offset_column.append(offset)
+            for name, value in attributes.items():
+                if name in BOOL_ATTRIBUTES:
+                    self.column(name).append(1 if value else 0)
+                else:
+                    if isinstance(value, (list, tuple)):
+                        value = " ".join(value)
+                    self.column(name).append(self.intern(str(value)))
+            self.n_tokens += 1
+            if len(self.columns) != len(attributes) + 2:
+                for column in self.columns.values():
+                    if len(column) < self.n_tokens:
+                        column.append(self.missing(column.typecode))
+        self.sentence_offsets.append(self.n_tokens)
+
+    def close(self):
+        strings = [string.encode("UTF-8") for string in self.strings]
+        string_offsets = array('Q', [0])
+        for string in strings:
+            string_offsets.append(string_offsets[-1] + len(string))
+
+        sections = []
+        header = {"version": 1, "metadata": self.metadata, "n_tokens": self.n_tokens,
+                  "n_sentences": len(self.sentence_offsets) - 1, "columns": {}}
+        position = 0
+
+        def add_section(data, dtype, count):
+            nonlocal position
+            raw = data.tobytes() if isinstance(data, array) else data
+            entry = {"dtype": dtype, "offset": position, "count": count}
+            sections.append(raw)
+            position += len(raw)
+            padding = (-position) % 8
+            if padding:
+                sections.append(b"\0" * padding)
+                position += padding
+            return entry
+
+        header["sentences"] = add_section(self.sentence_offsets, "<u8", len(self.sentence_offsets))
+        for name in self.column_order:
+            column = self.columns[name]
+            dtype = {'B': "|u1", 'I': "<u4", 'Q': "<u8"}[column.typecode]
+            header["columns"][name] = add_section(column, dtype, len(column))
+        header["string_offsets"] = add_section(string_offsets, "<u8", len(string_offsets))
+        header["string_data"] = add_section(b"".join(strings), "|u1", string_offsets[-1])
+
+        header_bytes = json.dumps(header, default=json_default).encode("UTF-8")
+        header_bytes += b" " * ((-(len(header_bytes) + 16)) % 8)
+        if self.stream is not None:
+            self.write_file(self.stream, header_bytes, sections)
+        else:
+            partial_file = self.output_file + ".part"
+            with open(partial_file, "wb") as file_write:
+                file_write = hashingWriter(file_write)
+                self.write_file(file_write, header_bytes, sections)
+            self.output_digest = file_write.record()
+            os.replace(partial_file, self.output_file)
+        self.file_size = 16 + len(header_bytes) + position
+        self.columns = {}
+        self.strings = {}
+
+    def write_file(self, file_write, header_bytes, sections):
+        file_write.write(MAGIC)
+        file_write.write(struct.pack("<Q", len(header_bytes)))
+        file_write.write(header_bytes)
+        for section in sections:
+            file_write.write(section)
+
+
+class columnarReader:
+
+    # offset is where the columnar file starts within input_file, for documents stored in a shard
+    def __init__(self, input_file, offset=0):
+        import numpy as np
+        self.np = np
+        self.input_file = input_file
+        self.file = open(input_file, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[offset:offset + 8] != MAGIC:
+            self.close()
+            raise ValueError(f"'{input_file}' is not a CorpusForge columnar file")
+        header_length = struct.unpack("<Q", self.buffer[offset + 8:offset + 16])[0]
+        self.header = json.loads(self.buffer[offset + 16:offset + 16 + header_length].decode("UTF-8"))
+        self.data_start = offset + 16 + header_length
+        self.metadata = self.header["metadata"]
+        self.n_tokens = self.header["n_tokens"]
+        self.n_sentences = self.header["n_sentences"]
+        self.columns = list(self.header["columns"])
+        self.string_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.n_sentences
+
+    def close(self):
+        try:
+            self.buffer.close()
+        except BufferError:
+            # Arrays returned by column() still reference the map, it is released once they are garbage collected
+            pass
+        self.file.close()
+
+    def section(self, entry, start=0, stop=None):
+        # Arrays are views onto the memory map, only the requested range is ever paged in
+        stop = entry["count"] if stop is None else stop
+        dtype = self.np.dtype(entry["dtype"])
+        return self.np.frombuffer(self.buffer, dtype=dtype, count=stop - start, offset=self.data_start + entry["offset"] + start * dtype.itemsize)
+
+    def string(self, string_ID):
+        string = self.string_cache.get(string_ID)
+        if string is None:
+            bounds = self.section(self.header["string_offsets"], string_ID, string_ID + 2)
+            start = self.data_start + self.header["string_data"]["offset"]
+            string = self.buffer[start + int(bounds[0]):start + int(bounds[1])].decode("UTF-8")
+            self.string_cache[string_ID] = string
+        return string
+
+    def column(self, name, start=0, stop=None, decode=False):
+        if name not in self.header["columns"]:
+            raise KeyError(f"Column '{name}' not in '{self.input_file}', available columns: {', '.join(self.columns)}")
+        values = self.section(self.header["columns"][name], start, stop)
+        if not decode:
+            return values
+        if name in BOOL_ATTRIBUTES:
+            return [bool(value) for value in values]
+        if name in INT_ATTRIBUTES:
+            return values.tolist()
+        return [self.string(int(value)) for value in values]
+
+    def sentence_range(self, start, stop=None):
+        stop = start + 1 if stop is None else stop
+        offsets = self.section(self.header["sentences"], start, stop + 1)
+        return int(offsets[0]), int(offsets[-1])
+
+    def sentences(self, start, stop=None, columns=None, decode=True):
+        # Returns {column: values} for the tokens of sentences start to stop
+        token_start, token_stop = self.sentence_range(start, stop)
+        columns = self.columns if columns is None else columns
+        return {name: self.column(name, token_start, token_stop, decode) for name in columns}
+
+    def sentence(self, index, columns=None, decode=True):
+        return self.sentences(index, index + 1, columns, decode)
+
+
+def columnar_path(output_file):
+    return os.path.splitext(output_file)[0] + ".cfc"
+
+def json_default(value):
+    # Metadata read through pandas can hold numpy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
@@ -8,23 +8,81 @@
 # TODO Re-structure main to allow for selecting the desired pipeline component.
 
 
+import os
+import sys
+import time
 import argparse
+import subprocess
 from CorpusForge.SpaCy_Pipeline_Class import spacyPipeline
 from CorpusForge.Fict_Body_Extraction_Class import fictBodyExtraction
 
+# Heavy libraries (SpaCy, pandas, sklearn, bs4, ebooklib) are imported on first use, --help and dry runs must stay under this
+STARTUP_TARGET_SECONDS = 0.5
+
+def startup_time(runs=5):
+    # Median wall time of a fresh interpreter running the CLI help, the package is found even when it is not installed
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.environ.get('PYTHONPATH')])))
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "CorpusForge.CorpusForge", "--help"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+def run_query(query=None, query_index="token_index.sqlite", query_mode="concordance", query_context=5, query_limit=20, query_facets=None, merge_index=None):
+    from CorpusForge.Token_Index_Class import tokenIndex
+    if not os.path.exists(query_index) and merge_index is None:
+        print(f"### Token Index '{query_index}' Does Not Exist ###")
+        return
+    with tokenIndex(query_index) as index:
+        if merge_index is not None:
+            index.merge(merge_index)
+            print(f"### Merged {len(merge_index)} Index(es) into '{query_index}' ###")
+        if query is None:
+            return
+        facets = dict(facet.split("=", 1) for facet in query_facets) if query_facets is not None else None
+        start = time.perf_counter()
+        if query_mode == "frequency":
+            print(f"{query}\t{index.frequency(query, facets)}\t{index.document_frequency(query, facets)} document(s)")
+        elif query_mode == "terms":
+            for value, frequency in index.frequencies(query, facets, query_limit):
+                print(f"{value}\t{frequency}")
+        else:
+            for line in index.concordance(query, query_context, query_limit, facets):
+                print(f"{line['document']}\t{line['left']:>40} [{line['node']}] {line['right']}")
+        print(f"### Query Took {(time.perf_counter() - start) * 1000:.1f}ms ###")
+
+def queue_status(queue_file):
+    from CorpusForge.Work_Queue_Class import workQueue
+    if not os.path.exists(queue_file):
+        print(f"### Work Queue '{queue_file}' Does Not Exist ###")
+        return
+    with workQueue(queue_file) as work_queue:
+        status = work_queue.status()
+    states = status['states']
+    print(f"### {states['done']} Done, {states['leased']} Leased ({status['expired_leases']} Expired), {states['queued']} Queued, {states['failed']} Failed, "
+          f"{status['remaining_bytes'] / 1048576:.1f}MB Left ###")
+    for worker in status['workers']:
+        print(f"{worker['worker']}\t{worker['files']} file(s)\tlast heartbeat {worker['seconds_since_heartbeat']}s ago")
+    for failure in status['failed']:
+        print(f"Failed '{failure['file']}': {failure['error']}")
+
 def main():
     parser = argparse.ArgumentParser(description='Print parameters with -help option')
 
     # Add your parameters here
     parser.add_argument('--corpus_title', type=str, help='Title of the Corpus [DEFAULT: "SpaCy Pipeline Corpus"]')
     parser.add_argument('--file_type', type=str, help='File type of content files (.xml, .txt etc) [DEFAULT: "Auto"]')
-    parser.add_argument('--multi_process', type=bool, help='Run multiple workers across cores [WIP] [DEFAULT: False]')
+    parser.add_argument('--multi_process', type=bool, help='Run multiple workers across cores, each worker loads its own SpaCy models [DEFAULT: False]')
     parser.add_argument('--worker_nodes', type=int, help='Number of simultaneous worker nodes [DEFAULT: 1]')
     parser.add_argument('--attributes', type=list, help="List of SpaCy attributes to collect [DEFAULT: ['lemma', 'pos', 'tag', 'dep', 'shape', 'is_alpha', 'is_stop', 'pymusas']")
     parser.add_argument('--warnings', type=bool, help='Overtly print warnings [DEFAULT: True]')
     parser.add_argument('--metadata', type=bool, help='Embed metadata from a file into an XML header [DEFAULT: True]')
     parser.add_argument('--metadata_file', type=str, help='Metadata file path [DEFAULT: "metadata/metadata.csv"]')
-    parser.add_argument('--metadata_ID_column', type=str, help='Name of ID column in metadata file [DEFAULT: "ID"]')
+    parser.add_argument('--metadata_ID_column', type=str, dest='metadata_id_column', help='Name of ID column in metadata file [DEFAULT: "ID"]')
+    parser.add_argument('--metadata_backend', type=str, help='Metadata lookup backend, "memory" or "sqlite" for metadata files too large to hold in memory [DEFAULT: "memory"]')
+    parser.add_argument('--metadata_db', type=str, help='SQLite database built from the metadata file by the sqlite backend [DEFAULT: metadata_file + ".sqlite"]')
     parser.add_argument('--data_dir', type=str, help='Directory location of files to process [DEFAULT: "data"]')
     parser.add_argument('--all_files', type=list, help='Provide a list object of files for manual targeting of pipeline [DEFAULT: []]')
     parser.add_argument('--single_file_type', type=bool, help='Are all corpus files a single file type (excluding metadata file) [DEFAULT: True]')
@@ -41,20 +99,126 @@ def main():
     parser.add_argument('--benchmark_sample', type=int, help='Number of files in benchmark sample [DEFAULT: 20]')
     parser.add_argument('--compress', type=bool, help='Compress output into Pickle files [DEFAULT: False]')
     parser.add_argument('--skip_processed_files', type=bool, help='Processed files that already exist in the output_dir will be skipped [DEFAULT: False]')
-    
+    parser.add_argument('--output_format', type=str, help='Output "xml", "columnar" (memory mappable .cfc token arrays) or "both" [DEFAULT: "xml"]')
+    parser.add_argument('--batch_annotation', type=bool, help='Annotate files through nlp.pipe in batches packed by token count [DEFAULT: False]')
+    parser.add_argument('--batch_size', type=int, help='Maximum number of files in one annotation batch [DEFAULT: 1000]')
+    parser.add_argument('--batch_tokens', type=int, help='Token budget of one annotation batch, larger files are annotated alone [DEFAULT: 50000]')
+    parser.add_argument('--chunk_size', type=int, help='Annotate texts longer than this many characters in paragraph aligned chunks to bound memory [DEFAULT: None]')
+    parser.add_argument('--chunk_processes', type=int, help='Processes annotating the chunks of one long text in parallel [DEFAULT: 1]')
+    parser.add_argument('--batch_memory_mb', type=int, help='Ceiling on the text held by one annotation batch in MB [DEFAULT: 256]')
+    parser.add_argument('--resume', type=bool, help='Continue an interrupted run, skipping files whose manifest entry and outputs are still valid [DEFAULT: False]')
+    parser.add_argument('--manifest', type=bool, help='Record each completed file in a manifest in the output directory [DEFAULT: True]')
+    parser.add_argument('--verify_outputs', type=str, help='How resume verifies existing outputs, checksum or size [DEFAULT: checksum]')
+    parser.add_argument('--annotation_cache', type=str, help='Directory of cached SpaCy annotations, texts already annotated skip the model [DEFAULT: None]')
+    parser.add_argument('--annotation_cache_mb', type=int, help='Size limit of the annotation cache in MB, least recently used entries are evicted [DEFAULT: 10240]')
+    parser.add_argument('--benchmark_suite', type=bool, help='Time every pipeline stage on synthetic and sampled corpora and write the results as JSON [DEFAULT: False]')
+    parser.add_argument('--benchmark_sizes', type=int, nargs='+', help='Word counts of the synthetic benchmark documents [DEFAULT: 1000 10000 100000]')
+    parser.add_argument('--benchmark_repeats', type=int, help='Timed repeats per benchmark document, the median is reported [DEFAULT: 3]')
+    parser.add_argument('--benchmark_results', type=str, help='JSON file the benchmark suite writes its results to [DEFAULT: "benchmark_results.json"]')
+    parser.add_argument('--benchmark_baseline', type=str, help='Saved benchmark results to check for regressions against [DEFAULT: None]')
+    parser.add_argument('--benchmark_tolerance', type=float, help='Fraction a stage may slow down or grow in memory before it counts as a regression [DEFAULT: 0.1]')
+    parser.add_argument('--read_processes', type=int, help='Processes reading files and extracting EPUBs ahead of annotation [DEFAULT: 1]')
+    parser.add_argument('--warnings_report', type=str, help='File every per-file warning is written to, the console only shows counts and examples [DEFAULT: None]')
+    parser.add_argument('--stages', type=str, nargs='+', help='Stages to run in memory, in order, from read, extract, normalize, deduplicate, annotate and write [DEFAULT: read annotate write]')
+    parser.add_argument('--extraction_processes', type=int, help='Processes running fiction body extraction in the extract stage [DEFAULT: 1]')
+    parser.add_argument('--short_texts', type=str, help='Texts too short for body extraction are skipped or kept whole, skip or keep [DEFAULT: skip]')
+    parser.add_argument('--shard_output', type=bool, help='Append documents to size limited shard files indexed by document ID instead of one file each [DEFAULT: False]')
+    parser.add_argument('--shard_mb', type=int, help='Size at which a new shard file is started in MB [DEFAULT: 1024]')
+    parser.add_argument('--pipelined', type=bool, help='Read ahead, annotate and write in overlapping threads so the models never wait on disk or compression [DEFAULT: False]')
+    parser.add_argument('--prefetch_size', type=int, help='Documents read and prepared ahead of the models in a pipelined run [DEFAULT: 4]')
+    parser.add_argument('--writer_threads', type=int, help='Threads serialising, compressing and writing annotated documents in a pipelined run [DEFAULT: 2]')
+    parser.add_argument('--write_queue_size', type=int, help='Annotated documents waiting for a writer thread before annotation pauses [DEFAULT: 4]')
+    parser.add_argument('--write_queue_tokens', type=int, help='Annotated tokens waiting for the writer threads before annotation pauses, bounds memory on long documents [DEFAULT: 50000]')
+    parser.add_argument('--telemetry', type=str, help='JSON lines file of per-file stage timings, throughput, memory and periodic summaries with an ETA [DEFAULT: None]')
+    parser.add_argument('--telemetry_interval', type=int, help='Seconds between telemetry summaries [DEFAULT: 30]')
+    parser.add_argument('--profile_fraction', type=float, help='Fraction of files profiled while the run is in progress, needs telemetry [DEFAULT: 0.0]')
+    parser.add_argument('--profile_mode', type=str, help='Profiler for sampled files, cprofile (a .prof file per file) or tracemalloc [DEFAULT: "cprofile"]')
+    parser.add_argument('--profile_dir', type=str, help='Directory of cProfile outputs [DEFAULT: <telemetry>_profiles]')
+    parser.add_argument('--model_profile', type=str, help='SpaCy model tier, trf (en_core_web_trf), lg, md or sm [DEFAULT: "trf"]')
+    parser.add_argument('--prune_components', type=bool, help='Only load the SpaCy components the selected attributes need [DEFAULT: True]')
+    parser.add_argument('--compare_profiles', type=str, nargs='+', help='Compare the throughput and accuracy of these model profiles on a sample of benchmark_sample files [DEFAULT: None]')
+    parser.add_argument('--compare_reference', type=str, help='Profile the others are scored against in a profile comparison [DEFAULT: "trf"]')
+    parser.add_argument('--comparison_results', type=str, help='JSON file the profile comparison writes its results to [DEFAULT: "profile_comparison.json"]')
+    parser.add_argument('--token_index', type=str, help='SQLite file an inverted index of lemmas, word forms, POS and PyMUSAS tags is built in while writing [DEFAULT: None]')
+    parser.add_argument('--query', type=str, help='Query a token index instead of running the pipeline, e.g. "lemma:run pos:ADV", * matches any characters [DEFAULT: None]')
+    parser.add_argument('--query_index', type=str, help='Token index file queried or merged into [DEFAULT: "token_index.sqlite"]')
+    parser.add_argument('--query_mode', type=str, help='concordance, frequency, or terms (most frequent values of the field given as the query) [DEFAULT: "concordance"]')
+    parser.add_argument('--query_context', type=int, help='Words either side of a concordance match [DEFAULT: 5]')
+    parser.add_argument('--query_limit', type=int, help='Maximum concordance lines or terms returned [DEFAULT: 20]')
+    parser.add_argument('--query_facets', type=str, nargs='+', help='Metadata facets the query is restricted to as name=value [DEFAULT: None]')
+    parser.add_argument('--merge_index', type=str, nargs='+', help='Token index files merged into query_index [DEFAULT: None]')
+    parser.add_argument('--deduplicate', type=bool, help='Find exact and near duplicate files before annotation and only annotate the first of each cluster [DEFAULT: False]')
+    parser.add_argument('--duplicate_threshold', type=float, help='Estimated Jaccard similarity of word 5-grams at which files count as duplicates [DEFAULT: 0.8]')
+    parser.add_argument('--duplicate_links', type=bool, help="Link each duplicate's output path to its representative's output [DEFAULT: False]")
+    parser.add_argument('--normalize', type=str, help='Normalise every text before annotation with a preset (fiction, markup, basic) or a JSON file of rules, also used by the extract and normalize stages [DEFAULT: None]')
+    parser.add_argument('--work_queue', type=str, help='Shared SQLite work queue, on a filesystem every node mounts at the same path, files are claimed from it instead of listed [DEFAULT: None]')
+    parser.add_argument('--register_queue', type=bool, help='Coordinator mode, register the corpus in work_queue for workers to claim and exit [DEFAULT: False]')
+    parser.add_argument('--lease_seconds', type=int, help='Seconds a claimed file stays leased without a heartbeat before it is queued again [DEFAULT: 300]')
+    parser.add_argument('--claim_size', type=int, help='Files claimed from the work queue at a time [DEFAULT: 1]')
+    parser.add_argument('--max_attempts', type=int, help='Claims of a file before it is marked failed in the work queue [DEFAULT: 3]')
+    parser.add_argument('--queue_status', type=str, help='Print the progress of this work queue file and exit [DEFAULT: None]')
+    parser.add_argument('--retry_failed', type=bool, help='Queue the failed files of work_queue again when registering [DEFAULT: False]')
+    parser.add_argument('--dry_run', type=bool, help='Validate parameters and list the files to process without loading models [DEFAULT: False]')
+    parser.add_argument('--check_startup', type=bool, help=f'Measure CLI startup time against the {STARTUP_TARGET_SECONDS}s target and exit [DEFAULT: False]')
 
     args = vars(parser.parse_args())
+    if args['benchmark_repeats'] is not None and args['benchmark_repeats'] < 1:
+        parser.error(f"--benchmark_repeats needs to be at least 1, got {args['benchmark_repeats']}")
     filtered_args = {key: value for key, value in args.items() if value is not None}
     return filtered_args
 
 if __name__ == '__main__':
     program_args = main()
-    
+    dry_run = program_args.pop('dry_run', False)
+
+    if program_args.pop('check_startup', False):
+        seconds = startup_time()
+        print(f"### CLI Startup {seconds:.3f}s, Target {STARTUP_TARGET_SECONDS}s ###")
+        sys.exit(0 if seconds <= STARTUP_TARGET_SECONDS else 1)
+
+    query_args = {key: program_args.pop(key) for key in ['query', 'query_index', 'query_mode', 'query_context', 'query_limit', 'query_facets', 'merge_index'] if key in program_args}
+    if 'query' in query_args or 'merge_index' in query_args:
+        run_query(**query_args)
+        sys.exit(0)
+
+    if 'queue_status' in program_args:
+        queue_status(program_args.pop('queue_status'))
+        sys.exit(0)
+    register_queue = program_args.pop('register_queue', False)
+    retry_failed = program_args.pop('retry_failed', False)
+
+    suite_args = {key: program_args.pop(f'benchmark_{key}') for key in ['suite', 'sizes', 'repeats', 'results', 'baseline', 'tolerance'] if f'benchmark_{key}' in program_args}
+
+    comparison_args = {key: program_args.pop(key) for key in ['compare_profiles', 'compare_reference', 'comparison_results'] if key in program_args}
+
+    stage_args = {key: program_args.pop(key) for key in ['stages', 'extraction_processes', 'short_texts'] if key in program_args}
+
     pipeline = spacyPipeline(**program_args)
     if pipeline.init_status == False:
         pass
+    elif register_queue:
+        if retry_failed and pipeline.work_queue is not None:
+            print(f"### {pipeline.work_queue.retry_failed()} Failed File(s) Queued Again ###")
+        pipeline.register_queue()
+        pipeline.close_outputs()
+    elif suite_args.pop('suite', False):
+        from CorpusForge.Benchmark_Suite_Class import benchmarkSuite
+        renamed = {'sizes': 'synthetic_sizes', 'results': 'results_file', 'baseline': 'baseline_file'}
+        suite = benchmarkSuite(pipeline, sample_size=pipeline.benchmark_sample, **{renamed.get(key, key): value for key, value in suite_args.items()})
+        suite.run()
+        sys.exit(1 if len(suite.regressions) > 0 else 0)
+    elif 'compare_profiles' in comparison_args:
+        from CorpusForge.Profile_Comparison_Class import profileComparison
+        renamed = {'compare_profiles': 'profiles', 'compare_reference': 'reference', 'comparison_results': 'results_file'}
+        profileComparison(pipeline, sample_size=pipeline.benchmark_sample, **{renamed[key]: value for key, value in comparison_args.items()}).run()
+    elif dry_run:
+        print(f"### Dry Run: {len(pipeline.proc_files)} File(s) Would Be Processed ###")
+        pipeline.report_file_warnings()
     elif pipeline.start_benchmark == True:
         pipeline.benchmark()
+    elif len(stage_args) > 0:
+        from CorpusForge.Stage_Pipeline_Class import stagePipeline
+        stagePipeline(pipeline, **stage_args).run_all()
     else:
         pipeline.job_handler()
 
@@ -63,4 +227,5 @@ if __name__ == '__main__':
 # splitter = fictBodyExtraction(folder_path='/path/to/your/folder')
 # splitter.get_files()
 # split_dataframe = splitter.split_body()
+# split_dataframe = splitter.split_body(processes=8, output_dir='/path/to/split/output')
 
@@ -0,0 +1,157 @@
+# CASS Near-Duplicate Detection #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# Reissues and mirrored copies are found before annotation from MinHash signatures of word shingles of the normalised text.
+# Signatures are split into bands for locality sensitive hashing, documents sharing a band are compared on their signatures and
+# count as duplicates when the estimated Jaccard similarity of their shingles reaches the threshold. Identical normalised texts
+# are matched on a digest before any signature is compared. The first document seen is the representative of its cluster, only
+# representatives are indexed, so a document either joins an earlier cluster or starts its own, which lets a stage stream.
+
+
+import re
+import csv
+import zlib
+import hashlib
+
+
+word_regex = re.compile(r"\w+")
+# Tags are dropped from XML inputs, only their text is compared
+tag_regex = re.compile(r"<[^>]*>")
+MERSENNE_PRIME = (1 << 61) - 1
+SHINGLE_CHUNK = 8192
+
+
+class duplicateDetector:
+
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=5, seed=1):
+        import numpy as np
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        generator = np.random.default_rng(seed)
+        # Universal hashing of the 32 bit shingle hashes, a * x + b stays inside uint64
+        self.a = generator.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = generator.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.buckets = [{} for _ in range(self.bands)]
+        self.digests = {}
+        self.signatures = {}
+        self.clusters = {}
+        self.representative = {}
+        self.n_documents = 0
+
+    def __getstate__(self):
+        # Worker processes only compute signatures, the index stays with the parent
+        state = self.__dict__.copy()
+        state['buckets'] = [{} for _ in range(self.bands)]
+        for name in ['digests', 'signatures', 'clusters', 'representative']:
+            state[name] = {}
+        return state
+
+    def signature(self, text, is_xml=False):
+        # Returns (digest, signature), signature is None for texts without a word
+        import numpy as np
+        if is_xml:
+            text = tag_regex.sub(" ", text)
+        words = word_regex.findall(text.lower())
+        digest = hashlib.blake2b(" ".join(words).encode("UTF-8"), digest_size=16).digest()
+        if len(words) == 0:
+            return digest, None
+        vocabulary = {}
+        word_hashes = np.fromiter((vocabulary.setdefault(word, zlib.crc32(word.encode("UTF-8"))) for word in words), dtype=np.uint64, count=len(words))
+        shingles = shingle_hashes(word_hashes, self.shingle_size)
+        signature = np.full(self.num_perm, 0xFFFFFFFF, dtype=np.uint64)
+        # Shingles are hashed in chunks so a novel never builds a shingles x permutations matrix in one go
+        for start in range(0, len(shingles), SHINGLE_CHUNK):
+            chunk = shingles[start:start + SHINGLE_CHUNK, None]
+            hashed = ((chunk * self.a + self.b) % MERSENNE_PRIME) & 0xFFFFFFFF
+            np.minimum(signature, hashed.min(axis=0), out=signature)
+        return digest, signature.astype(np.uint32)
+
+    def add(self, key, text=None, is_xml=False, signature=None):
+        # Returns (representative, similarity) when key duplicates an earlier document, otherwise None and key starts a cluster
+        digest, signature = signature if signature is not None else self.signature(text, is_xml)
+        self.n_documents += 1
+        match = None
+        if digest in self.digests:
+            match = (self.digests[digest], 1.0)
+        elif signature is not None:
+            match = self.query(signature)
+        if match is not None:
+            representative, similarity = match
+            self.clusters[representative].append((key, similarity))
+            self.representative[key] = representative
+            return representative, similarity
+        self.digests[digest] = key
+        self.clusters[key] = []
+        if signature is not None:
+            self.signatures[key] = signature
+            for band, bucket in zip(self.band_keys(signature), self.buckets):
+                bucket.setdefault(band, []).append(key)
+        return None
+
+    def query(self, signature):
+        best = None
+        checked = set()
+        for band, bucket in zip(self.band_keys(signature), self.buckets):
+            for candidate in bucket.get(band, []):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                similarity = float((self.signatures[candidate] == signature).mean())
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (candidate, similarity)
+        return best
+
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def duplicates(self, key):
+        return [duplicate for duplicate, _ in self.clusters.get(key, [])]
+
+    def n_duplicates(self):
+        return len(self.representative)
+
+    def write_map(self, map_file, output_file=None):
+        # One row per duplicate, output_file maps a representative to the output its duplicates are linked to
+        with open(map_file, "w", newline="", encoding="UTF-8") as map_write:
+            writer = csv.writer(map_write)
+            writer.writerow(["duplicate", "representative", "similarity", "representative_output"])
+            for representative, members in self.clusters.items():
+                for duplicate, similarity in members:
+                    writer.writerow([duplicate, representative, f"{similarity:.4f}", output_file(representative) if output_file is not None else ""])
+
+
+def read_duplicate_map(map_file):
+    # Returns {representative: [duplicates]} and {duplicate: representative} from a map written by write_map
+    clusters = {}
+    representative = {}
+    with open(map_file, newline="", encoding="UTF-8") as map_read:
+        for row in csv.DictReader(map_read):
+            clusters.setdefault(row['representative'], []).append(row['duplicate'])
+            representative[row['duplicate']] = row['representative']
+    return clusters, representative
+
+def lsh_bands(threshold, num_perm, recall=0.95):
+    # Bands x rows = num_perm, the most rows per band (fewest candidates) that still make a pair at the threshold a candidate
+    # with the given probability, 1 - (1 - threshold ** rows) ** bands
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return max((option for option in options if 1 - (1 - threshold ** option[1]) ** option[0] >= recall), key=lambda option: option[1], default=(num_perm, 1))
+
+def shingle_hashes(word_hashes, shingle_size):
+    # Distinct 32 bit hashes of every run of shingle_size words, shorter texts are one shingle
+    import numpy as np
+    size = min(shingle_size, len(word_hashes))
+    shingles = np.zeros(len(word_hashes) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        shingles = (shingles * np.uint64(1000003) + word_hashes[offset:len(word_hashes) - size + 1 + offset]) & np.uint64(0xFFFFFFFF)
+    return np.unique(shingles)
+
+def file_signature(job):
+    # Module level so signatures can be computed in worker processes, job is (detector, input_file, errors)
+    from CorpusForge.SpaCy_Pipeline_Class import read_input_file
+    detector, input_file, errors = job
+    content, is_xml, _ = read_input_file(input_file, errors)
+    return detector.signature(content, is_xml)
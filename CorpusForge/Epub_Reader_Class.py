@@ -0,0 +1,37 @@
+# CASS EPUB Reader #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+
+dc_fields = ['title', 'creator', 'language', 'identifier', 'publisher', 'date']
+
+
+def read_epub(file):
+    # Returns {'metadata': {dc_<field>: value}, 'sections': [text of each document item]}, module level so it can run in worker processes
+    from ebooklib import epub, ITEM_DOCUMENT
+    book = epub.read_epub(file)
+
+    metadata = {}
+    for field in dc_fields:
+        values = [str(value) for value, _ in book.get_metadata('DC', field) if value]
+        metadata[f"dc_{field}"] = "; ".join(values) if len(values) > 0 else "NA"
+
+    sections = []
+    for item in book.get_items_of_type(ITEM_DOCUMENT):
+        text = chapter_text(item.get_content())
+        if len(text) > 1:
+            sections.append(text)
+    return {'metadata': metadata, 'sections': sections}
+
+def chapter_text(content):
+    # Each chapter is parsed once, the text of its paragraphs joined by spaces
+    from ebooklib.utils import parse_html_string
+    try:
+        tree = parse_html_string(content)
+    except Exception:
+        return ""
+    body = tree.find("body")
+    if body is None:
+        return ""
+    return ' '.join(paragraph.text_content() for paragraph in body.iter('p'))
@@ -5,18 +5,40 @@
 #  #
 import os
 import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-import pandas as pd
-from bs4 import BeautifulSoup
+from CorpusForge.Text_Normalizer_Class import textNormalizer
+
+# Patterns are compiled once per process rather than for every file
+beginnings = re.compile(r'(\n[\s\-\*\#]*((CHAPTER[\s\-\*\#]*(I|1|One))|(part[\s\-\*\#]*(1|I|One))|(FIRST[\s\-\*\#]*CHAPTER)|(First[\s\-\*\#]*part)|(preface)))|(([\s\-\*\#]+(INTRODUCTION|ONE|I\.|1\.)[\s\-\*\#]*\n)|(Prologue[\s\-\*\#]*\n)|([\s\-\*\#]*Episode \d+.{0,15}\n)|(\n\*\*1\*\*\n))', re.I)
+ends = re.compile(r'(\n[\s\-\*\#]*(glossary|acknowledgements|BIBLIOGRAPHY|THE END|recipes)[\s\-\*\#]*\n)|(((Author.?s Note)|(\*\*Table of Contents\*\*)|(This is a work of fiction)|(post-?script)|(epilogue)|(ACKNOWLEDGMENTS)|(\*What\'s next)|(About the Author)|(Other .{3,30} by .{1,50})[\s\-\*\#]*\n))', re.I)
+contents = re.compile(r'(TOC)|(contents)[\s\*\#]*\n(.{1,50}\n{1,3}){5,}')
+
+# The clean up before splitting and of the split main text, shared with annotation through textNormalizer
+fiction_normalizer = textNormalizer.preset("fiction")
+markup_normalizer = textNormalizer.preset("markup")
+
+forbiddencontents = ["ABOUT THE AUTHOR","ALSO BY ", 'ISBN: 978', 'Jacket image by', 'is the author', 'contents','Times Book Review','sign up for our newsletters','Book Club pick','the publisher does not',
+"Praise for", 'acknowledgements', 'writing of this book', 'Independent Publishers', 'ACKNOWLEDGMENTS', 'book design', "What's next on",'for more information about ','about the authors',
+"©", '### available from', 'e-book', 'Printed in', 'is dedicated to', "Children's Books supports the First Amendment",'MEET THE AUTHOR'
+"This is a work of fiction", "right to reproduce", "Translation copyright", "all rights reserved", "ISBN 97", "are registered trademarks of", "cover design by", "any resemblance to actual persons", "AUTHOR'S NOTE", "this novel is a work of fiction", 'Books by',
+"Version\\_","TRADEMARK REGISTERED","All Rights Reserved.","Copyright infringement is against the law.",'**CONTENTS**', '# Contents', 'jacket art by', 'events in this book are fictitious', 'to persons living or dead', '—*Booklist*', 'to the memory of ', 'previously published in', 'TITLES BY MERCEDES LACKEY']
+forbiddencontents = [i.lower() for i in forbiddencontents]
 
 class fictBodyExtraction:
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, normalizer=None):
         self.folder_path = folder_path
+        # A preset name, JSON rules file or textNormalizer replacing the fiction clean up before splitting
+        self.normalizer = textNormalizer.from_config(normalizer) if normalizer is not None else None
         self.txtfilelist = []
         self.epubfilelist = []
         self.splitfiles = {}
         self.tooshortfiles = {}
 
+    # Reference checks for a single window, split_text scans every window at once with paragraphWindows
+    @staticmethod
     def startchecker(needles, haystackindex, paragraphs):
         window_size = 20
         testing = ' '.join(paragraphs[haystackindex: haystackindex + window_size]).lower()
@@ -25,6 +47,7 @@ class fictBodyExtraction:
             if not any(substring in testing for substring in needles):
                 return haystackindex
 
+    @staticmethod
     def endchecker(needles, haystackindex, paragraphs):
         window_size = 5
         testing = ' '.join(paragraphs[haystackindex:haystackindex+window_size]).lower()
@@ -32,96 +55,248 @@ class fictBodyExtraction:
             if not any(substring in testing for substring in needles):
                 return haystackindex+window_size
 
-    def split_body(self):
-        splitfiles = {}
-        tooshortfiles ={}
-
-        beginnings = r'(\n[\s\-\*\#]*((CHAPTER[\s\-\*\#]*(I|1|One))|(part[\s\-\*\#]*(1|I|One))|(FIRST[\s\-\*\#]*CHAPTER)|(First[\s\-\*\#]*part)|(preface)))|(([\s\-\*\#]+(INTRODUCTION|ONE|I\.|1\.)[\s\-\*\#]*\n)|(Prologue[\s\-\*\#]*\n)|([\s\-\*\#]*Episode \d+.{0,15}\n)|(\n\*\*1\*\*\n))'
-        ends = r'(\n[\s\-\*\#]*(glossary|acknowledgements|BIBLIOGRAPHY|THE END|recipes)[\s\-\*\#]*\n)|(((Author.?s Note)|(\*\*Table of Contents\*\*)|(This is a work of fiction)|(post-?script)|(epilogue)|(ACKNOWLEDGMENTS)|(\*What\'s next)|(About the Author)|(Other .{3,30} by .{1,50})[\s\-\*\#]*\n))'
-        contents =  r'(TOC)|(contents)[\s\*\#]*\n(.{1,50}\n{1,3}){5,}'
-
-        forbiddencontents = ["ABOUT THE AUTHOR","ALSO BY ", 'ISBN: 978', 'Jacket image by', 'is the author', 'contents','Times Book Review','sign up for our newsletters','Book Club pick','the publisher does not',
-        "Praise for", 'acknowledgements', 'writing of this book', 'Independent Publishers', 'ACKNOWLEDGMENTS', 'book design', "What's next on",'for more information about ','about the authors',
-        "©", '### available from', 'e-book', 'Printed in', 'is dedicated to', "Children's Books supports the First Amendment",'MEET THE AUTHOR'
-        "This is a work of fiction", "right to reproduce", "Translation copyright", "all rights reserved", "ISBN 97", "are registered trademarks of", "cover design by", "any resemblance to actual persons", "AUTHOR'S NOTE", "this novel is a work of fiction", 'Books by', 
-        "Version\_","TRADEMARK REGISTERED","All Rights Reserved.","Copyright infringement is against the law.",'**CONTENTS**', '# Contents', 'jacket art by', 'events in this book are fictitious', 'to persons living or dead', '—*Booklist*', 'to the memory of ', 'previously published in', 'TITLES BY MERCEDES LACKEY']
-        forbiddencontents = [i.lower() for i in forbiddencontents]
-
-
-        for file in tqdm(self.txtfilelist):
-            with open(str(file), 'r+', encoding='utf-8') as inf: 
-                text = inf.read()
-                text = re.sub(r"[\s\*\#]+\n(.{1,50}\n{1,3}){5,}", " ",text, 0, re.IGNORECASE)
-                text = text.replace(u"\u002D\u00ad", '')
-                text = text.replace(u"\u00ad", '')
-                text = re.sub(r"[\u2018\u2019\u201C\u201D\u2039\u203A`’\‘’“”‹›•']", "'", text, 0, re.MULTILINE)
-                text = re.sub(r"\n{2,}", "\n", text, 0, re.MULTILINE | re.DOTALL)
-                text = re.sub(r"[\r\t\f\v  ]", " ", text, 0, re.MULTILINE | re.DOTALL)
-                text = re.sub(r" {2,}", " ", text, 0, re.MULTILINE | re.DOTALL)
-                pretext = ''
-                mainandend = ''
-                posttext = ''
-                main=''
-                last25percent = ''
-                first75percent = ''
-
-                if len(text.split(' ')) < 30000:
-                    splitfiles[file.split('/')[-1]] = ['tooshort', len(text.split(' ')),0,0,0]
+    def iter_split(self, processes=1, output_dir=None):
+        # Yields (key, [b_status, e_status, pretext, main, posttext]) per file in txtfilelist order,
+        # with output_dir the three parts are written to disk and the row holds their paths instead
+        if output_dir is not None:
+            for part in ['pretext', 'main', 'posttext']:
+                os.makedirs(os.path.join(output_dir, part), exist_ok=True)
+        jobs = ((file, output_dir, self.normalizer) for file in self.txtfilelist)
+        with tqdm(total=len(self.txtfilelist)) as progress:
+            if processes == 1:
+                for job in jobs:
+                    yield split_file(job)
+                    progress.update(1)
+                return
+            # A bounded number of files are in flight so finished novels never pile up in memory
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                pending = deque()
+                for job in jobs:
+                    pending.append(executor.submit(split_file, job))
+                    if len(pending) >= processes * 2:
+                        yield pending.popleft().result()
+                        progress.update(1)
+                while pending:
+                    yield pending.popleft().result()
+                    progress.update(1)
 
-                else:
-                    b_textparts  = re.split(beginnings, text, maxsplit=1, flags= re.I)
-
-                    if len(b_textparts) > 1:
-                        pretext = b_textparts[0]
-                        mainandend = b_textparts[-1]
-                        b_status = 'fine'
-                        
-                    else:
-                        paragraphs = text.split('\n')
-                        paragraphs = [i for i in paragraphs if i]
-                        window_size = 10
-                        for i in range(len(paragraphs) - window_size + 1):
-                            breakindex = self.startchecker(forbiddencontents, i, paragraphs=paragraphs)
-                            if breakindex:
-                                pretext = '\n'.join(paragraphs[:breakindex+1])
-                                mainandend = '\n'.join(paragraphs[breakindex+1:])
-                                break
-                            else:
-                                continue
-
-                    last25percent = mainandend[round(0.75*len(mainandend)):]
-                    first75percent = mainandend[:round(0.75*len(mainandend))]
-
-                    e_textparts = re.split(ends, last25percent, flags= re.I)
-                    if len(e_textparts) > 1:
-                        main = [textpart for textpart in e_textparts[:-1] if textpart]
-                        main = ' '.join(map(str, main))
-                        main = first75percent+ ' '+ main
-                        posttext = e_textparts[-1]
-                        e_status = 'fine'
-
-                    else:
-                        paragraphs = last25percent.split('\n')
-                        paragraphs = [i for i in paragraphs if i]
-                        window_size = 10
-                        for i in reversed(range(len(paragraphs) - window_size + 1)):
-                            breakindex = self.endchecker(forbiddencontents, i, paragraphs=paragraphs)
-                            if breakindex:
-                                main = first75percent+ '\n'.join(paragraphs[:breakindex-1])
-                                posttext = '\n'.join(paragraphs[breakindex-1:])
-                                e_status = 'fine'
-                                break
-                            else:
-                                continue
-                    main = main.replace('*', "")
-                    main = main.replace('#', ' ')
-                    main = main.replace('~', ' ')
-                    main = re.sub(r" {2,}", " ", main, 0, re.MULTILINE | re.DOTALL)
-                        
-                    splitfiles[file] = [b_status, e_status,pretext,main,posttext]
+    def split_body(self, processes=1, output_dir=None):
+        import pandas as pd
+        splitfiles = {}
+        for key, row in self.iter_split(processes, output_dir):
+            splitfiles[key] = row
 
+        columns = ['pretext', 'main', 'posttext'] if output_dir is None else ['pretext_file', 'main_file', 'posttext_file']
         split = pd.DataFrame(splitfiles).T
-        split = split.rename(columns={0: "b_status", 1: "e_status", 2:'pretext', 3: 'main', 4: 'posttext'})
+        split = split.rename(columns={0: "b_status", 1: "e_status", 2: columns[0], 3: columns[1], 4: columns[2]})
         split = split.reset_index()
         split = split.rename(columns={'index':'path'})
-        return split
\ No newline at end of file
+        return split
+
+
+class needleScanner:
+    # Aho-Corasick automaton, every needle is found in one pass over the text
+    def __init__(self, needles):
+        self.goto = [{}]
+        self.fail = [0]
+        # Length of the shortest needle ending at each state, 0 for none
+        self.shortest = [0]
+        for needle in needles:
+            if not needle:
+                continue
+            state = 0
+            for char in needle:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.shortest.append(0)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            if self.shortest[state] == 0 or len(needle) < self.shortest[state]:
+                self.shortest[state] = len(needle)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                inherited = self.shortest[self.fail[next_state]]
+                if inherited and (self.shortest[next_state] == 0 or inherited < self.shortest[next_state]):
+                    self.shortest[next_state] = inherited
+
+    def scan(self, text, state=0):
+        # Returns the state after text and (end, length) of the shortest needle ending at each position,
+        # any window holding a longer needle ending there holds this one too
+        goto, fail, shortest = self.goto, self.fail, self.shortest
+        hits = []
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if shortest[state]:
+                hits.append((position + 1, shortest[state]))
+        return state, hits
+
+class paragraphWindows:
+    # Answers the checker tests for windows of paragraphs from prefix sums, the paragraphs are lowered once and
+    # fed through the needle automaton only as far as the windows asked for, forwards or (reversed) backwards
+    def __init__(self, paragraphs, scanner, reverse=False):
+        self.lowered = [paragraph.lower() for paragraph in paragraphs]
+        self.n = len(self.lowered)
+        self.scanner = scanner
+        self.reverse = reverse
+        self.lengths = [0]
+        self.starts = []
+        self.ends = []
+        position = 0
+        for paragraph in self.lowered:
+            self.lengths.append(self.lengths[-1] + len(paragraph))
+            self.starts.append(position)
+            position += len(paragraph)
+            self.ends.append(position)
+            position += 1
+        self.total = max(position - 1, 0)
+        self.state = 0
+        # Forwards bound[j] is the highest first paragraph of a needle lying within paragraphs ..j,
+        # backwards bound[i] is the lowest last paragraph of a needle lying within paragraphs i..
+        self.bound = {}
+        self.scanned = self.n if reverse else -1
+
+    def paragraph_span(self, start, end):
+        return bisect_right(self.starts, start) - 1, bisect_left(self.ends, end)
+
+    def advance(self, k):
+        while (self.scanned > k) if self.reverse else (self.scanned < k):
+            if self.reverse:
+                self.scanned -= 1
+                text = self.lowered[self.scanned][::-1] if self.scanned == self.n - 1 else ' ' + self.lowered[self.scanned][::-1]
+                offset = self.total - self.ends[self.scanned] - (0 if self.scanned == self.n - 1 else 1)
+                bound = self.bound.get(self.scanned + 1, self.n)
+            else:
+                self.scanned += 1
+                text = self.lowered[self.scanned] if self.scanned == 0 else ' ' + self.lowered[self.scanned]
+                offset = self.starts[self.scanned] - (0 if self.scanned == 0 else 1)
+                bound = self.bound.get(self.scanned - 1, -1)
+            self.state, hits = self.scanner.scan(text, self.state)
+            for end, length in hits:
+                if self.reverse:
+                    first, last = self.paragraph_span(self.total - offset - end, self.total - offset - end + length)
+                    bound = min(bound, last)
+                else:
+                    first, last = self.paragraph_span(offset + end - length, offset + end)
+                    bound = max(bound, first)
+            self.bound[self.scanned] = bound
+
+    def length(self, i, window_size):
+        # len(' '.join(paragraphs[i:i + window_size]).lower())
+        j = min(i + window_size, self.n)
+        if j <= i:
+            return 0
+        return self.lengths[j] - self.lengths[i] + j - i - 1
+
+    def clean(self, i, window_size):
+        j = min(i + window_size, self.n) - 1
+        if j < i:
+            return True
+        if self.reverse:
+            self.advance(i)
+            return self.bound[i] > j
+        self.advance(j)
+        return self.bound[j] < i
+
+forbidden_scanner = needleScanner(forbiddencontents)
+forbidden_scanner_reversed = needleScanner([needle[::-1] for needle in forbiddencontents])
+
+def find_start(paragraphs):
+    # Same decision as startchecker over range(len(paragraphs) - 9), index 0 is never returned as it is falsy
+    windows = paragraphWindows(paragraphs, forbidden_scanner)
+    for i in range(1, len(paragraphs) - 10 + 1):
+        if windows.length(i, 20) > 20*80 and windows.length(i, 5) > 400 and windows.clean(i, 20):
+            return i
+
+def find_end(paragraphs):
+    # Same decision as endchecker scanned from the last window backwards
+    windows = paragraphWindows(paragraphs, forbidden_scanner_reversed, reverse=True)
+    for i in reversed(range(len(paragraphs) - 10 + 1)):
+        if windows.length(i, 5) > 5*100 and windows.clean(i, 5):
+            return i + 5
+
+def normalise_text(text):
+    return fiction_normalizer.normalize(text)
+
+def split_text(text):
+    # Returns [b_status, e_status, pretext, main, posttext], statuses stay 'failed' when no boundary is found
+    pretext = ''
+    mainandend = ''
+    posttext = ''
+    main=''
+    b_status = 'failed'
+    e_status = 'failed'
+
+    b_textparts  = beginnings.split(text, maxsplit=1)
+
+    if len(b_textparts) > 1:
+        pretext = b_textparts[0]
+        mainandend = b_textparts[-1]
+        b_status = 'fine'
+
+    else:
+        paragraphs = text.split('\n')
+        paragraphs = [i for i in paragraphs if i]
+        breakindex = find_start(paragraphs)
+        if breakindex:
+            pretext = '\n'.join(paragraphs[:breakindex+1])
+            mainandend = '\n'.join(paragraphs[breakindex+1:])
+            b_status = 'fine'
+
+    last25percent = mainandend[round(0.75*len(mainandend)):]
+    first75percent = mainandend[:round(0.75*len(mainandend))]
+
+    e_textparts = ends.split(last25percent)
+    if len(e_textparts) > 1:
+        main = [textpart for textpart in e_textparts[:-1] if textpart]
+        main = ' '.join(map(str, main))
+        main = first75percent+ ' '+ main
+        posttext = e_textparts[-1]
+        e_status = 'fine'
+
+    else:
+        paragraphs = last25percent.split('\n')
+        paragraphs = [i for i in paragraphs if i]
+        breakindex = find_end(paragraphs)
+        if breakindex:
+            main = first75percent+ '\n'.join(paragraphs[:breakindex-1])
+            posttext = '\n'.join(paragraphs[breakindex-1:])
+            e_status = 'fine'
+    main = markup_normalizer.normalize(main)
+
+    return [b_status, e_status, pretext, main, posttext]
+
+def split_document(text, normalizer=None):
+    # Normalises and splits one text in memory, returns the row split_body stores for it
+    text = normalizer.normalize(text) if normalizer is not None else normalise_text(text)
+    n_words = len(text.split(' '))
+    if n_words < 30000:
+        return ['tooshort', n_words, 0, 0, 0]
+    return split_text(text)
+
+def split_file(job):
+    # Module level so it can run in worker processes, returns the same key and row split_body has always stored
+    file, output_dir, normalizer = job
+    with open(str(file), 'r', encoding='utf-8') as inf:
+        row = split_document(inf.read(), normalizer)
+    if row[0] == 'tooshort':
+        return file.split('/')[-1], row
+
+    if output_dir is not None:
+        name = os.path.splitext(file.split('/')[-1])[0] + ".txt"
+        for index, part in zip([2, 3, 4], ['pretext', 'main', 'posttext']):
+            part_file = os.path.join(output_dir, part, name)
+            with open(part_file, 'w', encoding='utf-8') as outf:
+                outf.write(row[index])
+            row[index] = part_file
+    return file, row
@@ -0,0 +1,191 @@
+# CASS Metadata Index #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+
+import os
+import json
+import sqlite3
+
+
+class metadataIndex:
+
+    key_column = "_corpusforge_key"
+    # Bumped whenever the layout of the SQLite cache changes
+    cache_version = 2
+
+    def __init__(self, metadata_file, id_column="ID", backend="memory", db_file=None, chunksize=50000):
+        self.metadata_file = metadata_file
+        self.id_column = id_column
+        self.backend = backend
+        self.db_file = db_file if db_file is not None else metadata_file + ".sqlite"
+        self.chunksize = chunksize
+        self.file_type = os.path.splitext(metadata_file)[1].lower()
+        self.warnings = []
+        self.status = True
+        self.columns = []
+        self.rows = {}
+        self.ids = set()
+        self.column_kinds = {}
+        self.connection = None
+
+        if not os.path.exists(metadata_file):
+            self.warnings.append(f"Metadata file '{metadata_file}' does not exist")
+            self.status = False
+        elif self.file_type not in [".csv", ".tsv", ".xlsx"]:
+            self.warnings.append(f"Metadata file is unknown file type '{self.file_type}'")
+            self.status = False
+        elif backend == "memory":
+            self.load_memory()
+        elif backend == "sqlite":
+            self.load_sqlite()
+        else:
+            self.warnings.append(f"Unknown metadata backend '{backend}', use 'memory' or 'sqlite'")
+            self.status = False
+
+    def __getstate__(self):
+        # SQLite connections cannot be shared with worker processes, each process reconnects on first lookup
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def normalise(self, value):
+        return str(value).strip().lower()
+
+    def read_metadata(self, **kwargs):
+        import pandas as pd
+        if self.file_type == ".xlsx":
+            return pd.read_excel(self.metadata_file, **kwargs)
+        sep = '\t' if self.file_type == ".tsv" else ','
+        return pd.read_csv(self.metadata_file, sep=sep, **kwargs)
+
+    def read_chunks(self):
+        # Excel files cannot be read in chunks
+        if self.file_type == ".xlsx":
+            yield self.read_metadata()
+        else:
+            yield from self.read_metadata(chunksize=self.chunksize)
+
+    def check_columns(self, columns):
+        self.columns = list(columns)
+        if self.id_column not in self.columns:
+            self.warnings.append(f"Metadata ID column '{self.id_column}' not in metadata")
+            self.status = False
+        return self.status
+
+    def load_memory(self):
+        metadata_df = self.read_metadata()
+        if not self.check_columns(metadata_df.columns):
+            return
+        metadata_df[self.id_column] = metadata_df[self.id_column].apply(self.normalise)
+        for row in metadata_df.to_dict(orient='records'):
+            # Duplicate IDs keep the first row, as the DataFrame lookup did
+            self.rows.setdefault(row[self.id_column], row)
+        self.ids = set(self.rows)
+
+    def cache_key(self):
+        # Everything the cached rows depend on, the cache is rebuilt when any of it differs
+        stat = os.stat(self.metadata_file)
+        return {'version': self.cache_version, 'id_column': self.id_column, 'file_type': self.file_type,
+                'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+
+    def cached_key(self):
+        if not os.path.exists(self.db_file):
+            return None
+        connection = sqlite3.connect(self.db_file)
+        try:
+            return json.loads(connection.execute("SELECT value FROM corpusforge_meta WHERE key = 'cache_key'").fetchone()[0])
+        except (sqlite3.DatabaseError, TypeError, ValueError):
+            return None
+        finally:
+            connection.close()
+
+    def column_kind(self, column):
+        # numpy dtype kind of a chunk's column, object columns holding booleans (a boolean column with gaps) count as 'b' too
+        kinds = {column.dtype.kind}
+        if column.dtype.kind == "O" and column.map(lambda value: isinstance(value, bool)).any():
+            kinds.add("b")
+        return kinds
+
+    def load_sqlite(self):
+        cache_key = self.cache_key()
+        if self.cached_key() != cache_key:
+            tmp_file = self.db_file + ".tmp"
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            if not self.check_columns(self.read_metadata(nrows=0).columns):
+                return
+            connection = sqlite3.connect(tmp_file)
+            column_kinds = {}
+            for chunk in self.read_chunks():
+                chunk[self.id_column] = chunk[self.id_column].apply(self.normalise)
+                for name in chunk.columns:
+                    column_kinds.setdefault(name, set()).update(self.column_kind(chunk[name]))
+                chunk[self.key_column] = chunk[self.id_column]
+                chunk.to_sql("metadata", connection, if_exists="append", index=False)
+            connection.execute(f'CREATE INDEX IF NOT EXISTS metadata_key ON metadata ("{self.key_column}")')
+            # SQLite keeps booleans as integers and integral floats in integer columns, the kinds let rows come back as the memory backend has them
+            connection.execute("CREATE TABLE corpusforge_meta (key TEXT PRIMARY KEY, value TEXT)")
+            connection.executemany("INSERT INTO corpusforge_meta VALUES (?, ?)",
+                                   [('cache_key', json.dumps(cache_key)), ('column_kinds', json.dumps({name: sorted(kinds) for name, kinds in column_kinds.items()}))])
+            connection.commit()
+            connection.close()
+            os.replace(tmp_file, self.db_file)
+
+        connection = self.connect()
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(metadata)") if row[1] != self.key_column]
+        if self.check_columns(columns):
+            self.ids = {row[0] for row in connection.execute(f'SELECT DISTINCT "{self.key_column}" FROM metadata')}
+            self.column_kinds = {name: set(kinds) for name, kinds in json.loads(connection.execute("SELECT value FROM corpusforge_meta WHERE key = 'column_kinds'").fetchone()[0]).items()}
+
+    def restore(self, name, value):
+        # A value read from SQLite as pandas read it, NULL is NaN
+        if value is None:
+            return float('nan')
+        kinds = self.column_kinds.get(name, set())
+        if "b" in kinds and isinstance(value, int):
+            return bool(value)
+        if "f" in kinds and kinds <= {"i", "u", "f"} and isinstance(value, int):
+            return float(value)
+        return value
+
+    def connect(self):
+        if self.connection is None:
+            # Pipelined runs look metadata up from their prefetch thread
+            self.connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        return self.connection
+
+    def get_row(self, key):
+        if key not in self.ids:
+            return None
+        if self.backend == "memory":
+            return dict(self.rows[key])
+        cursor = self.connect().execute(f'SELECT * FROM metadata WHERE "{self.key_column}" = ? ORDER BY rowid LIMIT 1', (key,))
+        names = [description[0] for description in cursor.description]
+        values = cursor.fetchone()
+        return {name: self.restore(name, value) for name, value in zip(names, values) if name != self.key_column}
+
+    def candidate_IDs(self, file):
+        file_w_ending = file.split(os.sep)[-1].lower()
+        file_wo_ending = file_w_ending.replace(os.path.splitext(file)[1].lower(), "")
+        return file_w_ending, file_wo_ending
+
+    def lookup(self, file):
+        # Returns the matched ID (or the ID without extension) and the metadata row, None when not present
+        for pot_ID in self.candidate_IDs(file):
+            row = self.get_row(pot_ID)
+            if row is not None:
+                return pot_ID, row
+        return pot_ID, None
+
+    def empty_row(self):
+        return dict.fromkeys(self.columns, float('nan'))
+
+    def has_file(self, file):
+        return not self.ids.isdisjoint(self.candidate_IDs(file))
+
+    def missing_files(self, files):
+        candidates = {file: self.candidate_IDs(file) for file in files}
+        found = self.ids.intersection(pot_ID for pot_IDs in candidates.values() for pot_ID in pot_IDs)
+        return [file for file, pot_IDs in candidates.items() if found.isdisjoint(pot_IDs)]
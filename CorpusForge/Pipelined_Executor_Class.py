@@ -0,0 +1,194 @@
+# CASS Pipelined Executor #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# Overlaps the three stages of a single process run: a prefetch thread reads and prepares upcoming documents,
+# the calling thread runs the models, and writer threads serialise, compress and write the finished documents.
+# Bounded queues between the stages cap how many documents are held in memory at once. Annotated sentences are streamed
+# to the writer of their document in batches, the tokens waiting for a writer are capped by write_queue_tokens.
+
+
+import time
+import queue
+import threading
+
+
+# Tokens handed to a writer thread at a time
+STREAM_BATCH_TOKENS = 1000
+
+
+class pipelinedExecutor:
+
+    def __init__(self, pipeline, prefetch_size=4, writer_threads=2, write_queue_size=4, write_queue_tokens=50000):
+        self.pipeline = pipeline
+        self.prefetch_size = prefetch_size
+        self.writer_threads = writer_threads
+        self.write_queue = queue.Queue(maxsize=write_queue_size)
+        self.write_queue_tokens = write_queue_tokens
+        self.held_tokens = 0
+        self.held = threading.Condition()
+        self.output_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.writers = []
+        self.error = None
+
+    def __enter__(self):
+        for _ in range(self.writer_threads):
+            writer = threading.Thread(target=self.writer_loop, daemon=True)
+            writer.start()
+            self.writers.append(writer)
+        self.pipeline.pipelined_executor = self
+        if self.pipeline.telemetry is not None:
+            self.pipeline.telemetry.watch("write", self.write_queue.qsize)
+        return self
+
+    def __exit__(self, error_type, *args):
+        if self.pipeline.telemetry is not None:
+            self.pipeline.telemetry.unwatch("write")
+        if error_type is not None:
+            self.stopping.set()
+        try:
+            self.close()
+        except BaseException:
+            # The error that stopped the run is the one reported
+            if error_type is None:
+                raise
+        finally:
+            # Kept until the writers have finished, they time their documents differently while it is set
+            self.pipeline.pipelined_executor = None
+        return False
+
+    def prefetch(self, documents):
+        # Runs the documents generator in a background thread, at most prefetch_size documents wait for the models
+        prefetched = queue.Queue(maxsize=self.prefetch_size)
+        done = object()
+
+        def producer():
+            try:
+                for document in documents:
+                    if not self.put(prefetched, (document, None)):
+                        return
+                self.put(prefetched, (done, None))
+            except BaseException as error:
+                self.put(prefetched, (done, error))
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        if self.pipeline.telemetry is not None:
+            self.pipeline.telemetry.watch("prefetch", prefetched.qsize)
+        try:
+            while True:
+                document, error = prefetched.get()
+                if error is not None:
+                    raise error
+                if document is done:
+                    return
+                yield document
+        finally:
+            if self.pipeline.telemetry is not None:
+                self.pipeline.telemetry.unwatch("prefetch")
+            self.stopping.set()
+            thread.join()
+            self.stopping.clear()
+
+    def put(self, target, item):
+        # Blocks while the queue is full, gives up once the run is stopping
+        while not self.stopping.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def submit(self, soup, sentences, input_file, output_file):
+        # Annotation happens here as the sentences are consumed, only serialisation and writing are handed over.
+        # The writer takes the document as soon as one is free and writes its sentences while the rest are annotated
+        if self.error is not None:
+            raise self.error
+        stream = queue.Queue()
+        self.write_queue.put((soup, stream, input_file, output_file))
+        start = time.perf_counter()
+        waited = 0.0
+        batch = []
+        batch_tokens = 0
+        try:
+            for sentence in sentences:
+                batch.append(sentence)
+                batch_tokens += len(sentence)
+                if batch_tokens >= STREAM_BATCH_TOKENS:
+                    waited += self.hand_over(stream, batch, batch_tokens)
+                    batch = []
+                    batch_tokens = 0
+            if len(batch) > 0:
+                waited += self.hand_over(stream, batch, batch_tokens)
+        except BaseException as error:
+            # The writer discards the partial document
+            stream.put(error)
+            raise
+        telemetry = self.pipeline.telemetry
+        if telemetry is not None:
+            # Added before the end of the stream, the writer finishes the document's record once it is reached
+            telemetry.add(output_file, "annotate", time.perf_counter() - start - waited)
+            telemetry.take_components(output_file)
+        stream.put(None)
+
+    def hand_over(self, stream, batch, batch_tokens):
+        # Waits while the tokens held for the writers are over budget, a batch is always let through when none are held
+        start = time.perf_counter()
+        with self.held:
+            while self.held_tokens > 0 and self.held_tokens + batch_tokens > self.write_queue_tokens:
+                if self.error is not None:
+                    raise self.error
+                self.held.wait(0.1)
+            self.held_tokens += batch_tokens
+        stream.put((batch, batch_tokens))
+        return time.perf_counter() - start
+
+    def drain(self, stream):
+        # The sentences of one document as the annotating thread hands them over
+        while True:
+            item = stream.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            batch, batch_tokens = item
+            yield from batch
+            with self.held:
+                self.held_tokens -= batch_tokens
+                self.held.notify_all()
+
+    def writer_loop(self):
+        pipeline = self.pipeline
+        while True:
+            job = self.write_queue.get()
+            if job is None:
+                return
+            if self.error is not None:
+                continue
+            soup, stream, input_file, output_file = job
+            sentences = self.drain(stream)
+            try:
+                if pipeline.shard_writer is not None:
+                    # Every document is appended to the same shard, shard writes are taken in turn
+                    with self.output_lock:
+                        digests = pipeline.write_output(soup, sentences, output_file)
+                else:
+                    digests = pipeline.write_output(soup, sentences, output_file)
+                if input_file is not None:
+                    with self.output_lock:
+                        pipeline.record_output(input_file, output_file, digests)
+            except BaseException as error:
+                self.error = error
+
+    def close(self):
+        for _ in self.writers:
+            self.write_queue.put(None)
+        for writer in self.writers:
+            writer.join()
+        self.writers = []
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
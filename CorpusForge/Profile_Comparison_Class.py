@@ -0,0 +1,123 @@
+# CASS Model Profile Comparison #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# Annotates a sample of the corpus with each installed model profile and reports throughput and accuracy.
+# There is no gold standard, accuracy is agreement with the reference profile (trf by default) on tokens both profiles share,
+# per selected attribute, plus the F1 of the sentence boundaries. Only the components the selected attributes need are loaded.
+
+
+import json
+import time
+from datetime import datetime
+from tqdm import tqdm
+from CorpusForge.SpaCy_Pipeline_Class import model_profiles
+from CorpusForge.Benchmark_Suite_Class import benchmarkSuite
+
+
+class profileComparison:
+
+    def __init__(self, pipeline, profiles=['trf', 'lg', 'md', 'sm'], reference="trf", sample_size=5, results_file="profile_comparison.json"):
+        self.pipeline = pipeline
+        self.profiles = [profile for profile in profiles if profile in model_profiles]
+        self.reference = reference
+        self.sample_size = sample_size
+        self.results_file = results_file
+        self.results = None
+
+    def installed(self, profile):
+        from spacy.util import is_package
+        return is_package(model_profiles[profile])
+
+    def sample(self):
+        # The same evenly spaced sample as the benchmark suite, read and prepared once for every profile
+        pipeline = self.pipeline
+        texts = []
+        for input_file in benchmarkSuite(pipeline, sample_size=self.sample_size).sampled_corpus():
+            content, is_xml, extra_metadata = pipeline.read_input(input_file)
+            _, text_content, _ = pipeline.prepare_xml(input_file, content, is_xml, 0, extra_metadata)
+            texts.append((input_file, text_content))
+        return texts
+
+    def annotate(self, profile, texts):
+        # Returns the seconds spent in the model and {file: {(idx, word): attributes}, sentence starts}
+        pipeline = self.pipeline
+        nlp = pipeline.build_nlp(profile)
+        nlp("Warm up sentence for the profile comparison.")
+        seconds = 0.0
+        n_tokens = 0
+        annotations = {}
+        for input_file, text in tqdm(texts, desc=profile):
+            # Texts longer than chunk_size are annotated in the pipeline's chunks, as a production run would, nlp.max_length is chunk_size
+            chunks = list(pipeline.split_chunks(text)) if pipeline.chunk_size is not None else [(0, text)]
+            start = time.perf_counter()
+            docs = [nlp(chunk) for _, chunk in chunks]
+            seconds += time.perf_counter() - start
+            tokens = {}
+            sentence_starts = set()
+            for (chunk_offset, _), doc in zip(chunks, docs):
+                n_tokens += len(doc)
+                for sentence in pipeline.doc_sentences(doc, chunk_offset):
+                    sentence_starts.add(sentence[0][1])
+                    for word, offset, attributes in sentence:
+                        tokens[(offset, word)] = attributes
+            annotations[input_file] = (tokens, sentence_starts)
+        return {'model': model_profiles[profile], 'components': nlp.pipe_names, 'tokens': n_tokens, 'seconds': seconds,
+                'tokens_per_second': n_tokens / seconds if seconds > 0 else None}, annotations
+
+    def agreement(self, annotations, reference):
+        matches = {}
+        shared = 0
+        true_starts = 0
+        found_starts = 0
+        reference_starts = 0
+        for input_file, (tokens, sentence_starts) in annotations.items():
+            reference_tokens, reference_sentence_starts = reference[input_file]
+            for key in tokens.keys() & reference_tokens.keys():
+                shared += 1
+                for name, value in tokens[key].items():
+                    matches[name] = matches.get(name, 0) + (value == reference_tokens[key].get(name))
+            true_starts += len(sentence_starts & reference_sentence_starts)
+            found_starts += len(sentence_starts)
+            reference_starts += len(reference_sentence_starts)
+        precision = true_starts / found_starts if found_starts > 0 else 0.0
+        recall = true_starts / reference_starts if reference_starts > 0 else 0.0
+        return {'shared_tokens': shared, 'attributes': {name: count / shared for name, count in matches.items()} if shared > 0 else {},
+                'sentence_f1': 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0}
+
+    def run(self):
+        if self.pipeline.init_status == False:
+            print("### Initialisation Failed - See Warnings for Details ###")
+            return None
+        profiles = [profile for profile in self.profiles if self.installed(profile)]
+        missing = [profile for profile in self.profiles if profile not in profiles]
+        if len(profiles) == 0:
+            print(f"### No Model Profiles Installed, Install One of: {', '.join(model_profiles[profile] for profile in self.profiles)} ###")
+            return None
+        reference = self.reference if self.reference in profiles else profiles[0]
+
+        texts = self.sample()
+        self.results = {'created': datetime.now().isoformat(timespec='seconds'), 'reference': reference,
+                        'attributes': self.pipeline.selected_attributes, 'sample': [input_file for input_file, _ in texts],
+                        'not_installed': missing, 'profiles': {}}
+        annotations = {}
+        for profile in [reference] + [profile for profile in profiles if profile != reference]:
+            self.results['profiles'][profile], annotations[profile] = self.annotate(profile, texts)
+        for profile in profiles:
+            self.results['profiles'][profile]['agreement'] = self.agreement(annotations[profile], annotations[reference])
+
+        with open(self.results_file, "w") as results_write:
+            json.dump(self.results, results_write, indent=2)
+        print(f"### Profile Comparison Written to '{self.results_file}' ###")
+        self.print_summary()
+        return self.results
+
+    def print_summary(self):
+        print(f"### Agreement with '{self.results['reference']}' on {len(self.results['sample'])} sampled file(s) ###")
+        for profile, result in self.results['profiles'].items():
+            agreement = result['agreement']
+            attributes = ", ".join(f"{name} {value:.3f}" for name, value in agreement['attributes'].items())
+            print(f"{profile:<4} {result['model']:<16} {result['tokens_per_second'] or 0:>10.0f} tokens/s  sentences F1 {agreement['sentence_f1']:.3f}  {attributes}")
+        if len(self.results['not_installed']) > 0:
+            print(f"Not installed: {', '.join(self.results['not_installed'])}")
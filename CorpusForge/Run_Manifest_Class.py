@@ -0,0 +1,164 @@
+# CASS Run Manifest #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+
+import os
+import json
+import hashlib
+from datetime import datetime
+
+
+class runManifest:
+
+    manifest_name = ".corpusforge_manifest.jsonl"
+
+    def __init__(self, output_dir, config, verify_outputs="checksum"):
+        self.manifest_file = os.path.join(output_dir, self.manifest_name)
+        self.config = config
+        self.config_hash = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("UTF-8")).hexdigest()
+        self.verify_outputs = verify_outputs
+        # Records are buffered instead of appended when the manifest belongs to a worker process
+        self.buffered = False
+        self.pending = []
+        self.input_hashes = {}
+        self.records = {}
+        self.load()
+
+    def update_config(self, **config):
+        # Settings outside the pipeline that still change its outputs, such as the stages of a stagePipeline
+        self.config = {**self.config, **config}
+        self.config_hash = hashlib.sha256(json.dumps(self.config, sort_keys=True, default=str).encode("UTF-8")).hexdigest()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pending'] = []
+        return state
+
+    def load(self):
+        if not os.path.exists(self.manifest_file):
+            return
+        n_lines = 0
+        with open(self.manifest_file) as manifest_read:
+            for line in manifest_read:
+                n_lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A killed run can leave a partial last line
+                    continue
+                self.records[record['input']] = record
+        # Later records supersede earlier ones, the file is compacted once it is mostly superseded lines
+        if n_lines > 2 * len(self.records) + 1000:
+            tmp_file = self.manifest_file + ".tmp"
+            with open(tmp_file, "w") as manifest_write:
+                for record in self.records.values():
+                    manifest_write.write(json.dumps(record) + "\n")
+            os.replace(tmp_file, self.manifest_file)
+
+    def input_hash(self, input_file, record=None):
+        # Unchanged size and modification time reuse the recorded hash rather than reading the file again
+        stat = os.stat(input_file)
+        if record is not None and record['input_size'] == stat.st_size and record['input_mtime_ns'] == stat.st_mtime_ns:
+            return record['input_hash'], stat
+        return file_hash(input_file), stat
+
+    def output_valid(self, output_file, expected):
+        if not os.path.exists(output_file):
+            return False
+        if os.path.getsize(output_file) != expected['size']:
+            return False
+        if self.verify_outputs == "checksum":
+            return file_hash(output_file) == expected['hash']
+        return True
+
+    def needs_processing(self, input_file, output_files):
+        # Returns the reason a file has to be (re)processed, None when its recorded outputs are still valid
+        record = self.records.get(input_file)
+        if record is not None and 'error' in record:
+            # A failure supersedes an earlier completion, the file may have been left with partial outputs
+            self.input_hashes[input_file] = self.input_hash(input_file)
+            return "failed"
+        input_hash, stat = self.input_hash(input_file, record)
+        self.input_hashes[input_file] = (input_hash, stat)
+        if record is None:
+            return "missing"
+        if record['input_hash'] != input_hash:
+            return "changed"
+        if record['config_hash'] != self.config_hash:
+            return "config"
+        if sorted(record['outputs']) != sorted(output_files):
+            return "missing"
+        for output_file in output_files:
+            if not self.output_valid(output_file, record['outputs'][output_file]):
+                return "corrupt"
+        return None
+
+    def add(self, input_file, output_files, digests={}):
+        # digests are the {'hash', 'size'} of outputs measured by their writers, other outputs are read back and hashed
+        if input_file in self.input_hashes:
+            input_hash, stat = self.input_hashes.pop(input_file)
+        else:
+            # Not hashed by a resume check, the input is known by its size and modification time and counts as changed once they differ
+            input_hash, stat = None, os.stat(input_file)
+        outputs = {}
+        for output_file in output_files:
+            if output_file in digests:
+                outputs[output_file] = digests[output_file]
+            else:
+                outputs[output_file] = {'hash': file_hash(output_file), 'size': os.path.getsize(output_file)}
+        record = {'input': input_file, 'input_hash': input_hash, 'input_size': stat.st_size, 'input_mtime_ns': stat.st_mtime_ns,
+                  'config_hash': self.config_hash, 'config': self.config, 'completed': datetime.now().isoformat(timespec='seconds'),
+                  'outputs': outputs}
+        if self.buffered:
+            self.pending.append(record)
+        else:
+            self.append([record])
+
+    def fail(self, input_file, error):
+        # Recorded by the parent for files whose worker died, so resume processes them again
+        record = {'input': input_file, 'error': error, 'config_hash': self.config_hash, 'failed': datetime.now().isoformat(timespec='seconds')}
+        if self.buffered:
+            self.pending.append(record)
+        else:
+            self.append([record])
+
+    def append(self, records):
+        with open(self.manifest_file, "a") as manifest_write:
+            for record in records:
+                manifest_write.write(json.dumps(record, default=str) + "\n")
+                self.records[record['input']] = record
+
+    def take_pending(self):
+        pending = self.pending
+        self.pending = []
+        return pending
+
+
+class hashingWriter:
+
+    # Wraps a binary file, hashing the bytes as they are written gives the digest of the finished file without reading it back
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def record(self):
+        return {'hash': self.digest.hexdigest(), 'size': self.size}
+
+
+def file_hash(file):
+    digest = hashlib.sha256()
+    with open(file, "rb") as file_read:
+        for block in iter(lambda: file_read.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
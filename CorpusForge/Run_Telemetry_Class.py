@@ -0,0 +1,311 @@
+# CASS Run Telemetry #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# JSON lines metrics of a run, one {"type": "file"} record per document and a {"type": "summary"} record every interval seconds.
+# File records hold the seconds spent in each stage:
+#   read - reading the input (or waiting on the read pool), parse - building the XML skeleton,
+#   annotate - producing sentences, net of the SpaCy components (nlp) and the PyMUSAS tagger (pymusas) where they are measured within it,
+#   serialize - formatting the outputs, write - compressing and writing them to disk.
+# The stages do not overlap, their sum is the time spent on the document.
+# Sampled documents add a {"type": "profile"} record.
+# Summaries are written by a timer thread, so they keep coming while a long document is annotated. They hold throughput, queue depths and an ETA from the input bytes left, weighted by the words per byte seen so far.
+# The corpus size is summed in the background as files are found, total_bytes_partial marks summaries written before it was complete.
+
+
+import os
+import json
+import time
+import zlib
+import threading
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+PYMUSAS_COMPONENT = "pymusas_rule_based_tagger"
+
+
+class runTelemetry:
+
+    def __init__(self, metrics_file, interval=30, profile_fraction=0.0, profile_mode="cprofile", profile_dir=None):
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.profile_fraction = profile_fraction
+        self.profile_mode = profile_mode
+        self.profile_dir = profile_dir if profile_dir is not None else os.path.splitext(metrics_file)[0] + "_profiles"
+        # Worker processes hand their records to the parent, which is the only process writing the metrics file
+        self.buffered = False
+        self.pending = []
+        self.documents = {}
+        self.queues = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.metrics = None
+        self.count_thread = None
+        self.summary_thread = None
+        self.stop_summaries = threading.Event()
+        self.reset_totals()
+
+    def reset_totals(self):
+        self.started = time.time()
+        self.total_bytes = None
+        self.counting_bytes = False
+        self.n_files = 0
+        self.done_bytes = 0
+        self.skipped_bytes = 0
+        self.done_tokens = 0
+        self.stage_totals = {}
+        self.peak_rss = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['local', 'lock', 'metrics', 'count_thread', 'summary_thread', 'stop_summaries']:
+            state[name] = None
+        state['pending'] = []
+        state['documents'] = {}
+        state['queues'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stop_summaries = threading.Event()
+
+    def start_summaries(self):
+        # Started once by the process writing the metrics file, close stops it
+        if self.buffered or self.summary_thread is not None:
+            return
+        self.stop_summaries.clear()
+
+        def summarise():
+            while not self.stop_summaries.wait(self.interval):
+                self.write_summary()
+        self.summary_thread = threading.Thread(target=summarise, daemon=True)
+        self.summary_thread.start()
+
+    def count_bytes(self, files):
+        # Sums the sizes of files in a background thread, the ETA covers what has been found so far until the scan completes
+        self.total_bytes = 0
+        self.counting_bytes = True
+
+        def count():
+            try:
+                for file in files:
+                    try:
+                        file_bytes = os.path.getsize(file)
+                    except OSError:
+                        continue
+                    with self.lock:
+                        self.total_bytes += file_bytes
+            finally:
+                self.counting_bytes = False
+        self.count_thread = threading.Thread(target=count, daemon=True)
+        self.count_thread.start()
+
+    # Per document
+
+    def start(self, key, input_file=None):
+        file_bytes = os.path.getsize(input_file) if input_file is not None and os.path.exists(input_file) else 0
+        with self.lock:
+            self.documents[key] = {'file': input_file if input_file is not None else key, 'started': time.time(), 'bytes': file_bytes, 'stages': {}, 'components': {}, 'nested': 0.0}
+
+    def document(self, key):
+        document = self.documents.get(key)
+        if document is None:
+            self.start(key)
+            document = self.documents[key]
+        return document
+
+    def add(self, key, stage, seconds):
+        stages = self.document(key)['stages']
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def skip(self, input_file):
+        # Skipped files still count as done for the ETA
+        self.emit({'type': "skip", 'bytes': os.path.getsize(input_file)})
+
+    def component(self, name, seconds):
+        # Component timings are collected by the thread running the models and attached to the document it annotates
+        components = getattr(self.local, "components", None)
+        if components is None:
+            components = {}
+            self.local.components = components
+        components[name] = components.get(name, 0.0) + seconds
+
+    def take_components(self, key):
+        components = getattr(self.local, "components", None)
+        if not components:
+            return
+        self.local.components = {}
+        document = self.document(key)
+        for name, seconds in components.items():
+            document['components'][name] = document['components'].get(name, 0.0) + seconds
+        stages = document['stages']
+        stages['pymusas'] = stages.get('pymusas', 0.0) + components.get(PYMUSAS_COMPONENT, 0.0)
+        stages['nlp'] = stages.get('nlp', 0.0) + sum(seconds for name, seconds in components.items() if name != PYMUSAS_COMPONENT)
+        # Components are only timed while annotate is, their time is taken out of it when the document finishes
+        document['nested'] += sum(components.values())
+
+    def finish(self, key, n_tokens, n_sentences):
+        with self.lock:
+            document = self.documents.pop(key, None)
+        if document is None:
+            return
+        seconds = time.time() - document['started']
+        if 'annotate' in document['stages']:
+            document['stages']['annotate'] = max(document['stages']['annotate'] - document['nested'], 0.0)
+        record = {'type': "file", 'time': datetime.now().isoformat(timespec='seconds'), 'pid': os.getpid(), 'file': document['file'],
+                  'bytes': document['bytes'], 'tokens': n_tokens, 'sentences': n_sentences, 'seconds': round(seconds, 4),
+                  'tokens_per_second': round(n_tokens / seconds, 1) if seconds > 0 else None,
+                  'stages': {stage: round(value, 4) for stage, value in document['stages'].items()},
+                  'components': {name: round(value, 4) for name, value in document['components'].items()},
+                  'peak_rss_mb': peak_rss_mb()}
+        self.emit(record)
+
+    def emit(self, record):
+        if self.buffered:
+            self.pending.append(record)
+        else:
+            self.append([record])
+
+    def take_pending(self):
+        records, self.pending = self.pending, []
+        return records
+
+    # Metrics file
+
+    def watch(self, name, depth):
+        # depth is a callable giving the current depth of a queue, included in every summary
+        self.queues[name] = depth
+
+    def unwatch(self, name):
+        self.queues.pop(name, None)
+
+    def append(self, records):
+        with self.lock:
+            for record in records:
+                if record['type'] == "skip":
+                    self.skipped_bytes += record['bytes']
+                elif record['type'] == "file":
+                    self.n_files += 1
+                    self.done_bytes += record['bytes']
+                    self.done_tokens += record['tokens']
+                    for stage, seconds in record['stages'].items():
+                        self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + seconds
+                    self.peak_rss[record['pid']] = max(self.peak_rss.get(record['pid'], 0.0), record['peak_rss_mb'] or 0.0)
+            self.write(records)
+
+    def write(self, records):
+        if self.metrics is None:
+            self.metrics = open(self.metrics_file, "a")
+        for record in records:
+            if record['type'] != "skip":
+                self.metrics.write(json.dumps(record) + "\n")
+        self.metrics.flush()
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        tokens_per_second = self.done_tokens / elapsed if elapsed > 0 else 0.0
+        summary = {'type': "summary", 'time': datetime.now().isoformat(timespec='seconds'), 'elapsed': round(elapsed, 1), 'files': self.n_files,
+                   'tokens': self.done_tokens, 'tokens_per_second': round(tokens_per_second, 1),
+                   'stages': {stage: round(seconds, 2) for stage, seconds in self.stage_totals.items()},
+                   'peak_rss_mb': {str(pid): rss for pid, rss in self.peak_rss.items()},
+                   'queues': {name: depth() for name, depth in list(self.queues.items())}}
+        if self.total_bytes is not None and self.done_bytes > 0 and tokens_per_second > 0:
+            # Files vary widely in length, the work left is estimated in words from the bytes left rather than counted in files
+            remaining_bytes = max(self.total_bytes - self.done_bytes - self.skipped_bytes, 0)
+            remaining_words = remaining_bytes * self.done_tokens / self.done_bytes
+            summary['remaining_words'] = int(remaining_words)
+            summary['eta_seconds'] = round(remaining_words / tokens_per_second, 1)
+            if self.counting_bytes:
+                summary['total_bytes_partial'] = True
+        return summary
+
+    def write_summary(self):
+        with self.lock:
+            summary = self.summary()
+            self.write([summary])
+        return summary
+
+    def close(self):
+        if self.summary_thread is not None:
+            self.stop_summaries.set()
+            self.summary_thread.join()
+            self.summary_thread = None
+        if self.n_files > 0:
+            self.write_summary()
+        with self.lock:
+            if self.metrics is not None:
+                self.metrics.close()
+                self.metrics = None
+
+    # Profiling
+
+    def sampled(self, key):
+        # A stable fraction of documents, the same ones are sampled again when a run is repeated
+        return self.profile_fraction > 0 and zlib.crc32(key.encode("UTF-8")) % 10000 < self.profile_fraction * 10000
+
+    def profile(self, key):
+        return profileSample(self, key) if self.sampled(key) else nullSample()
+
+
+class profileSample:
+
+    # cProfile writes <profile_dir>/<document>.prof for pstats or snakeviz, tracemalloc adds the largest allocations to the file record
+    def __init__(self, telemetry, key):
+        self.telemetry = telemetry
+        self.key = key
+
+    def __enter__(self):
+        if self.telemetry.profile_mode == "tracemalloc":
+            import tracemalloc
+            self.tracing = tracemalloc.is_tracing()
+            if not self.tracing:
+                tracemalloc.start()
+        else:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *args):
+        record = {'type': "profile", 'time': datetime.now().isoformat(timespec='seconds'), 'pid': os.getpid(), 'file': self.key, 'mode': self.telemetry.profile_mode}
+        if self.telemetry.profile_mode == "tracemalloc":
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not self.tracing:
+                tracemalloc.stop()
+            record['peak_mb'] = round(peak / 1048576, 2)
+            record['top'] = [str(statistic) for statistic in snapshot.statistics('lineno')[:10]]
+        else:
+            self.profiler.disable()
+            os.makedirs(self.telemetry.profile_dir, exist_ok=True)
+            profile_file = os.path.join(self.telemetry.profile_dir, self.key.replace(os.sep, "_") + ".prof")
+            self.profiler.dump_stats(profile_file)
+            record['profile_file'] = profile_file
+        self.telemetry.emit(record)
+        return False
+
+
+class nullSample:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1048576 if os.uname().sysname == "Darwin" else 1024), 1)
@@ -0,0 +1,241 @@
+# CASS Sharded Output #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# Documents are appended to size limited shard files instead of one file each. Every record is
+#   4 byte magic, uint16 key length, key, uint8 kind length, kind, uint8 compressed flag, uint8 padding length, padding, uint64 payload length, payload
+# with payloads aligned to 8 bytes for memory mapped columns, so shards can be read without the index. The SQLite index maps (doc_id, kind) to shard, payload offset and length.
+# Shared runs (nodes of a work queue writing one output_dir) index into a part file per host and process with a rollback journal,
+# the parts are merged into the shard index once the queue is finished, so no two hosts write one SQLite file.
+
+
+import os
+import glob
+import zlib
+import socket
+import struct
+import sqlite3
+
+
+RECORD_MAGIC = b"CFSR"
+INDEX_NAME = "shard_index.sqlite"
+
+
+class shardWriter:
+
+    def __init__(self, output_dir, shard_mb=1024, shared=False):
+        self.output_dir = output_dir
+        self.max_bytes = shard_mb * 1048576
+        self.shared_index = os.path.join(output_dir, INDEX_NAME)
+        self.shared = shared
+        # Worker processes of a shared run index into their parent's part file
+        self.index_file = f"{self.shared_index}.{socket.gethostname()}.{os.getpid()}.part" if shared else self.shared_index
+        self.connection = None
+        self.shared_connection = None
+        self.file = None
+        self.shard = None
+        self.shard_count = 0
+        self.record_start = None
+        self.payload_start = None
+
+    def __getstate__(self):
+        # Each worker process appends to shards of its own
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['shared_connection'] = None
+        state['file'] = None
+        state['shard'] = None
+        return state
+
+    def connect(self):
+        if self.connection is None:
+            # Pipelined runs check the index from the prefetch thread and write it from the writer threads
+            self.connection = sqlite3.connect(self.index_file, timeout=60, check_same_thread=False)
+            self.connection.execute(f"PRAGMA journal_mode={'DELETE' if self.shared else 'WAL'}")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS shard_index (doc_id TEXT, kind TEXT, shard TEXT, offset INTEGER, length INTEGER, compressed INTEGER, PRIMARY KEY (doc_id, kind))")
+            self.connection.commit()
+        return self.connection
+
+    def indexes(self):
+        # Shared runs also look up the merged shard index, read only as other hosts may be merging into it
+        indexes = [self.connect()]
+        if self.shared and self.shared_connection is None and os.path.exists(self.shared_index):
+            self.shared_connection = sqlite3.connect(f"file:{self.shared_index}?mode=ro", uri=True, timeout=60, check_same_thread=False)
+        if self.shared_connection is not None:
+            indexes.append(self.shared_connection)
+        return indexes
+
+    def query(self, sql, parameters):
+        rows = []
+        for connection in self.indexes():
+            try:
+                rows.extend(connection.execute(sql, parameters).fetchall())
+            except sqlite3.OperationalError:
+                # The merged index has no table until the first merge
+                if connection is self.connection:
+                    raise
+        return rows
+
+    def contains(self, doc_id, kinds):
+        placeholders = ", ".join("?" for _ in kinds)
+        found = {kind for kind, in self.query(f"SELECT kind FROM shard_index WHERE doc_id = ? AND kind IN ({placeholders})", (doc_id, *kinds))}
+        return len(found) == len(kinds)
+
+    def open_shard(self):
+        # Shards are named by host and process so concurrent workers never share one, a reused name is truncated back to its last indexed record
+        while True:
+            self.shard = f"shard-{socket.gethostname()}-{os.getpid()}-{self.shard_count:05d}.cfs"
+            self.shard_count += 1
+            path = os.path.join(self.output_dir, self.shard)
+            if not os.path.exists(path) or os.path.getsize(path) < self.max_bytes:
+                break
+        path = os.path.join(self.output_dir, self.shard)
+        end = max((end for end, in self.query("SELECT MAX(offset + length) FROM shard_index WHERE shard = ?", (self.shard,)) if end is not None), default=None)
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.file.truncate(end or 0)
+        self.file.seek(0, os.SEEK_END)
+
+    def begin(self, doc_id, kind, compressed=False):
+        # Returns the binary stream the document is written to
+        if self.file is None or self.file.tell() >= self.max_bytes:
+            self.close_shard()
+            self.open_shard()
+        key = doc_id.encode("UTF-8")
+        kind_bytes = kind.encode("UTF-8")
+        self.record_start = self.file.tell()
+        header = RECORD_MAGIC + struct.pack("<H", len(key)) + key + struct.pack("<B", len(kind_bytes)) + kind_bytes + struct.pack("<B", 1 if compressed else 0)
+        padding = (-(self.record_start + len(header) + 9)) % 8
+        self.file.write(header + struct.pack("<B", padding) + b"\0" * padding)
+        self.length_position = self.file.tell()
+        self.file.write(struct.pack("<Q", 0))
+        self.payload_start = self.file.tell()
+        return self.file
+
+    def commit(self, doc_id, kind, compressed=False):
+        end = self.file.tell()
+        length = end - self.payload_start
+        self.file.seek(self.length_position)
+        self.file.write(struct.pack("<Q", length))
+        self.file.seek(end)
+        # Flushed before indexing, worker processes exit without flushing their buffers
+        self.file.flush()
+        connection = self.connect()
+        connection.execute("INSERT OR REPLACE INTO shard_index VALUES (?, ?, ?, ?, ?, ?)", (doc_id, kind, self.shard, self.payload_start, length, 1 if compressed else 0))
+        connection.commit()
+        self.record_start = None
+
+    def abort(self):
+        # A failed document leaves nothing behind in the shard
+        if self.file is not None and self.record_start is not None:
+            self.file.truncate(self.record_start)
+            self.file.seek(self.record_start)
+            self.record_start = None
+
+    def close_shard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.close_shard()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.shared_connection is not None:
+            self.shared_connection.close()
+            self.shared_connection = None
+
+    def merge_parts(self):
+        # Folds every host's part index into the shard index, run by one worker once the work queue is finished
+        self.close()
+        parts = sorted(glob.glob(glob.escape(f"{self.shared_index}.") + "*.part"))
+        connection = sqlite3.connect(self.shared_index, timeout=60)
+        try:
+            connection.execute("PRAGMA journal_mode=DELETE")
+            connection.execute("CREATE TABLE IF NOT EXISTS shard_index (doc_id TEXT, kind TEXT, shard TEXT, offset INTEGER, length INTEGER, compressed INTEGER, PRIMARY KEY (doc_id, kind))")
+            connection.commit()
+            for part in parts:
+                connection.execute("ATTACH DATABASE ? AS part", (part,))
+                try:
+                    with connection:
+                        connection.execute("INSERT OR REPLACE INTO shard_index SELECT * FROM part.shard_index")
+                finally:
+                    connection.execute("DETACH DATABASE part")
+                for file in [part, part + "-journal"]:
+                    if os.path.exists(file):
+                        os.remove(file)
+        finally:
+            connection.close()
+        return len(parts)
+
+
+class shardReader:
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.connection = sqlite3.connect(os.path.join(output_dir, INDEX_NAME))
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(DISTINCT doc_id) FROM shard_index").fetchone()[0]
+
+    def __contains__(self, doc_id):
+        return self.connection.execute("SELECT 1 FROM shard_index WHERE doc_id = ? LIMIT 1", (doc_id,)).fetchone() is not None
+
+    def ids(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT doc_id FROM shard_index ORDER BY doc_id")]
+
+    def locate(self, doc_id, kind):
+        row = self.connection.execute("SELECT shard, offset, length, compressed FROM shard_index WHERE doc_id = ? AND kind = ?", (doc_id, kind)).fetchone()
+        if row is None:
+            raise KeyError(f"Document '{doc_id}' ({kind}) not in '{self.output_dir}'")
+        return row
+
+    def read(self, doc_id, kind="xml"):
+        # One index lookup and one seek per document
+        shard, offset, length, compressed = self.locate(doc_id, kind)
+        file = self.files.get(shard)
+        if file is None:
+            file = open(os.path.join(self.output_dir, shard), "rb")
+            self.files[shard] = file
+        file.seek(offset)
+        payload = file.read(length)
+        return zlib.decompress(payload) if compressed else payload
+
+    def get(self, doc_id):
+        return self.read(doc_id, "xml").decode("UTF-8")
+
+    def columnar(self, doc_id):
+        # Columns are memory mapped straight out of the shard
+        from CorpusForge.Columnar_Output_Class import columnarReader
+        shard, offset, _, _ = self.locate(doc_id, "cfc")
+        return columnarReader(os.path.join(self.output_dir, shard), offset=offset)
+
+    def records(self, shard):
+        # Walks a shard from its record headers alone, (doc_id, kind, compressed, offset, length)
+        with open(os.path.join(self.output_dir, shard), "rb") as file:
+            while True:
+                magic = file.read(4)
+                if len(magic) < 4 or magic != RECORD_MAGIC:
+                    return
+                key = file.read(struct.unpack("<H", file.read(2))[0]).decode("UTF-8")
+                kind = file.read(struct.unpack("<B", file.read(1))[0]).decode("UTF-8")
+                compressed = bool(struct.unpack("<B", file.read(1))[0])
+                file.seek(struct.unpack("<B", file.read(1))[0], os.SEEK_CUR)
+                length = struct.unpack("<Q", file.read(8))[0]
+                offset = file.tell()
+                yield key, kind, compressed, offset, length
+                file.seek(offset + length)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+        self.connection.close()
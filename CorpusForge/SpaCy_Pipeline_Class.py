@@ -5,22 +5,43 @@
 
 
 import os
-import sys
-import zlib
+import copy
 import time
-import spacy
-import humanize
-import numpy as np
-import pandas as pd
-import pickle as pkl
+import warnings as py_warnings
+import traceback
 from tqdm import tqdm
 from datetime import timedelta
-from bs4 import BeautifulSoup as bs4
-from sklearn.linear_model import LinearRegression
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 import xml.etree.ElementTree as ET
-from ebooklib import epub
+import re
 import html
+from itertools import islice
+from collections import deque
+from CorpusForge.Stream_XML_Writer_Class import streamXMLWriter
+from CorpusForge.Metadata_Index_Class import metadataIndex
+from CorpusForge.Columnar_Output_Class import columnarWriter, columnar_path
+from CorpusForge.Run_Manifest_Class import runManifest, file_hash
+from CorpusForge.Annotation_Cache_Class import annotationCache
+from CorpusForge.Warning_Summary_Class import warningSummary
+from CorpusForge.Shard_Output_Class import shardWriter
+from CorpusForge.Token_Index_Class import tokenIndex, part_file, part_files, shared_part_files
+from CorpusForge.Run_Telemetry_Class import runTelemetry, nullSample
+from CorpusForge.Work_Queue_Class import workQueue
+from CorpusForge.Text_Normalizer_Class import textNormalizer
+
+
+sentence_end_regex = re.compile(r'[.!?]["\'\u2019\u201D)\]]*\s+')
+spacy_attributes = ['lemma', 'pos', 'tag', 'dep', 'shape', 'is_alpha', 'is_stop', 'pymusas']
+# Speed/quality tiers, each a SpaCy English pipeline with the same components
+# Automatic file type selection counts the types of this many files from the start of the scan, annotation never waits on the whole tree
+FILE_TYPE_SAMPLE = 1000
+model_profiles = {'trf': 'en_core_web_trf', 'lg': 'en_core_web_lg', 'md': 'en_core_web_md', 'sm': 'en_core_web_sm'}
+model_components = ['transformer', 'tok2vec', 'tagger', 'parser', 'senter', 'attribute_ruler', 'lemmatizer', 'ner']
+# Components each attribute needs, the rule based lemmatizer and PyMUSAS both work from the POS the attribute ruler maps from the tags.
+# shape, is_alpha and is_stop are lexical and need none
+attribute_components = {'lemma': ['tagger', 'attribute_ruler', 'lemmatizer'], 'pos': ['tagger', 'attribute_ruler'], 'tag': ['tagger'],
+                        'dep': ['parser'], 'pymusas': ['tagger', 'attribute_ruler', 'lemmatizer']}
 
 
 class spacyPipeline:
@@ -30,10 +51,18 @@ class spacyPipeline:
                  warnings=True, metadata=True, metadata_file="metadata/metadata.csv", metadata_id_column="ID", data_dir="data", 
                  all_files=[], single_file_type=True, multi_filetypes=[], output_dir="output", create_output_folder=False,
                  use_nonempty_output_folder = False, flat_output_dir=False, xml_text_node="text", xml_metadata_node="text",
-                 spacy_features=True, errors="strict", start_benchmark=False, benchmark_sample=20, compress=False, skip_processed_files=False, **kwargs):
+                 spacy_features=True, errors="strict", start_benchmark=False, benchmark_sample=20, compress=False, skip_processed_files=False,
+                 metadata_backend="memory", metadata_db=None, output_format="xml", batch_annotation=False, batch_size=1000, batch_tokens=50000, batch_memory_mb=256,
+                 chunk_size=None, chunk_processes=1, resume=False, manifest=True, verify_outputs="checksum",
+                 annotation_cache=None, annotation_cache_mb=10240, read_processes=1, warnings_report=None, shard_output=False, shard_mb=1024,
+                 pipelined=False, prefetch_size=4, writer_threads=2, write_queue_size=4, write_queue_tokens=50000, token_index=None,
+                 telemetry=None, telemetry_interval=30, profile_fraction=0.0, profile_mode="cprofile", profile_dir=None,
+                 model_profile="trf", prune_components=True, work_queue=None, lease_seconds=300, claim_size=1, max_attempts=3,
+                 deduplicate=False, duplicate_threshold=0.8, duplicate_links=False, normalize=None, **kwargs):
         
         self.corpus_name = corpus_title
         self.compress = compress
+        self.output_format = output_format
         self.skip_processed_files = skip_processed_files
         self.static_ID = 0
         self.errors = errors
@@ -51,34 +80,69 @@ class spacyPipeline:
         self.worker_nodes = worker_nodes
         self.metadata = metadata
         self.attributes = attributes
+        # Output attributes in annotation order, resolved once so per-token work is only building the output
+        self.selected_attributes = [attribute for attribute in spacy_attributes if attribute in attributes]
+        self.batch_annotation = batch_annotation
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.batch_max_chars = 0
+        self.chunk_size = chunk_size
+        self.chunk_processes = chunk_processes
+        self.model_profile = model_profile
+        self.prune_components = prune_components
+        self.resume = resume
+        self.manifest = None
+        self.annotation_cache = None
+        self.read_processes = read_processes
+        self.shard_output = shard_output
+        self.shard_writer = None
+        self.pipelined = pipelined
+        self.prefetch_size = prefetch_size
+        self.writer_threads = writer_threads
+        self.write_queue_size = write_queue_size
+        self.write_queue_tokens = write_queue_tokens
+        self.pipelined_executor = None
+        self.token_index = None
+        self.token_index_file = None
+        self.telemetry = None
+        self.work_queue = None
+        self.deduplicate = deduplicate
+        self.duplicate_threshold = duplicate_threshold
+        self.duplicate_links = duplicate_links
+        self.duplicate_clusters = {}
+        self.duplicate_of = {}
+        self.normalizer = None
         self.warnings = []
-
-        # Initialise SpaCy + Pymusas
-
-        if spacy_features:
-            self.nlp = spacy.load('en_core_web_trf')
-            self.nlp.max_length = 100000000
-            english_tagger_pipeline = spacy.load('en_dual_none_contextual')
-            self.nlp.add_pipe('pymusas_rule_based_tagger', source=english_tagger_pipeline)
+        # Per-file warnings are aggregated into counts with examples, optionally with a full report file
+        self.file_warnings = warningSummary(report_file=warnings_report)
+        self.nlp = None
 
         # Parameter Integrity Checks
 
-        # Files
+        if model_profile not in model_profiles:
+            self.warnings.append(f"Unknown model_profile '{model_profile}', default to 'trf', available profiles: {', '.join(model_profiles)}")
+            self.model_profile = "trf"
 
-        self.valid_files = []
+        # Files
+        # Nothing is listed up front, files are streamed from data_dir by iter_proc_files as they are found
+        self.data_dir = data_dir
+        self.all_files = []
+        self.single_file_type = single_file_type
+        self.multi_filetypes = multi_filetypes
+        self.file_type = None
+        self.file_types = []
+        self.discovered = False
+        self._proc_files = None
         if isinstance(all_files, list) and len(all_files) > 0:
             for file in all_files:
                 if os.path.exists(file):
-                    self.valid_files.append(file)
+                    self.all_files.append(file)
                 else:
                     self.warnings.append(f"File does not exist: {file}")
         elif not isinstance(data_dir, str):
             self.warnings.append(f"Directory provided is invalid datatype: {type(data_dir)}")
         elif os.path.exists(data_dir):
-            for dirs, paths, files in os.walk(data_dir):
-                for file in files:
-                    self.valid_files.append(os.path.join(dirs, file))
-            if len(self.valid_files) == 0:
+            if next(scan_files(data_dir), None) is None:
                 self.warnings.append("No files available to process")
                 self.init_status = False
         else:
@@ -86,77 +150,34 @@ class spacyPipeline:
             self.init_status = False
 
         # File type
-        
-        self.proc_files = []
-        self.file_types = {}
-        if len(self.valid_files) > 0 and single_file_type:
-            for file in self.valid_files:
-                file_ending = self.get_filetype(file)
-                if file_ending not in self.file_types.keys():
-                    self.file_types[file_ending] = 1
-                else:
-                    self.file_types[file_ending] += 1
-            
-            self.file_types = sorted(self.file_types.items(), key=lambda x: x[1], reverse=True)
-            self.file_type = self.file_types[0][0].lower()
-            if file_type != "Auto":
-                if file_type.lower() in [file_type_tmp[0].lower() for file_type_tmp in self.file_types]:
-                    self.file_type = file_type
-                else:
+        # A given file type is checked with the first matching file, automatic selection counts the types of the first FILE_TYPE_SAMPLE files
+        if single_file_type and next(self.source_files(), None) is not None:
+            if file_type != "Auto" and any(self.get_filetype(file) == file_type.lower() for file in self.source_files()):
+                self.file_type = file_type.lower()
+            else:
+                file_types = {}
+                for file in islice(self.source_files(), FILE_TYPE_SAMPLE):
+                    file_ending = self.get_filetype(file)
+                    file_types[file_ending] = file_types.get(file_ending, 0) + 1
+                self.file_types = sorted(file_types.items(), key=lambda x: x[1], reverse=True)
+                self.file_type = self.file_types[0][0]
+                if file_type != "Auto":
                     self.warnings.append(f"File type {file_type} not found in '{data_dir}', defaulted to Automatic Filetype Selection: {self.file_type}")
-            for file in self.valid_files:
-                file_ending = self.get_filetype(file)
-                if file_ending == self.file_type:
-                    self.proc_files.append(file)
-                else:
-                    self.warnings.append(f"File '{file}' excluded due to bad file type")
-        
-        elif len(self.valid_files) > 0 and not single_file_type:
-            for file in self.valid_files:
-                file_ending = self.get_filetype(file)
-                if file_ending in multi_filetypes:
-                    self.proc_files.append(file)
-                else:
-                    self.warnings.append(f"File '{file}' excluded due to bad file type")
 
 
 
         ## Metadata
                     
         if self.metadata:
-            if os.path.exists(metadata_file):
-                file_type = self.get_filetype(metadata_file)
-                if file_type == ".csv":
-                    self.metadata_df = pd.read_csv(metadata_file)
-                elif file_type == '.xlsx':
-                    self.metadata_df = pd.read_excel(metadata_file)
-                elif file_type == ".tsv":
-                    self.metadata_df = pd.read_csv(metadata_file, sep='\t')
-                else:
-                    self.warnings.append(f"Metadata file is unknown file type '{file_type}'")
-                    self.init_status = False
-            else:
-                self.warnings.append(f"Metadata file '{metadata_file}' does not exist")
+            self.metadata_index = metadataIndex(metadata_file, metadata_id_column, backend=metadata_backend, db_file=metadata_db)
+            self.warnings.extend(self.metadata_index.warnings)
+            if not self.metadata_index.status:
                 self.init_status = False
-
-            if self.init_status:
-                self.metadata_attrs = self.metadata_df.columns
-                if metadata_id_column not in self.metadata_attrs:
-                    self.warnings.append(f"Metadata ID column '{metadata_id_column}' not in metadata")
-                    self.init_status = False
-                else:
-                    self.metadata_df[metadata_id_column] = self.metadata_df[metadata_id_column].apply(lambda x: x.strip().lower())
-                    for file in self.proc_files:
-                        file_w_ending = file.split(os.sep)[-1].lower()
-                        file_wo_ending = file.split(os.sep)[-1].lower().replace(self.get_filetype(file), "")
-                        if file_w_ending in self.metadata_df[metadata_id_column].values or file_wo_ending in self.metadata_df[metadata_id_column].values:
-                            pass
-                        else:
-                            self.warnings.append(f"File '{file}' cannot be located in metadata file")      
+            else:
+                self.metadata_attrs = self.metadata_index.columns
                 
         ## Attributes
-        full_attributes = ['lemma', 'pos', 'tag', 'dep', 'shape', 'is_alpha', 'is_stop', 'pymusas']
-        bad_attributes = [attr for attr in attributes if attr not in full_attributes]
+        bad_attributes = [attr for attr in attributes if attr not in spacy_attributes]
         if len(bad_attributes) != 0:
             self.warnings.append(f"Invalid attributes not used: {', '.join(bad_attributes)}")
 
@@ -171,16 +192,45 @@ class spacyPipeline:
             if worker_nodes < 1:
                 self.warnings.append(f"You have selected {worker_nodes} worker nodes. You need at least 1 worker node in order for a program to operate, a default of 1 has been selected.")
                 worker_nodes = 1
+            self.worker_nodes = worker_nodes
+
+
+        ## Output Format
+        if output_format not in ["xml", "columnar", "both"]:
+            self.warnings.append(f"Unknown output format '{output_format}', use 'xml', 'columnar' or 'both'")
+            self.init_status = False
+
+        ## Batch Annotation
+        if batch_annotation:
+            for name, value in [('batch_size', batch_size), ('batch_tokens', batch_tokens), ('batch_memory_mb', batch_memory_mb)]:
+                if not isinstance(value, int) or value < 1:
+                    self.warnings.append(f"Invalid batch parameter {name} '{value}', batch annotation disabled")
+                    self.batch_annotation = False
+            if self.batch_annotation:
+                self.batch_max_chars = batch_memory_mb * 1024 * 1024
+
+        ## Chunked Annotation
+        if chunk_size is not None and (not isinstance(chunk_size, int) or chunk_size < 1000):
+            self.warnings.append(f"Invalid chunk_size '{chunk_size}', needs to be an integer of at least 1000 characters, chunking disabled")
+            self.chunk_size = None
+        if not isinstance(chunk_processes, int) or chunk_processes < 1:
+            self.warnings.append(f"Invalid chunk_processes '{chunk_processes}', default to 1")
+            self.chunk_processes = 1
+
+        # Read Ahead
+        if not isinstance(read_processes, int) or read_processes < 1:
+            self.warnings.append(f"Invalid read_processes '{read_processes}', default to 1")
+            self.read_processes = 1
 
-        
         # Output Directory
         if isinstance(output_dir, str):
             if os.path.exists(output_dir):
-                if not use_nonempty_output_folder:
-                    for dirs, paths, files in os.walk(output_dir):
-                        for file in files:
-                            self.init_status = False
-                            self.warnings.append(f"File present in output directory '{os.path.join(dirs, file)}', override using use_nonempty_output_folder paramter")
+                if not use_nonempty_output_folder and not resume:
+                    # Stops at the first file found
+                    present_file = next(scan_files(output_dir), None)
+                    if present_file is not None:
+                        self.init_status = False
+                        self.warnings.append(f"File present in output directory '{present_file}', override using use_nonempty_output_folder paramter")
 
             elif create_output_folder:
                 if os.sep not in output_dir:
@@ -193,7 +243,105 @@ class spacyPipeline:
         else:
             self.warnings.append(f"Output directory '{output_dir}' is incorrect type '{type(output_dir)}', cannot use or create")
             self.init_status = False
-    
+
+        ## Duplicate Detection
+        # Validated before the run manifest, run_config reads the threshold and the normalizer
+        if deduplicate:
+            if not isinstance(duplicate_threshold, (int, float)) or not 0 < duplicate_threshold <= 1:
+                self.warnings.append(f"Invalid duplicate_threshold '{duplicate_threshold}', default to 0.8")
+                self.duplicate_threshold = 0.8
+            if duplicate_links and shard_output:
+                self.warnings.append("Sharded outputs cannot be linked, duplicates are only listed in the duplicate map")
+                self.duplicate_links = False
+
+        ## Text Normalization
+        # A preset name, JSON rules file or dict of rules, applied to the text of every document before annotation
+        if normalize is not None:
+            try:
+                self.normalizer = textNormalizer.from_config(normalize)
+            except ValueError as error:
+                self.warnings.append(str(error))
+                self.init_status = False
+
+        ## Run Manifest
+        if resume and not manifest:
+            self.warnings.append("resume requires the run manifest, manifest has been enabled")
+            manifest = True
+        if verify_outputs not in ["checksum", "size"]:
+            self.warnings.append(f"Unknown verify_outputs '{verify_outputs}', default to 'checksum'")
+            verify_outputs = "checksum"
+        if manifest and self.init_status:
+            self.manifest = runManifest(output_dir, self.run_config(metadata_file), verify_outputs=verify_outputs)
+
+        ## Token Index
+        if token_index is not None:
+            if not isinstance(token_index, str):
+                self.warnings.append(f"Token index '{token_index}' is incorrect type '{type(token_index)}', index disabled")
+            elif not self.spacy_features:
+                self.warnings.append("The token index needs spacy_features, index disabled")
+            elif self.init_status:
+                self.token_index_file = token_index
+                if isinstance(work_queue, str):
+                    # Nodes of a work queue each index into a part file with a rollback journal, merged once the queue is finished
+                    self.token_index = tokenIndex(part_file(token_index), ['word'] + list(self.attributes), journal_mode="DELETE")
+                else:
+                    self.token_index = tokenIndex(token_index, ['word'] + list(self.attributes))
+
+        ## Telemetry
+        if telemetry is not None:
+            if not isinstance(profile_fraction, (int, float)) or not 0 <= profile_fraction <= 1:
+                self.warnings.append(f"Invalid profile_fraction '{profile_fraction}', profiling disabled")
+                profile_fraction = 0.0
+            if not isinstance(telemetry_interval, (int, float)) or telemetry_interval <= 0:
+                # Summaries are written by a timer, an interval of 0 would write them in a busy loop
+                self.warnings.append(f"Invalid telemetry_interval '{telemetry_interval}', default to 30")
+                telemetry_interval = 30
+            if profile_mode not in ["cprofile", "tracemalloc"]:
+                self.warnings.append(f"Unknown profile_mode '{profile_mode}', default to 'cprofile'")
+                profile_mode = "cprofile"
+            if not isinstance(telemetry, str):
+                self.warnings.append(f"Telemetry file '{telemetry}' is incorrect type '{type(telemetry)}', telemetry disabled")
+            elif self.init_status:
+                self.telemetry = runTelemetry(telemetry, telemetry_interval, profile_fraction, profile_mode, profile_dir)
+
+        ## Pipelined Execution
+        for name, value, default in [("prefetch_size", prefetch_size, 4), ("writer_threads", writer_threads, 2), ("write_queue_size", write_queue_size, 4),
+                                     ("write_queue_tokens", write_queue_tokens, 50000)]:
+            if not isinstance(value, int) or value < 1:
+                self.warnings.append(f"Invalid {name} '{value}', default to {default}")
+                setattr(self, name, default)
+        if pipelined and multi_process and worker_nodes > 1:
+            self.warnings.append("pipelined applies to single process runs, worker processes write their own files")
+
+        ## Work Queue
+        if work_queue is not None:
+            lease_settings = {'lease_seconds': lease_seconds, 'claim_size': claim_size, 'max_attempts': max_attempts}
+            for name, default in [("lease_seconds", 300), ("claim_size", 1), ("max_attempts", 3)]:
+                if not isinstance(lease_settings[name], int) or lease_settings[name] < 1:
+                    self.warnings.append(f"Invalid {name} '{lease_settings[name]}', default to {default}")
+                    lease_settings[name] = default
+            if not isinstance(work_queue, str):
+                self.warnings.append(f"Work queue '{work_queue}' is incorrect type '{type(work_queue)}', work queue disabled")
+            elif self.init_status:
+                self.work_queue = workQueue(work_queue, **lease_settings)
+
+        ## Sharded Output
+        if shard_output and self.init_status:
+            if not isinstance(shard_mb, (int, float)) or shard_mb <= 0:
+                self.warnings.append(f"Invalid shard_mb '{shard_mb}', default to 1024")
+                shard_mb = 1024
+            self.shard_writer = shardWriter(output_dir, shard_mb=shard_mb, shared=self.work_queue is not None)
+
+        ## Annotation Cache
+        if annotation_cache is not None and self.spacy_features:
+            if not isinstance(annotation_cache_mb, (int, float)) or annotation_cache_mb <= 0:
+                self.warnings.append(f"Invalid annotation_cache_mb '{annotation_cache_mb}', default to 10240")
+                annotation_cache_mb = 10240
+            if not isinstance(annotation_cache, str):
+                self.warnings.append(f"Annotation cache directory '{annotation_cache}' is incorrect type '{type(annotation_cache)}', cache disabled")
+            elif self.init_status:
+                # Chunking changes sentence boundaries at the cuts, so the chunk size is part of the key
+                self.annotation_cache = annotationCache(annotation_cache, spacy_attributes, {'models': self.model_versions(), 'chunk_size': self.chunk_size}, max_mb=annotation_cache_mb)
 
         ## Print Init Warnings
         if len(self.warnings) > 0 and warnings:
@@ -211,131 +359,713 @@ class spacyPipeline:
         else:
             print("### Initialisation Failed - See Warnings for Details ###")
 
+    def __getstate__(self):
+        # SpaCy pipelines are not shipped to worker processes, each worker loads its own copy
+        state = self.__dict__.copy()
+        state['nlp'] = None
+        state['pipelined_executor'] = None
+        return state
+
+    # SpaCy + Pymusas are only loaded once a run has passed validation and needs annotation
+    def load_models(self):
+        if self.nlp is None and self.spacy_features:
+            self.nlp = self.build_nlp(self.model_profile)
+
+    def build_nlp(self, profile):
+        import spacy
+        package = model_profiles[profile]
+        # The annotation cache stores every attribute, so the full pipeline is kept when it is used
+        pruning = self.prune_components and self.annotation_cache is None
+        if pruning:
+            needed = self.needed_components(package)
+            nlp = spacy.load(package, exclude=[component for component in model_components if component not in needed])
+            if 'senter' in needed and 'senter' in nlp.disabled:
+                nlp.enable_pipe('senter')
+        else:
+            nlp = spacy.load(package)
+        # Chunked runs never pass more than chunk_size characters to the model
+        nlp.max_length = 100000000 if self.chunk_size is None else self.chunk_size
+        if not pruning or 'pymusas' in self.selected_attributes:
+            english_tagger_pipeline = spacy.load('en_dual_none_contextual')
+            nlp.add_pipe('pymusas_rule_based_tagger', source=english_tagger_pipeline)
+        return nlp
+
+    def needed_components(self, package):
+        needed = set()
+        for attribute in self.selected_attributes:
+            needed.update(attribute_components.get(attribute, []))
+        # Sentences always need boundaries, the senter is far cheaper than the parser where the model has one
+        if 'parser' not in needed:
+            needed.add('senter' if 'senter' in package_components(package) else 'parser')
+        if 'tagger' in needed or 'parser' in needed:
+            needed.update(['transformer', 'tok2vec'])
+        return needed
+
+    def model_versions(self):
+        from importlib import metadata as importlib_metadata
+        versions = {}
+        for package in ['spacy', 'pymusas', model_profiles[self.model_profile], 'en_dual_none_contextual']:
+            try:
+                versions[package] = importlib_metadata.version(package)
+            except importlib_metadata.PackageNotFoundError:
+                versions[package] = None
+        return versions
+
+    def run_config(self, metadata_file):
+        # Everything that changes the content of an output, a file produced under a different config is redone on resume
+        metadata_hash = file_hash(metadata_file) if self.metadata and os.path.exists(metadata_file) else None
+        return {'attributes': list(self.attributes), 'xml_text_node': self.xml_text_node, 'xml_metadata_node': self.xml_metadata_node,
+                'compress': self.compress, 'output_format': self.output_format, 'spacy_features': self.spacy_features,
+                'chunk_size': self.chunk_size, 'metadata': self.metadata, 'metadata_id_column': self.metadata_id_column,
+                'metadata_hash': metadata_hash, 'models': self.model_versions(), 'shard_output': self.shard_output,
+                'prune_components': self.prune_components, 'deduplicate': self.duplicate_threshold if self.deduplicate else None,
+                'normalize': self.normalizer.config() if self.normalizer is not None else None}
+
+    def source_files(self):
+        if len(self.all_files) > 0:
+            yield from self.all_files
+        elif isinstance(self.data_dir, str) and os.path.exists(self.data_dir):
+            yield from scan_files(self.data_dir)
+
+    def wanted_type(self, file):
+        file_ending = self.get_filetype(file)
+        return file_ending == self.file_type if self.single_file_type else file_ending in self.multi_filetypes
+
+    def iter_proc_files(self):
+        # Streams the files to process, the type filter and metadata check run as each file is found
+        record = not self.discovered
+        for file in self.source_files():
+            if not self.wanted_type(file):
+                if record:
+                    self.file_warnings.add("Files excluded due to bad file type", file)
+                continue
+            if record and self.metadata and not self.metadata_index.has_file(file):
+                self.file_warnings.add("Files that cannot be located in metadata file", file)
+            yield file
+        self.discovered = True
+
+    def iter_jobs(self):
+        # (static_ID, file) pairs, static_ID is tied to a file's position in discovery order so it is identical for any worker count
+        return enumerate(self.proc_files if self._proc_files is not None else self.iter_proc_files())
+
+    @property
+    def proc_files(self):
+        # Listed on first use only, job_handler streams the files without it
+        if self._proc_files is None:
+            self._proc_files = list(self.iter_proc_files())
+        return self._proc_files
+
+    def report_file_warnings(self):
+        self.file_warnings.close()
+        if self.file_warnings.total() == 0:
+            return
+        summary = self.file_warnings.summary()
+        self.warnings.extend(summary)
+        print(f"### {self.file_warnings.total()} File Warning(s) ###")
+        for line in summary:
+            print(line)
+        if self.file_warnings.report_file is not None:
+            print(f"### Full Warning Report Written to '{self.file_warnings.report_file}' ###")
+
     def get_filetype(self, filename):
         return os.path.splitext(filename)[1].lower()
 
     def build_directory(self, directory):
-        full_path = []
-        for path in directory.split(os.sep):
-            full_path.append(path)
-            if os.path.exists(os.path.join(*full_path)):
-                continue
-            else:
-                os.mkdir(os.path.join(*full_path))    
+        # Worker processes and nodes sharing output_dir create the same directories concurrently
+        os.makedirs(directory, exist_ok=True)
 
 
     def job_handler(self):
         if self.init_status == True:
-            if self.worker_nodes == 1 or self.multi_process == False:
-                for input_file in tqdm(self.proc_files):
-                    self.process_file(input_file)
+            # With an annotation cache the models are only loaded once a text misses the cache
+            if (self.worker_nodes == 1 or self.multi_process == False) and self.annotation_cache is None:
+                self.load_models()
+            if self.telemetry is not None:
+                self.telemetry.start_summaries()
+            if self.telemetry is not None and self.work_queue is None:
+                # The ETA needs the size of the whole corpus, it is summed by a second scan in the background while annotation runs
+                self.telemetry.count_bytes(self.proc_files if self._proc_files is not None else (file for file in self.source_files() if self.wanted_type(file)))
+            if self.deduplicate and self.work_queue is not None:
+                # The coordinator found the duplicates when registering, only their representatives are queued
+                self.load_duplicates()
+            elif self.deduplicate:
+                self.find_duplicates()
+            if self.work_queue is None:
+                self.run_jobs(self.unique_jobs(self.iter_jobs()))
+            else:
+                try:
+                    # Files are claimed from the shared queue, once none are left to claim the run waits on leases held
+                    # elsewhere, which are either completed or expire and are claimed here
+                    self.run_jobs(self.work_queue.jobs())
+                    while self.work_queue.wait_for_work():
+                        self.run_jobs(self.work_queue.jobs())
+                except BaseException:
+                    self.work_queue.close()
+                    raise
+                self.report_lost_leases()
+                self.merge_parts()
+            self.close_outputs()
+            self.report_file_warnings()
         else:
             print("### Initialisation Failed - See Warnings for Details ###")
+
+    def run_jobs(self, jobs):
+        if (self.worker_nodes == 1 or self.multi_process == False) and self.pipelined:
+            from CorpusForge.Pipelined_Executor_Class import pipelinedExecutor
+            with pipelinedExecutor(self, self.prefetch_size, self.writer_threads, self.write_queue_size, self.write_queue_tokens):
+                self.single_process_handler(jobs)
+        elif self.worker_nodes == 1 or self.multi_process == False:
+            self.single_process_handler(jobs)
+        else:
+            self.multi_process_handler(jobs)
+
+    def register_queue(self):
+        # Coordinator mode, the corpus is listed once into the shared work queue for workers on any node to claim
+        if self.work_queue is None:
+            print("### No Work Queue Given, Set work_queue to Register the Corpus ###")
+            return 0
+        jobs = self.iter_jobs()
+        if self.deduplicate:
+            self.find_duplicates()
+            jobs = self.unique_jobs(jobs)
+        registered = self.work_queue.register(jobs)
+        status = self.work_queue.status()
+        print(f"### {registered} File(s) Registered, {status['states']['queued']} Queued in '{self.work_queue.queue_file}' ###")
+        self.report_file_warnings()
+        return registered
+
+    # Duplicates - found before annotation, only the first document of each cluster is annotated
+
+    def duplicate_map_file(self):
+        return os.path.join(self.output_dir, ".corpusforge_duplicates.csv")
+
+    def find_duplicates(self):
+        from CorpusForge.Duplicate_Detection_Class import duplicateDetector, file_signature
+        detector = duplicateDetector(self.duplicate_threshold)
+        files = [input_file for _, input_file in self.iter_jobs()]
+        if self.read_processes == 1:
+            signatures = (detector.signature(*self.read_input(input_file)[:2]) for input_file in files)
+            for input_file, signature in zip(tqdm(files, desc="Duplicates"), signatures):
+                detector.add(input_file, signature=signature)
+        else:
+            with ProcessPoolExecutor(max_workers=self.read_processes) as executor:
+                signatures = executor.map(file_signature, ((detector, input_file, self.errors) for input_file in files), chunksize=8)
+                for input_file, signature in zip(tqdm(files, desc="Duplicates"), signatures):
+                    detector.add(input_file, signature=signature)
+        self.duplicate_clusters = {representative: detector.duplicates(representative) for representative in detector.clusters if detector.clusters[representative]}
+        self.duplicate_of = dict(detector.representative)
+        detector.write_map(self.duplicate_map_file(), self.map_output)
+        print(f"### {detector.n_duplicates()} Duplicate(s) of {len(self.duplicate_clusters)} Document(s) Found in {detector.n_documents} File(s), Listed in '{self.duplicate_map_file()}' ###")
+        if self.duplicate_links:
+            self.link_duplicates()
+
+    def map_output(self, input_file):
+        # The duplicate map gives a representative's output relative to output_dir, or its document ID in the shards
+        output_file = self.get_output_file(input_file)
+        return self.output_key(output_file) if self.shard_writer is not None else os.path.relpath(output_file, self.output_dir)
+
+    def load_duplicates(self):
+        from CorpusForge.Duplicate_Detection_Class import read_duplicate_map
+        if os.path.exists(self.duplicate_map_file()):
+            self.duplicate_clusters, self.duplicate_of = read_duplicate_map(self.duplicate_map_file())
+
+    def unique_jobs(self, jobs):
+        for static_ID, input_file in jobs:
+            if input_file in self.duplicate_of:
+                if self.telemetry is not None:
+                    self.telemetry.skip(input_file)
+                continue
+            yield static_ID, input_file
+
+    def link_duplicates(self):
+        # Each duplicate's output path links to its representative's output, links resolve once the representative is written
+        for duplicate, representative in self.duplicate_of.items():
+            representative_output = self.get_output_file(representative)
+            duplicate_output = self.get_output_file(duplicate)
+            for target, link in zip(self.output_files(representative_output), self.output_files(duplicate_output)):
+                if os.path.lexists(link):
+                    if not os.path.islink(link):
+                        self.file_warnings.add("Duplicates not linked, an output already exists", link)
+                        continue
+                    os.remove(link)
+                os.symlink(os.path.relpath(target, os.path.dirname(link)), link)
+
+    def merge_parts(self):
+        # Every node wrote its own part indexes, the first to find the queue finished merges them into the shared ones in one step
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+        if self.token_index is not None:
+            self.token_index.close()
+        if (self.shard_writer is None and self.token_index is None) or not self.work_queue.claim_merge():
+            return
+        merged = 0
+        if self.shard_writer is not None:
+            merged += self.shard_writer.merge_parts()
+        if self.token_index is not None:
+            parts = shared_part_files(self.token_index_file)
+            with tokenIndex(self.token_index_file, self.token_index.fields, journal_mode="DELETE") as token_index:
+                token_index.merge(parts, remove=True)
+            merged += len(parts)
+        print(f"### {merged} Part Index(es) Merged ###")
+
+    def report_lost_leases(self):
+        lost, self.work_queue.lost = self.work_queue.lost, []
+        for file in lost:
+            self.file_warnings.add("Leases lost to another worker", file)
+
+    def single_process_handler(self, jobs):
+        if self.batch_annotation and self.spacy_features:
+            self.process_batches(tqdm(jobs))
+        else:
+            for static_ID, input_file, output_file, prepared in self.prefetched(self.prepare_jobs(tqdm(jobs))):
+                with self.profile(output_file):
+                    soup, sentences = self.annotate_xml(*prepared)
+                    self.write_document(soup, sentences, input_file, output_file)
+
+    def multi_process_handler(self, jobs):
+        failures = []
+        # Keep a bounded number of job groups queued per worker, idle workers take the next group as soon as they finish
+        max_pending = self.worker_nodes * 2
+        group_iter = iter(self.group_jobs(jobs))
+        executor = ProcessPoolExecutor(max_workers=self.worker_nodes, initializer=_init_worker, initargs=(self,))
+        # Groups in flight by future, kept so the files of a group lost with a dead worker are known
+        pending = {}
+        if self.telemetry is not None:
+            self.telemetry.watch("pending_groups", lambda: len(pending))
+        try:
+            with tqdm(total=len(self._proc_files) if self._proc_files is not None else None) as progress:
+                while True:
+                    for group in group_iter:
+                        pending[executor.submit(_process_worker, group)] = group
+                        if len(pending) >= max_pending:
+                            break
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    broken = False
+                    for future in done:
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool:
+                            broken = True
+                            continue
+                        del pending[future]
+                        self.collect_result(result, failures, progress)
+                    if broken:
+                        # A worker died without returning (killed by the OOM killer or crashed), the pool fails every group still in it.
+                        # Groups that finished first are kept, the rest are recorded as failed and the run continues in a new pool
+                        wait(pending)
+                        for future, group in list(pending.items()):
+                            del pending[future]
+                            if future.exception() is None:
+                                self.collect_result(future.result(), failures, progress)
+                            else:
+                                self.collect_result(self.lost_group(group), failures, progress)
+                        executor.shutdown(wait=True)
+                        executor = ProcessPoolExecutor(max_workers=self.worker_nodes, initializer=_init_worker, initargs=(self,))
+        finally:
+            executor.shutdown(wait=True)
+
+        if self.telemetry is not None:
+            self.telemetry.unwatch("pending_groups")
+        if self.token_index is not None:
+            # Each worker indexed into a part file of its own
+            self.token_index.merge(part_files(self.token_index.index_file), remove=True)
+
+        self.warnings.extend(f"File '{failure['file']}' failed: {failure['error']}" for failure in failures)
+        if len(failures) > 0:
+            print(f"### {len(failures)} File(s) Failed ###")
+            for failure in failures:
+                print(f"File '{failure['file']}' failed: {failure['error']}")
+                if failure['traceback'] is not None:
+                    print(failure['traceback'])
     
     
-    # EPUB - Chapter to string converter, TEI from EPUB
-    def str_from_epub(file):
-        def chapter_to_str(chapter):
-            soup = bs4(chapter.get_body_content(), 'html.parser')
-            text = [para.get_text() for para in soup.find_all('p')]
-            return ' '.join(text)
+    def collect_result(self, result, failures, progress):
+        if self.manifest is not None:
+            self.manifest.append(result['manifest'])
+        if self.telemetry is not None:
+            self.telemetry.append(result['telemetry'])
+        if self.work_queue is not None:
+            self.work_queue.append(result['work_queue'])
+            if result['error'] is not None:
+                # Files of the group the worker did not finish go back to the queue
+                for input_file in result['files']:
+                    self.work_queue.fail(input_file, result['error'])
+        for warning in result['warnings']:
+            self.file_warnings.add("Processing warnings", f"File '{result['file']}': {warning}")
+        if result['error'] is not None:
+            failures.append(result)
+        progress.update(result['n_files'])
+
+    def lost_group(self, group):
+        # The result of a group whose worker process died, its files are failures in the manifest and the warning summary
+        files = [input_file for _, input_file in group]
+        error = "BrokenProcessPool: a worker process died while the file was in flight"
+        for input_file in files:
+            self.file_warnings.add("Files lost with a worker process that died", input_file)
+            if self.manifest is not None:
+                self.manifest.fail(input_file, error)
+        return {'file': files[0] if len(files) == 1 else ', '.join(files), 'files': files, 'n_files': len(files), 'warnings': [], 'error': error,
+                'traceback': None, 'manifest': [], 'telemetry': [], 'work_queue': []}
+
+    def group_jobs(self, jobs):
+        # Batched workers receive groups bounded by on-disk size, the worker packs them precisely by tokens
+        if not self.batch_annotation:
+            for job in jobs:
+                yield [job]
+            return
+        group = []
+        group_bytes = 0
+        for job in jobs:
+            file_bytes = os.path.getsize(job[1])
+            if len(group) > 0 and (group_bytes + file_bytes > self.batch_max_chars or len(group) >= self.batch_size):
+                yield group
+                group, group_bytes = [], 0
+            group.append(job)
+            group_bytes += file_bytes
+        if len(group) > 0:
+            yield group
+
+    # EPUB - TEI string from EPUB, the pipeline itself reads EPUBs through read_epub without building TEI
+    def str_from_epub(self, file):
+        from CorpusForge.Epub_Reader_Class import read_epub
+        book = read_epub(file)
         root = ET.Element('TEI xmlns="http://www.tei-c.org/ns/1.0')
         header = ET.SubElement(root, 'teiHeader')
-        book = epub.read_epub(file)
-        try:
-            title = book.get_metadata('DC', 'title')[0][0]
-        except:
-            title = "NA"
-        try:
-            creator = book.get_metadata('DC', 'creator')[0][0]
-        except:
-            creator = "NA"
 
         fileDesc = ET.SubElement(header, 'fileDesc')
         titleStmt = ET.SubElement(fileDesc, 'titleStmt')
         title_element = ET.SubElement(titleStmt, 'title')
-        title_element.text = str(title)
+        title_element.text = book['metadata']['dc_title']
         respStmt = ET.SubElement(titleStmt, 'respStmt')
         name_element = ET.SubElement(respStmt, 'name')
-        name_element.text = str(creator)
+        name_element.text = book['metadata']['dc_creator']
 
         text_element = ET.SubElement(root, 'text')
         body_element = ET.SubElement(text_element, 'body')
-        items = list(book.get_items_of_type(ebooklib.ITEM_DOCUMENT))
-        count = 0
-        for item in items:
-            if len(chapter_to_str(item)) >1:
-                count +=1
-                text_element = ET.SubElement(body_element, "section {}".format(str(count)))
-                text_element.text = html.escape(str(chapter_to_str(item)))
+        for count, section in enumerate(book['sections'], start=1):
+            text_element = ET.SubElement(body_element, "section {}".format(str(count)))
+            text_element.text = html.escape(section)
         xml_string = ET.tostring(root, encoding="utf-8").decode("utf-8")
         return xml_string
 
-    def process_file(self, input_file):
+    def get_output_file(self, input_file):
         file_type = self.get_filetype(input_file)
-        is_xml = file_type == ".xml"
-        is_epub = file_type == ".epub"
-
         if self.flat_output_dir:
             output_file = os.path.join(self.output_dir, input_file.split(os.sep)[-1].lower().replace(file_type, ".xml"))
         else:
-            self.build_directory(os.path.join(self.output_dir, str(os.sep).join(input_file.split(os.sep)[1:-1])))
+            # Sharded documents are keyed by this path, no directories are needed for them
+            if not self.shard_output:
+                self.build_directory(os.path.join(self.output_dir, str(os.sep).join(input_file.split(os.sep)[1:-1])))
             output_file = os.path.join(self.output_dir, str(os.sep).join(input_file.split(os.sep)[1:]).lower()).replace(file_type, ".xml")
 
         if self.compress:
             output_file = output_file.replace(".xml", ".pkl")
+        return output_file
+
+    def get_text_output_file(self, doc_id):
+        return os.path.join(self.output_dir, doc_id.lower() + (".pkl" if self.compress else ".xml"))
+
+    def read_input(self, input_file):
+        return read_input_file(input_file, self.errors)
+
+    def read_jobs(self, jobs):
+        # Yields (static_ID, input_file, output_file, (content, is_xml, extra_metadata)) for the files still to process,
+        # with read_processes > 1 files are read and EPUBs extracted in a process pool ahead of annotation
+        telemetry = self.telemetry
+        if self.read_processes == 1:
+            for static_ID, input_file in jobs:
+                output_file = self.get_output_file(input_file)
+                if self.skip_file(input_file, output_file):
+                    self.skipped(input_file)
+                    continue
+                start = time.perf_counter()
+                document = self.read_input(input_file)
+                if telemetry is not None:
+                    telemetry.start(output_file, input_file)
+                    telemetry.add(output_file, "read", time.perf_counter() - start)
+                yield static_ID, input_file, output_file, document
+            return
+        with ProcessPoolExecutor(max_workers=self.read_processes) as executor:
+            pending = deque()
+            for static_ID, input_file in jobs:
+                output_file = self.get_output_file(input_file)
+                if self.skip_file(input_file, output_file):
+                    self.skipped(input_file)
+                    continue
+                pending.append((static_ID, input_file, output_file, executor.submit(read_input_file, input_file, self.errors)))
+                if len(pending) >= self.read_processes * 2:
+                    yield self.collect_read(*pending.popleft())
+            while pending:
+                yield self.collect_read(*pending.popleft())
+
+    def skipped(self, input_file):
+        if self.telemetry is not None:
+            self.telemetry.skip(input_file)
+        if self.work_queue is not None:
+            self.work_queue.complete(input_file)
+
+    def collect_read(self, static_ID, input_file, output_file, future):
+        # Only the time spent waiting on the read pool is counted as reading
+        start = time.perf_counter()
+        document = future.result()
+        if self.telemetry is not None:
+            self.telemetry.start(output_file, input_file)
+            self.telemetry.add(output_file, "read", time.perf_counter() - start)
+        return static_ID, input_file, output_file, document
+
+    def output_files(self, output_file):
+        # Sharded documents are tracked by the shard index rather than as files of their own
+        if self.shard_writer is not None:
+            return []
+        output_files = []
+        if self.output_format in ["xml", "both"]:
+            output_files.append(output_file)
+        if self.output_format in ["columnar", "both"]:
+            output_files.append(columnar_path(output_file))
+        return output_files
+
+    def output_key(self, output_file):
+        return os.path.splitext(os.path.relpath(output_file, self.output_dir))[0]
+
+    def shard_kinds(self):
+        return [kind for kind, formats in [("xml", ["xml", "both"]), ("cfc", ["columnar", "both"])] if self.output_format in formats]
+
+    def skip_file(self, input_file, output_file):
+        if self.shard_writer is not None and (self.resume or self.skip_processed_files):
+            # A document counts as processed once the shard index holds every output of it
+            if not self.shard_writer.contains(self.output_key(output_file), self.shard_kinds()):
+                return False
+        if self.resume:
+            return self.manifest.needs_processing(input_file, self.output_files(output_file)) is None
+        if self.skip_processed_files:
+            return all(os.path.exists(file) for file in self.output_files(output_file))
+        return False
+
+    def close_outputs(self):
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+        if self.token_index is not None:
+            self.token_index.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+        if self.work_queue is not None:
+            self.work_queue.close()
+
+    def record_output(self, input_file, output_file, digests={}):
+        if self.manifest is not None:
+            self.manifest.add(input_file, self.output_files(output_file), digests)
+        if self.work_queue is not None:
+            # Only marked done once every output is written
+            self.work_queue.complete(input_file)
+
+    def write_output(self, soup, sentences, output_file):
+        # Sentences are serialised as they are produced, the full document is never held as tags or a string.
+        # Returns the digests of the files written, hashed by the writers for the run manifest
+        writers = []
+        xml_writer = None
+        columnar_writer = None
+        index_document = None
+        shard = self.shard_writer
+        key = self.output_key(output_file) if shard is not None or self.token_index is not None else None
+        metadata_tag = soup.find(self.xml_metadata_node)
+        metadata = metadata_tag.attrs if metadata_tag is not None else {}
+        try:
+            if self.output_format in ["xml", "both"]:
+                # Sharded XML is streamed straight onto the end of the current shard
+                stream = shard.begin(key, "xml", self.compress) if shard is not None else None
+                xml_writer = streamXMLWriter(output_file, compress=self.compress, measure_compressed=self.start_benchmark, stream=stream)
+                xml_writer.open(soup, self.xml_text_node)
+                writers.append(xml_writer)
+            if self.output_format in ["columnar", "both"]:
+                columnar_writer = columnarWriter(columnar_path(output_file))
+                columnar_writer.open(metadata)
+                writers.append(columnar_writer)
+            if self.token_index is not None:
+                # Postings are collected alongside the outputs and stored once the document is complete
+                index_document = self.token_index.document(key, metadata)
+                writers.append(index_document)
+
+            # Time spent waiting on the sentences is annotation, time spent in the writers is serialisation
+            annotate_seconds = 0.0
+            serialize_seconds = 0.0
+            n_tokens = 0
+            n_sentences = 0
+            sentences = iter(sentences)
+            while True:
+                start = time.perf_counter()
+                sentence = next(sentences, None)
+                annotate_seconds += time.perf_counter() - start
+                if sentence is None:
+                    break
+                start = time.perf_counter()
+                for writer in writers:
+                    writer.write_sentence(sentence)
+                serialize_seconds += time.perf_counter() - start
+                n_tokens += len(sentence)
+                n_sentences += 1
+            start = time.perf_counter()
+            if xml_writer is not None:
+                xml_writer.close()
+                if shard is not None:
+                    shard.commit(key, "xml", self.compress)
+            if columnar_writer is not None:
+                # Columnar files are only written on close, after the XML record is complete
+                if shard is not None:
+                    columnar_writer.stream = shard.begin(key, "cfc")
+                columnar_writer.close()
+                if shard is not None:
+                    shard.commit(key, "cfc")
+            if index_document is not None:
+                index_document.close()
+            if self.telemetry is not None:
+                # With the pipelined executor annotation is timed on the annotating thread, the wait here is for its hand over
+                if self.pipelined_executor is None:
+                    self.telemetry.add(output_file, "annotate", annotate_seconds)
+                    self.telemetry.take_components(output_file)
+                self.telemetry.add(output_file, "serialize", serialize_seconds)
+                self.telemetry.add(output_file, "write", time.perf_counter() - start)
+                self.telemetry.finish(output_file, n_tokens, n_sentences)
+        except BaseException:
+            if shard is not None:
+                shard.abort()
+            raise
 
-        if self.skip_processed_files and os.path.exists(output_file):
+        self.latest_file_size = xml_writer.raw_bytes if xml_writer is not None else 0
+        self.latest_file_comp_size = xml_writer.compressed_bytes if xml_writer is not None else 0
+        self.latest_file_columnar_size = columnar_writer.file_size if columnar_writer is not None else 0
+        return {writer.output_file: writer.output_digest for writer in [xml_writer, columnar_writer] if writer is not None and writer.output_digest is not None}
+
+    def write_document(self, soup, sentences, input_file, output_file):
+        # With the pipelined executor the annotated document is serialised and written by its writer threads
+        if self.pipelined_executor is not None:
+            self.pipelined_executor.submit(soup, sentences, input_file, output_file)
+            return
+        digests = self.write_output(soup, sentences, output_file)
+        if input_file is not None:
+            self.record_output(input_file, output_file, digests)
+
+    def prepare_jobs(self, jobs):
+        for static_ID, input_file, output_file, document in self.read_jobs(jobs):
+            yield static_ID, input_file, output_file, self.prepare_document(input_file, output_file, document, static_ID)
+
+    def prepare_document(self, input_file, output_file, document, static_ID=None):
+        content, is_xml, extra_metadata = document
+        if input_file in self.duplicate_clusters:
+            # The representative's header lists the documents that were not annotated in its place
+            extra_metadata = dict(extra_metadata or {}, duplicates=";".join(self.duplicate_clusters[input_file]))
+        start = time.perf_counter()
+        prepared = self.prepare_xml(input_file, content, is_xml, static_ID, extra_metadata)
+        if self.telemetry is not None:
+            self.telemetry.add(output_file, "parse", time.perf_counter() - start)
+        return prepared
+
+    def profile(self, output_file):
+        # Sampled documents are profiled from annotation to writing
+        return self.telemetry.profile(output_file) if self.telemetry is not None else nullSample()
+
+    def prefetched(self, documents):
+        # With the pipelined executor documents are read and prepared ahead of the models in a background thread
+        if self.pipelined_executor is not None:
+            return self.pipelined_executor.prefetch(documents)
+        return documents
+
+    def process_file(self, input_file, static_ID=None):
+        output_file = self.get_output_file(input_file)
+
+        if self.skip_file(input_file, output_file):
             return None
+        self.process_document(input_file, output_file, self.read_input(input_file), static_ID)
 
-        if is_xml:
-            with open(input_file, errors=self.errors) as file_read:
-                content = file_read.read()
-        
-        # converts epub to string
-        elif is_epub:
-            content = self.str_from_epub(input_file)
+    def process_document(self, input_file, output_file, document, static_ID=None):
+        with self.profile(output_file):
+            soup, sentences = self.annotate_xml(*self.prepare_document(input_file, output_file, document, static_ID))
+            self.write_document(soup, sentences, input_file, output_file)
 
-        soup = self.build_xml(input_file, content, is_xml)
-        self.latest_file = soup.prettify()
+    def process_text(self, text, doc_id, static_ID=None, is_xml=False, output_file=None, extra_metadata=None):
+        # In-memory entry point, a document given as a string and an ID is written to <output_dir>/<doc_id>.xml unless output_file is set
+        if output_file is None:
+            output_file = self.get_text_output_file(doc_id)
+        soup, sentences = self.build_xml(doc_id, text, is_xml, static_ID, extra_metadata)
+        self.write_output(soup, sentences, output_file)
+        return output_file
 
-        if self.compress or self.start_benchmark:
-            self.latest_file_comp = zlib.compress(self.latest_file.encode("UTF-8"))
+    def process_batches(self, jobs):
+        # Reads jobs in order and annotates them through nlp.pipe in token budgeted batches
+        batch = []
+        batch_tokens = 0
+        batch_chars = 0
+        for static_ID, input_file, output_file, (soup, text_content, valid_ID) in self.prefetched(self.prepare_jobs(jobs)):
+            if self.chunk_size is not None and len(text_content) > self.chunk_size:
+                # Long documents are chunked on their own, batches keep their current order otherwise
+                self.write_document(soup, self.gen_spacy_features(text_content, valid_ID), input_file, output_file)
+                continue
+            if self.annotation_cache is not None and self.annotation_cache.contains(self.annotation_cache.key(text_content)):
+                # Cached texts never enter a batch
+                self.write_document(soup, self.gen_spacy_features(text_content, valid_ID), input_file, output_file)
+                continue
+            n_tokens = len(text_content.split())
 
-        if self.compress:
-            with open(output_file, "wb") as pkl_write:
-                pkl.dump(self.latest_file_comp, pkl_write)
-        else:
-            with open(output_file, "w") as xml_write:
-                xml_write.write(self.latest_file)
+            # Documents over budget are never packed with others, they are annotated on their own
+            if len(batch) > 0 and (batch_tokens + n_tokens > self.batch_tokens or batch_chars + len(text_content) > self.batch_max_chars or len(batch) >= self.batch_size):
+                self.annotate_batch(batch)
+                batch, batch_tokens, batch_chars = [], 0, 0
+
+            batch.append((input_file, soup, text_content, valid_ID, output_file))
+            batch_tokens += n_tokens
+            batch_chars += len(text_content)
+
+        if len(batch) > 0:
+            self.annotate_batch(batch)
 
+    def annotate_batch(self, batch):
+        self.load_models()
+        docs = self.nlp.pipe([text_content for _, _, text_content, _, _ in batch], batch_size=len(batch))
+        for input_file, soup, text_content, valid_ID, output_file in batch:
+            # nlp.pipe annotates the whole batch on the first document, batches are timed as a whole
+            start = time.perf_counter()
+            doc = next(docs)
+            if self.telemetry is not None:
+                self.telemetry.add(output_file, "nlp", time.perf_counter() - start)
+            sentences = self.gen_spacy_features(text_content, valid_ID, doc=doc)
+            self.write_document(soup, sentences, input_file, output_file)
 
-    def build_xml(self, file, file_content, is_xml):
+    def build_xml(self, file, file_content, is_xml, static_ID=None, extra_metadata=None, normalize=True):
+        # file is a path or a document ID, it is only used to find the document's ID and metadata
+        return self.annotate_xml(*self.prepare_xml(file, file_content, is_xml, static_ID, extra_metadata, normalize))
+
+    def annotate_xml(self, soup, file_content, valid_ID):
+        if not self.spacy_features:
+            # Metadata only runs keep the unannotated text in the text node
+            text_tag = soup.find(self.xml_text_node)
+            if text_tag.text == "":
+                text_tag.string = file_content
+            return soup, iter(())
+        sentences = self.gen_spacy_features(file_content, valid_ID)
+
+        return soup, sentences
+
+    def prepare_xml(self, file, file_content, is_xml, static_ID=None, extra_metadata=None, normalize=True):
+        from bs4 import BeautifulSoup as bs4
 
         if is_xml:
                 soup = bs4(file_content, features="xml")
         else:
             soup = bs4(features="xml")
 
-        file_w_ending = file.split(os.sep)[-1].lower()
         file_wo_ending = file.split(os.sep)[-1].lower().replace(self.get_filetype(file), "")
         valid_ID = file_wo_ending
-        metadata = None
 
         if self.metadata:
-            for pot_ID in [file_w_ending, file_wo_ending]:
-                metadata = self.metadata_df.loc[self.metadata_df['ID'] == pot_ID]
-                valid_ID = pot_ID
-                if not metadata.empty:
-                    break
-
-            if metadata.empty:
-                metadata = dict(self.metadata_attrs, [np.nan]*len(self.metadata_attrs))
-            else:
-                metadata = metadata.to_dict(orient='records')[0]
+            valid_ID, metadata = self.metadata_index.lookup(file)
+            if metadata is None:
+                metadata = self.metadata_index.empty_row()
             
-            metadata["static_ID"] = (12-len(str(self.static_ID)))*"0" + str(self.static_ID)
-            self.static_ID += 1
+            if static_ID is None:
+                static_ID = self.static_ID
+                self.static_ID += 1
+            metadata["static_ID"] = (12-len(str(static_ID)))*"0" + str(static_ID)
             metadata_tag = soup.find(self.xml_metadata_node)
             if metadata_tag == None:
                 metadata_tag = soup.new_tag(self.xml_metadata_node)
@@ -343,6 +1073,14 @@ class spacyPipeline:
             
             metadata_tag.attrs.update(metadata)
 
+        # Attributes from earlier in-memory stages, such as the body extraction statuses
+        if extra_metadata:
+            metadata_tag = soup.find(self.xml_metadata_node)
+            if metadata_tag == None:
+                metadata_tag = soup.new_tag(self.xml_metadata_node)
+                soup.append(metadata_tag)
+            metadata_tag.attrs.update(extra_metadata)
+
         text_tag = soup.find(self.xml_text_node)
         if text_tag == None:
             text_tag = soup.new_tag(self.xml_text_node)
@@ -350,95 +1088,337 @@ class spacyPipeline:
         elif text_tag.text != "":
             file_content = text_tag.text
 
-        soup = self.gen_spacy_features(soup, file_content, valid_ID)
+        # normalize is False for text an earlier stage already normalised
+        if normalize and self.normalizer is not None:
+            file_content = self.normalizer.normalize(file_content)
 
-        return soup
+        return soup, file_content, valid_ID
     
-    def gen_spacy_features(self, soup, content, file_ID):
-        output_doc = self.nlp(content)
+    def gen_spacy_features(self, content, file_ID, doc=None):
+        # Yields one sentence at a time as a list of (word, character offset, attributes)
+        sentences = None
+        if self.annotation_cache is not None:
+            key = self.annotation_cache.key(content)
+            if doc is None:
+                sentences = self.annotation_cache.get(key)
+            if sentences is None:
+                sentences = self.annotation_cache.store(key, self.annotate(content, doc, spacy_attributes))
+        else:
+            # Without a cache only the selected attributes are ever extracted
+            yield from self.annotate(content, doc)
+            return
+        # Cached annotations carry every attribute, only the selected ones are kept for output
+        selected = self.selected_attributes
+        if len(selected) == len(spacy_attributes):
+            yield from sentences
+            return
+        for sentence in sentences:
+            yield [(text, offset, {name: attributes[name] for name in selected}) for text, offset, attributes in sentence]
+
+    def annotate(self, content, doc=None, attributes=None):
+        if doc is not None:
+            yield from self.doc_sentences(doc, attributes=attributes)
+            return
+        self.load_models()
+        if self.chunk_size is not None and len(content) > self.chunk_size:
+            # Chunks are annotated in sequence and discarded, offsets are shifted back onto the full text
+            chunks = ((chunk, offset) for offset, chunk in self.split_chunks(content))
+            for chunk_doc, offset in self.nlp.pipe(chunks, as_tuples=True, batch_size=1, n_process=self.chunk_processes):
+                yield from self.doc_sentences(chunk_doc, offset, attributes)
+        else:
+            yield from self.doc_sentences(self.run_nlp(content), attributes=attributes)
 
-        main_tag = soup.find(self.xml_text_node)
+    def run_nlp(self, content):
+        if self.telemetry is None:
+            return self.nlp(content)
+        # Runs the components one at a time so each is timed, as nlp() itself would
+        start = time.perf_counter()
+        doc = self.nlp.make_doc(content)
+        self.telemetry.component("tokenizer", time.perf_counter() - start)
+        for name, component in self.nlp.pipeline:
+            start = time.perf_counter()
+            doc = component(doc)
+            self.telemetry.component(name, time.perf_counter() - start)
+        return doc
+
+    def doc_sentences(self, output_doc, offset=0, attributes=None):
+        # Token attributes are read in bulk through Doc.to_array, each distinct string is looked up in the StringStore once
+        names = self.selected_attributes if attributes is None else attributes
+        columns = doc_columns(output_doc, ['text', 'idx'] + [name for name in names if name != 'pymusas'])
+        if 'pymusas' in names:
+            columns['pymusas'] = extension_values(output_doc, "pymusas_tags", columns['idx'])
+        texts = columns.pop('text')
+        idxs = columns.pop('idx')
+        rows = list(zip(*[columns[name] for name in names])) if len(names) > 0 else [()] * len(texts)
         for sentence in output_doc.sents:
-            sentence_tag = soup.new_tag("s")
-            for token in sentence:
-                word_tag = soup.new_tag("w")
-                word_tag.string = token.text
-                attributes = {
-                    'lemma': token.lemma_,
-                    'pos': token.pos_,
-                    'tag': token.tag_,
-                    'dep': token.dep_,
-                    'shape': token.shape_,
-                    'is_alpha': token.is_alpha,
-                    'is_stop': token.is_stop,
-                    'pymusas': token._.pymusas_tags
-                }
-                for attribute in list(attributes.keys()):
-                    if attribute not in self.attributes:
-                        del attributes[attribute]
-                word_tag.attrs.update(attributes)
-                sentence_tag.append(word_tag)
-            main_tag.append(sentence_tag)
-
-        soup.append(main_tag)
-        # Return the modified xml_soup
-        return soup
+            yield [(texts[index], idxs[index] + offset, dict(zip(names, rows[index]))) for index in range(sentence.start, sentence.end)]
+
+    def split_chunks(self, text):
+        # Yields (offset, chunk) windows of at most chunk_size characters that concatenate back to the text,
+        # cutting at the last paragraph break, then line break, sentence end or space inside the window
+        start = 0
+        while len(text) - start > self.chunk_size:
+            window_end = start + self.chunk_size
+            cut = -1
+            for boundary in ["\n\n", "\n"]:
+                cut = text.rfind(boundary, start + 1, window_end)
+                if cut != -1:
+                    cut += len(boundary)
+                    break
+            if cut == -1:
+                sentence_ends = [match.end() for match in sentence_end_regex.finditer(text, start + 1, window_end)]
+                if len(sentence_ends) > 0:
+                    cut = sentence_ends[-1]
+            if cut == -1:
+                cut = text.rfind(" ", start + 1, window_end)
+                cut = window_end if cut == -1 else cut + 1
+            yield start, text[start:cut]
+            start = cut
+        if start < len(text):
+            yield start, text[start:]
     
-    def benchmark(self, word_count=True):
+    def benchmark(self, word_count=True, confidence=0.9, bootstrap_samples=1000):
         if self.init_status == False:
             print("### Initialisation Failed - See Warnings for Details ###")
             return None
-        file_metadata = {}
-        for file in tqdm(self.proc_files):
-            file_type = self.get_filetype(file)
-            with open(file, errors=self.errors) as read_file:
-                content = read_file.read()
-            if file_type == ".xml":
-                content = bs4(content, features="xml").text
-            word_count = len(content.split(" "))
-            file_metadata[file] = word_count
+        import numpy as np
+        import humanize
+        self.load_models()
 
+        # File sizes come from os.stat, only the benchmark sample is ever read
+        files = list(self.proc_files)
+        file_bytes = np.array([os.stat(file).st_size for file in files], dtype=np.float64)
 
-        sorted_files = sorted(file_metadata.items(), key=lambda x: x[1])
-
-        # Calculate the number of files to pick
-        step_size = len(sorted_files) // self.benchmark_sample
+        # Pick files with the best distribution of scope
+        order = np.argsort(file_bytes, kind="stable")
+        sample_count = min(self.benchmark_sample, len(files))
+        selected = order[np.unique(np.linspace(0, len(files) - 1, sample_count).round().astype(int))]
+        selected_files = [files[index] for index in selected]
 
-        sample_performance = []
-        sample_size_comp = []
+        sample_words = []
+        sample_seconds = []
         sample_size_raw = []
-        # Pick files with the best distribution of scope
-        selected_files = [file for i, (file, _) in enumerate(sorted_files) if i % step_size == 0][:self.benchmark_sample]
+        sample_size_comp = []
+        sample_size_columnar = []
         for file in tqdm(selected_files):
+            content, is_xml, extra_metadata = self.read_input(file)
+            _, text_content, _ = self.prepare_xml(file, content, is_xml, 0, extra_metadata)
+            sample_words.append(len(text_content.split(" ")))
             start = time.time()
             self.process_file(file)
-            end = time.time()
-            duration = end - start 
-            sample_performance.append((file_metadata[file], duration))
-            sample_size_raw.append((file_metadata[file], sys.getsizeof(self.latest_file)))
-            sample_size_comp.append((file_metadata[file], sys.getsizeof(self.latest_file_comp)))
+            sample_seconds.append(time.time() - start)
+            sample_size_raw.append(self.latest_file_size)
+            sample_size_comp.append(self.latest_file_comp_size)
+            sample_size_columnar.append(self.latest_file_columnar_size)
+
+        # Word counts for every file are predicted from their size in a single call
+        sample_bytes = file_bytes[selected]
+        sample_words = np.array(sample_words, dtype=np.float64)
+        predicted_words = self.linear_estimator(list(zip(sample_bytes, sample_words)), file_bytes)
 
-        seconds_runtime = sum(self.linear_estimator(sample_performance, file_metadata).values())
-        bytes_raw = sum(self.linear_estimator(sample_size_raw, file_metadata).values())
-        bytes_comp = sum(self.linear_estimator(sample_size_comp, file_metadata).values())
+        targets = {'runtime': sample_seconds, 'raw': sample_size_raw, 'compressed': sample_size_comp}
+        if self.output_format in ["columnar", "both"]:
+            targets['columnar'] = sample_size_columnar
+        estimates = {}
+        for name, sample_values in targets.items():
+            point = self.linear_estimator(list(zip(sample_words, sample_values)), predicted_words)
+            low, high = self.bootstrap_total(sample_bytes, sample_words, np.array(sample_values, dtype=np.float64), file_bytes, confidence, bootstrap_samples)
+            estimates[name] = {'total': float(point.sum()), 'largest_file': float(point.max()), 'low': low, 'high': high}
 
-        print(f'Estimated Total Runtime = {humanize.naturaldelta(timedelta(seconds=seconds_runtime))}')
-        print(f'Estimated Processed Corpus Size = {humanize.naturalsize(bytes_raw)} RAW or {humanize.naturalsize(bytes_comp)} Compressed')
+        # A file is never split across workers, so no worker count can finish faster than the largest file
+        CPUs = os.cpu_count() or 1
+        worker_counts = {2 ** power for power in range(CPUs.bit_length())} | {CPUs}
+        if isinstance(self.worker_nodes, int) and self.worker_nodes > 0:
+            worker_counts.add(self.worker_nodes)
+        worker_counts = sorted(worker_counts)
+        runtime = estimates['runtime']
+        estimates['workers'] = {}
+        for workers in worker_counts:
+            estimates['workers'][workers] = {
+                'runtime': max(runtime['total'] / workers, runtime['largest_file']),
+                'runtime_low': max(runtime['low'] / workers, runtime['largest_file']),
+                'runtime_high': max(runtime['high'] / workers, runtime['largest_file']),
+                'raw_per_worker': estimates['raw']['total'] / workers,
+                'compressed_per_worker': estimates['compressed']['total'] / workers}
+        self.estimates = estimates
 
-    def linear_estimator(self, performance_list, file_metadata):
+        def delta(seconds):
+            return humanize.naturaldelta(timedelta(seconds=seconds))
+        level = f"{round(confidence * 100)}% CI"
+        print(f"Estimated Total Runtime = {delta(runtime['total'])} ({level} {delta(runtime['low'])} - {delta(runtime['high'])})")
+        print(f"Estimated Processed Corpus Size = {humanize.naturalsize(estimates['raw']['total'])} RAW or {humanize.naturalsize(estimates['compressed']['total'])} Compressed "
+              f"({level} {humanize.naturalsize(estimates['raw']['low'])} - {humanize.naturalsize(estimates['raw']['high'])} RAW, "
+              f"{humanize.naturalsize(estimates['compressed']['low'])} - {humanize.naturalsize(estimates['compressed']['high'])} Compressed)")
+        if 'columnar' in estimates:
+            print(f"Estimated Columnar Corpus Size = {humanize.naturalsize(estimates['columnar']['total'])} ({level} {humanize.naturalsize(estimates['columnar']['low'])} - {humanize.naturalsize(estimates['columnar']['high'])})")
+        for workers, estimate in estimates['workers'].items():
+            print(f"{workers:>4} Worker(s) = {delta(estimate['runtime'])} ({level} {delta(estimate['runtime_low'])} - {delta(estimate['runtime_high'])}), "
+                  f"{humanize.naturalsize(estimate['raw_per_worker'])} RAW / {humanize.naturalsize(estimate['compressed_per_worker'])} Compressed per Worker")
+        return estimates
+
+    def linear_estimator(self, performance_list, values):
+        import numpy as np
+        from sklearn.linear_model import LinearRegression
         X_train = np.array([data[0] for data in performance_list]).reshape(-1, 1)
         y_train = np.array([data[1] for data in performance_list])
 
         # Train a linear regression model
         model = LinearRegression().fit(X_train, y_train)
 
-        # Use the model to predict runtimes for all files in the corpus
-        predicted_values = {}
-        for file, value in tqdm(file_metadata.items()):
-            predicted_value = model.predict(np.array([[value]]))[0]
-            predicted_values[file] = predicted_value
+        # Use the model to predict values for all files in the corpus in one call
+        return model.predict(np.asarray(values, dtype=np.float64).reshape(-1, 1))
+
+    def bootstrap_total(self, sample_bytes, sample_words, sample_values, file_bytes, confidence, bootstrap_samples):
+        # Resamples the benchmark sample and refits both regressions (bytes -> words, words -> value) in closed form,
+        # the corpus total of a linear model only needs the sum of its inputs, so each resample is O(1) in corpus size
+        import numpy as np
+        rng = np.random.default_rng(0)
+        n = len(sample_bytes)
+        indices = rng.integers(0, n, size=(bootstrap_samples, n))
+
+        def fit(x, y):
+            x_mean = x.mean(axis=1, keepdims=True)
+            y_mean = y.mean(axis=1, keepdims=True)
+            variance = ((x - x_mean) ** 2).sum(axis=1)
+            covariance = ((x - x_mean) * (y - y_mean)).sum(axis=1)
+            slope = np.divide(covariance, variance, out=np.zeros_like(covariance), where=variance > 0)
+            return slope, y_mean[:, 0] - slope * x_mean[:, 0]
+
+        word_slope, word_intercept = fit(sample_bytes[indices], sample_words[indices])
+        value_slope, value_intercept = fit(sample_words[indices], sample_values[indices])
+        total_words = word_slope * file_bytes.sum() + word_intercept * len(file_bytes)
+        totals = value_slope * total_words + value_intercept * len(file_bytes)
+        tail = (1 - confidence) / 2 * 100
+        low, high = np.percentile(totals, [tail, 100 - tail])
+        return max(float(low), 0.0), max(float(high), 0.0)
 
-        return predicted_values
-        
 
+# Multi-Process Workers
+
+_worker_pipeline = None
+
+def _init_worker(pipeline):
+    # Runs once per worker process, models are loaded here rather than per file
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+    # Workers already read in parallel with each other
+    _worker_pipeline.read_processes = 1
+    if _worker_pipeline.manifest is not None:
+        # Workers hand their manifest records to the parent, which is the only process appending to the manifest
+        _worker_pipeline.manifest.buffered = True
+    if _worker_pipeline.telemetry is not None:
+        _worker_pipeline.telemetry.buffered = True
+    if _worker_pipeline.work_queue is not None:
+        # Leases are held and renewed by the parent, workers report the files they finish
+        _worker_pipeline.work_queue.buffered = True
+    if _worker_pipeline.token_index is not None:
+        _worker_pipeline.token_index = tokenIndex(part_file(_worker_pipeline.token_index.index_file), _worker_pipeline.token_index.fields, _worker_pipeline.token_index.journal_mode)
+    if _worker_pipeline.spacy_features and _worker_pipeline.annotation_cache is None:
+        _worker_pipeline.load_models()
+
+def _process_worker(jobs):
+    files = [input_file for _, input_file in jobs]
+    result = {'file': files[0] if len(files) == 1 else ', '.join(files), 'files': files, 'n_files': len(files), 'warnings': [], 'error': None, 'traceback': None}
+    with py_warnings.catch_warnings(record=True) as caught:
+        py_warnings.simplefilter("always")
+        try:
+            if _worker_pipeline.batch_annotation:
+                _worker_pipeline.process_batches(jobs)
+            else:
+                for static_ID, input_file, output_file, document in _worker_pipeline.read_jobs(jobs):
+                    _worker_pipeline.process_document(input_file, output_file, document, static_ID)
+        except Exception as error:
+            result['error'] = f"{type(error).__name__}: {error}"
+            result['traceback'] = traceback.format_exc()
+    result['warnings'] = [str(warning.message) for warning in caught]
+    result['manifest'] = _worker_pipeline.manifest.take_pending() if _worker_pipeline.manifest is not None else []
+    result['telemetry'] = _worker_pipeline.telemetry.take_pending() if _worker_pipeline.telemetry is not None else []
+    result['work_queue'] = _worker_pipeline.work_queue.take_pending() if _worker_pipeline.work_queue is not None else []
+    return result
 
+def package_components(package):
+    # Every component of an installed model package, including those disabled by default, read from its meta without loading it
+    from spacy.util import get_package_path, get_model_meta
+    try:
+        meta = get_model_meta(get_package_path(package))
+    except Exception:
+        return []
+    return meta.get('components', meta.get('pipeline', []))
+
+def doc_columns(doc, names):
+    # Returns {name: list of token values}, strings are resolved per distinct hash rather than per token
+    import numpy
+    from spacy.parts_of_speech import NAMES as pos_names
+    array = doc.to_array([array_attributes[name] for name in names])
+    array = array.reshape(len(doc), len(names))
+    columns = {}
+    for position, name in enumerate(names):
+        column = array[:, position]
+        if name == 'idx':
+            columns[name] = column.tolist()
+        elif name in ['is_alpha', 'is_stop']:
+            columns[name] = column.astype(bool).tolist()
+        elif name == 'pos':
+            columns[name] = [pos_names[value] for value in column.tolist()]
+        else:
+            hashes, inverse = numpy.unique(column, return_inverse=True)
+            strings = [doc.vocab.strings[int(value)] for value in hashes]
+            columns[name] = [strings[index] for index in inverse.tolist()]
+    return columns
+
+def extension_values(doc, name, idxs):
+    # Plain token extensions are read straight from doc.user_data under the key Token._ uses, ("._.", name, token.idx, None)
+    from spacy.tokens import Token
+    default, method, getter, _ = Token.get_extension(name)
+    if getter is not None or method is not None:
+        return [getattr(token._, name) for token in doc]
+    user_data = doc.user_data
+    values = []
+    for idx in idxs:
+        value = user_data.get(("._.", name, idx, None), missing)
+        if value is missing:
+            # Mutable defaults are copied per token as Token._ does
+            value = copy.copy(default) if isinstance(default, (list, dict)) else default
+        values.append(value)
+    return values
+
+missing = object()
+
+# Doc.to_array attribute names, spacy.attrs accepts the names as well as the IDs
+array_attributes = {'text': "ORTH", 'idx': "IDX", 'lemma': "LEMMA", 'pos': "POS", 'tag': "TAG", 'dep': "DEP",
+                    'shape': "SHAPE", 'is_alpha': "IS_ALPHA", 'is_stop': "IS_STOP"}
+
+def read_input_file(input_file, errors="strict"):
+    # Returns (content, is_xml, extra_metadata), EPUBs give their section texts one paragraph apart and their DC metadata
+    file_type = os.path.splitext(input_file)[1].lower()
+    if file_type == ".epub":
+        from CorpusForge.Epub_Reader_Class import read_epub
+        book = read_epub(input_file)
+        return "\n\n".join(book['sections']), False, book['metadata']
+    with open(input_file, errors=errors) as file_read:
+        content = file_read.read()
+    return content, file_type == ".xml", None
+
+def scan_files(directory):
+    # Yields files in the same order as os.walk (each directory's files, then its subdirectories depth first) as they are found
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        subdirs = []
+        try:
+            entries = os.scandir(current)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # os.walk lists linked directories without following them
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                else:
+                    yield entry.path
+        stack.extend(reversed(subdirs))
@@ -0,0 +1,184 @@
+# CASS Stage Pipeline #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# Documents flow between stages as dicts (id, file, text, is_xml, static_ID, output_file, metadata, normalized),
+# every stage is a generator so only the documents in flight are ever held in memory.
+
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+
+class stagePipeline:
+
+    stage_order = ['read', 'extract', 'normalize', 'deduplicate', 'annotate', 'write']
+    default_stages = ['read', 'annotate', 'write']
+
+    def __init__(self, pipeline, stages=['read', 'annotate', 'write'], extraction_processes=1, short_texts="skip", warnings=True):
+        self.pipeline = pipeline
+        self.stages = list(stages)
+        self.extraction_processes = extraction_processes
+        self.short_texts = short_texts
+        self.init_status = pipeline.init_status
+        self.warnings = []
+        self.skipped_short = []
+        self.detector = None
+
+        # Parameter Integrity Checks
+        bad_stages = [stage for stage in self.stages if stage not in self.stage_order]
+        if len(bad_stages) > 0:
+            self.warnings.append(f"Unknown stages: {', '.join(bad_stages)}, available stages: {', '.join(self.stage_order)}")
+            self.init_status = False
+        elif self.stages != sorted(self.stages, key=self.stage_order.index) or len(set(self.stages)) != len(self.stages):
+            self.warnings.append(f"Stages must be given once each in the order {', '.join(self.stage_order)}")
+            self.init_status = False
+        if 'write' in self.stages and 'annotate' not in self.stages:
+            self.warnings.append("The write stage needs the annotate stage")
+            self.init_status = False
+        if not isinstance(extraction_processes, int) or extraction_processes < 1:
+            self.warnings.append(f"Invalid extraction_processes '{extraction_processes}', default to 1")
+            self.extraction_processes = 1
+        if short_texts not in ["skip", "keep"]:
+            self.warnings.append(f"Unknown short_texts '{short_texts}', default to 'skip'")
+            self.short_texts = "skip"
+
+        # Extraction and normalisation change the outputs, a resumed run with other stages redoes its files
+        if self.init_status and pipeline.manifest is not None and self.stages != self.default_stages:
+            pipeline.manifest.update_config(stages=self.stages)
+
+        if len(self.warnings) > 0 and warnings:
+            print("### Stage Warnings Start ###")
+            for index in range(len(self.warnings)):
+                print(f"{index+1}) - {self.warnings[index]}")
+            print("### Stage Warnings End ###")
+
+    def run(self, documents=None):
+        # Returns the generator of the last stage, documents replaces the read stage with in-memory documents
+        if not self.init_status:
+            print("### Initialisation Failed - See Warnings for Details ###")
+            return iter(())
+        if self.pipeline.telemetry is not None:
+            self.pipeline.telemetry.start_summaries()
+        if documents is None:
+            documents = self.read() if 'read' in self.stages else iter(())
+        else:
+            documents = (self.document(document) for document in documents)
+        for stage in self.stages:
+            if stage != 'read':
+                documents = getattr(self, stage)(documents)
+        return documents
+
+    def run_all(self, documents=None):
+        count = 0
+        for _ in self.run(documents):
+            count += 1
+        if len(self.skipped_short) > 0:
+            print(f"### {len(self.skipped_short)} Text(s) Too Short for Body Extraction Skipped ###")
+        if self.detector is not None:
+            self.detector.write_map(self.pipeline.duplicate_map_file())
+            print(f"### {self.detector.n_duplicates()} Duplicate(s) Not Annotated, Listed in '{self.pipeline.duplicate_map_file()}' ###")
+        self.pipeline.close_outputs()
+        self.pipeline.report_file_warnings()
+        return count
+
+    def document(self, fields):
+        # In-memory documents need at least an id and a text
+        document = {'id': None, 'file': None, 'text': None, 'is_xml': False, 'static_ID': None, 'output_file': None}
+        document.update(fields)
+        document['metadata'] = dict(document.get('metadata') or {})
+        return document
+
+    # Stages
+
+    def read(self):
+        pipeline = self.pipeline
+        # EPUBs arrive as their section texts with their DC metadata, read ahead in parallel with read_processes
+        for static_ID, input_file, output_file, (content, is_xml, extra_metadata) in pipeline.read_jobs(tqdm(pipeline.iter_jobs())):
+            yield self.document({'id': input_file, 'file': input_file, 'text': content, 'is_xml': is_xml, 'static_ID': static_ID,
+                                 'output_file': output_file, 'metadata': extra_metadata})
+
+    def extract(self, documents):
+        # Body extraction in a bounded process pool, documents keep their order. The pipeline's normalizer, when set,
+        # replaces the fiction clean up before splitting
+        from CorpusForge.Fict_Body_Extraction_Class import split_document
+        normalizer = self.pipeline.normalizer
+        if self.extraction_processes == 1:
+            for document in documents:
+                result = self.apply_split(document, split_document(document['text'], normalizer) if not document['is_xml'] else None)
+                if result is not None:
+                    yield result
+            return
+        with ProcessPoolExecutor(max_workers=self.extraction_processes) as executor:
+            pending = deque()
+            for document in documents:
+                pending.append((document, executor.submit(split_document, document['text'], normalizer) if not document['is_xml'] else None))
+                if len(pending) >= self.extraction_processes * 2:
+                    result = self.apply_split(*self.collect(pending.popleft()))
+                    if result is not None:
+                        yield result
+            while pending:
+                result = self.apply_split(*self.collect(pending.popleft()))
+                if result is not None:
+                    yield result
+
+    def collect(self, entry):
+        document, future = entry
+        return document, future.result() if future is not None else None
+
+    def apply_split(self, document, row):
+        # XML documents already hold their text in the text node and are passed on unchanged
+        if row is None:
+            return document
+        b_status, e_status, _, main, _ = row
+        if b_status == 'tooshort':
+            if self.short_texts == "skip":
+                self.skipped_short.append(document['id'])
+                return None
+            document['metadata']['b_status'] = b_status
+            return document
+        document['text'] = main
+        document['metadata'].update({'b_status': b_status, 'e_status': e_status})
+        return document
+
+    def normalize(self, documents):
+        # The pipeline's normalizer or the fiction clean up, annotation does not normalise the text again
+        from CorpusForge.Fict_Body_Extraction_Class import fiction_normalizer
+        normalizer = self.pipeline.normalizer if self.pipeline.normalizer is not None else fiction_normalizer
+        for document in documents:
+            if not document['is_xml']:
+                document['text'] = normalizer.normalize(document['text'])
+                document['normalized'] = True
+            yield document
+
+    def deduplicate(self, documents):
+        # Compares the extracted bodies, so differing front and back matter of reissues does not hide them.
+        # Documents stream, a duplicate is only found after its representative has been written, so duplicates are listed in the duplicate map
+        from CorpusForge.Duplicate_Detection_Class import duplicateDetector
+        self.detector = duplicateDetector(self.pipeline.duplicate_threshold)
+        for document in documents:
+            if self.detector.add(document['id'], document['text'], document['is_xml']) is None:
+                yield document
+            elif self.pipeline.telemetry is not None and document['file'] is not None:
+                self.pipeline.telemetry.skip(document['file'])
+
+    def annotate(self, documents):
+        # Annotation is lazy, sentences are produced as the write stage (or the caller) consumes them
+        for document in documents:
+            document['soup'], document['sentences'] = self.pipeline.build_xml(document['id'], document['text'], document['is_xml'], document['static_ID'], document['metadata'],
+                                                                              normalize=not document.get('normalized'))
+            yield document
+
+    def write(self, documents):
+        pipeline = self.pipeline
+        for document in documents:
+            if document['output_file'] is None:
+                document['output_file'] = pipeline.get_text_output_file(document['id'])
+            digests = pipeline.write_output(document.pop('soup'), document.pop('sentences'), document['output_file'])
+            if document['file'] is not None:
+                pipeline.record_output(document['file'], document['output_file'], digests)
+            # The text is released once written, only the document's details are passed on
+            document['text'] = None
+            yield document
@@ -0,0 +1,147 @@
+# CASS Streaming XML Writer #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+
+import os
+import zlib
+import pickle as pkl
+from CorpusForge.Run_Manifest_Class import hashingWriter
+
+
+class streamXMLWriter:
+
+    # Empty element appended to the text node, its position in the prettified skeleton is where sentences are streamed
+    placeholder = "corpusforge_sentence_stream"
+
+    def __init__(self, output_file, compress=False, measure_compressed=False, indent=" ", stream=None):
+        self.output_file = output_file
+        # A binary stream (a shard) replaces the output file, compressed output is then the bare zlib stream
+        self.stream = stream
+        self.compress = compress
+        self.indent = indent
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.sentence_count = 0
+        self.compressor = zlib.compressobj() if compress or measure_compressed else None
+        self.compressed_chunks = []
+        self.file = None
+        # {'hash', 'size'} of the output file once it is closed, for the run manifest
+        self.output_digest = None
+        self.soup = None
+        self.tail = None
+
+    def open(self, soup, text_node):
+        # Matches the layout of the BeautifulSoup pipeline, the text node is moved to the end of the document
+        text_tag = soup.find(text_node)
+        self.placeholder_tag = soup.new_tag(self.placeholder)
+        text_tag.append(self.placeholder_tag)
+        soup.append(text_tag)
+        self.soup = soup
+        if self.stream is not None:
+            return
+        # Written to a partial file that is renamed into place on close, so a killed run never leaves a truncated output
+        self.partial_file = self.output_file + ".part"
+        if not self.compress:
+            self.file = hashingWriter(open(self.partial_file, "wb"))
+
+    def write(self, chunk):
+        encoded = chunk.encode("UTF-8")
+        self.raw_bytes += len(encoded)
+        if self.compressor is not None:
+            compressed = self.compressor.compress(encoded)
+            self.compressed_bytes += len(compressed)
+            if self.compress:
+                if self.stream is not None:
+                    self.stream.write(compressed)
+                else:
+                    self.compressed_chunks.append(compressed)
+        if self.file is not None:
+            self.file.write(encoded)
+        elif self.stream is not None and not self.compress:
+            self.stream.write(encoded)
+
+    def write_head(self):
+        skeleton = self.soup.prettify()
+        marker = f"<{self.placeholder}/>"
+        marker_start = skeleton.index(marker)
+        line_start = skeleton.rindex("\n", 0, marker_start) + 1
+        self.depth = skeleton[line_start:marker_start]
+        self.tail = skeleton[marker_start + len(marker) + 1:]
+        self.write(skeleton[:line_start])
+
+    def write_sentence(self, sentence):
+        if self.tail is None:
+            self.write_head()
+        depth = self.depth
+        word_depth = depth + self.indent
+        text_depth = word_depth + self.indent
+        lines = [depth, "<s>\n"]
+        for text, _, attributes in sentence:
+            lines.append(word_depth)
+            lines.append(self.format_word_tag(attributes))
+            text = escape_text(text).strip()
+            if text:
+                lines.append(text_depth)
+                lines.append(text)
+                lines.append("\n")
+            lines.append(word_depth)
+            lines.append("</w>\n")
+        lines.append(depth)
+        lines.append("</s>\n")
+        self.write("".join(lines))
+        self.sentence_count += 1
+
+    def format_word_tag(self, attributes):
+        # BeautifulSoup's minimal formatter sorts attributes by name
+        parts = ["<w"]
+        for key, value in sorted(attributes.items()):
+            if value is None:
+                parts.append(f" {key}")
+                continue
+            if isinstance(value, (list, tuple)):
+                value = " ".join(value)
+            elif not isinstance(value, str):
+                value = str(value)
+            parts.append(f" {key}={quote_attribute(escape_text(value))}")
+        parts.append(">\n")
+        return "".join(parts)
+
+    def close(self):
+        if self.tail is None:
+            # No sentences, render the document exactly as BeautifulSoup would without the placeholder
+            self.placeholder_tag.extract()
+            self.write(self.soup.prettify())
+        else:
+            self.write(self.tail)
+
+        if self.file is not None:
+            self.file.close()
+            self.output_digest = self.file.record()
+        if self.compressor is not None:
+            compressed = self.compressor.flush()
+            self.compressed_bytes += len(compressed)
+            if self.compress and self.stream is not None:
+                self.stream.write(compressed)
+            elif self.compress:
+                self.compressed_chunks.append(compressed)
+                with open(self.partial_file, "wb") as pkl_write:
+                    pkl_write = hashingWriter(pkl_write)
+                    pkl.dump(b"".join(self.compressed_chunks), pkl_write)
+                self.output_digest = pkl_write.record()
+        if self.stream is None:
+            os.replace(self.partial_file, self.output_file)
+        self.compressed_chunks = []
+        self.soup = None
+
+
+def escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def quote_attribute(value):
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', "&quot;") + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
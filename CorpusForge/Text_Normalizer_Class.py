@@ -0,0 +1,198 @@
+# CASS Text Normalizer #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# Text clean up shared by body extraction and annotation, configured per corpus from presets or a JSON file of rules.
+#   contents lists - runs of five or more short lines after a blank or decorated line, removed from the raw text first
+#   a character table - deletes soft hyphens (with a "-" before them), folds quotes, maps \r \t \f \v to spaces and strips * # ~ markup
+#   collapses - runs of line breaks and runs of spaces
+# Every rule is preceded by a scan that costs no copy, so a text is only copied by the rules that change it. The contents list
+# pattern only runs from the first place a run of five short lines starts. The table is one str.translate for ASCII texts, once a
+# text holds any non-ASCII character translate looks every character up in a dict and replacing each table character present is faster.
+# normalize_stepwise applies the rules one pass each, as body extraction used to, and is kept as the benchmark reference.
+
+
+import re
+import json
+import time
+
+
+contents_list = re.compile(r"[\s\*\#]+\n(.{1,50}\n{1,3}){5,}", re.IGNORECASE)
+# Found wherever contents_list is, its literal start lets the search skip between line breaks
+contents_candidate = re.compile(r"\n(?:[^\n]{1,50}\n{1,3}){5,}")
+line_breaks = re.compile(r"\n{2,}")
+spaces = re.compile(r" {2,}")
+quote_characters = "\u2018\u2019\u201C\u201D\u2039\u203A`\u2022'"
+whitespace_characters = "\r\t\f\v"
+# Characters a streamed chunk may not be cut after, they join up with what follows once normalised
+joining_characters = "*#~-\u00ad"
+CONTENTS_LINE_LENGTH = 50
+
+
+class textNormalizer:
+
+    presets = {'fiction': {'contents_lists': True, 'soft_hyphens': True, 'fold_quotes': True, 'whitespace': True, 'collapse_line_breaks': True, 'collapse_spaces': True},
+               'markup': {'strip_markup': True, 'collapse_spaces': True},
+               'basic': {'soft_hyphens': True, 'whitespace': True, 'collapse_spaces': True}}
+    rules = ['contents_lists', 'soft_hyphens', 'fold_quotes', 'whitespace', 'collapse_line_breaks', 'collapse_spaces', 'strip_markup']
+
+    def __init__(self, contents_lists=True, soft_hyphens=True, fold_quotes=True, whitespace=True, collapse_line_breaks=True,
+                 collapse_spaces=True, strip_markup=False, chunk_size=1048576):
+        self.contents_lists = contents_lists
+        self.soft_hyphens = soft_hyphens
+        self.fold_quotes = fold_quotes
+        self.whitespace = whitespace
+        self.collapse_line_breaks = collapse_line_breaks
+        self.collapse_spaces = collapse_spaces
+        self.strip_markup = strip_markup
+        self.chunk_size = chunk_size
+
+        # Character table, no replacement is itself replaced so the order is free
+        table = {}
+        if soft_hyphens:
+            table["-\u00ad"] = ""
+            table["\u00ad"] = ""
+        if fold_quotes:
+            table.update({character: "'" for character in quote_characters if character != "'"})
+        if whitespace:
+            table.update({character: " " for character in whitespace_characters})
+        if strip_markup:
+            table.update({"*": "", "#": " ", "~": " "})
+        self.table = list(table.items())
+        self.translate_table = {ord(character): replacement for character, replacement in table.items() if len(character) == 1}
+
+    @classmethod
+    def preset(cls, name, **overrides):
+        rules = {rule: False for rule in cls.rules}
+        rules.update(cls.presets[name])
+        rules.update(overrides)
+        return cls(**rules)
+
+    @classmethod
+    def from_config(cls, config):
+        # config is a preset name, a JSON file or a dict of rules, either may start from a preset with "preset"
+        if isinstance(config, textNormalizer):
+            return config
+        if isinstance(config, str):
+            if config in cls.presets:
+                return cls.preset(config)
+            try:
+                with open(config) as config_read:
+                    config = json.load(config_read)
+            except (OSError, ValueError) as error:
+                raise ValueError(f"Normalizer '{config}' is not a preset ({', '.join(cls.presets)}) or a readable JSON file: {error}")
+        if not isinstance(config, dict):
+            raise ValueError(f"Normalizer config is incorrect type '{type(config)}'")
+        config = dict(config)
+        preset = config.pop('preset', None)
+        unknown = [key for key in config if key not in cls.rules + ['chunk_size']]
+        if preset is not None and preset not in cls.presets:
+            unknown.append(f"preset '{preset}'")
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown normalizer rules: {', '.join(unknown)}, available rules: {', '.join(cls.rules)}")
+        return cls.preset(preset, **config) if preset is not None else cls(**config)
+
+    def config(self):
+        return {rule: getattr(self, rule) for rule in self.rules}
+
+    def normalize(self, text):
+        if self.contents_lists:
+            candidate = contents_candidate.search(text)
+            if candidate is not None:
+                # A contents list starts at a candidate or in the run of spaces, * and # just before it
+                start = candidate.start()
+                while start > 0 and (text[start - 1].isspace() or text[start - 1] in "*#"):
+                    start -= 1
+                text = text[:start] + contents_list.sub(" ", text[start:])
+        if text.isascii():
+            if self.translate_table:
+                text = text.translate(self.translate_table)
+        else:
+            for character, replacement in self.table:
+                if character in text:
+                    text = text.replace(character, replacement)
+        if self.collapse_line_breaks and "\n\n" in text:
+            text = line_breaks.sub("\n", text)
+        if self.collapse_spaces and "  " in text:
+            text = spaces.sub(" ", text)
+        return text
+
+    def normalize_stepwise(self, text):
+        # One pass per rule, gives the same text as normalize
+        if self.contents_lists:
+            text = contents_list.sub(" ", text)
+        if self.soft_hyphens:
+            text = text.replace("-\u00ad", "")
+            text = text.replace("\u00ad", "")
+        if self.fold_quotes:
+            text = re.sub(f"[{re.escape(quote_characters)}]", "'", text)
+        if self.whitespace:
+            text = re.sub(r"[\r\t\f\v]", " ", text)
+        if self.strip_markup:
+            text = text.replace("*", "")
+            text = text.replace("#", " ")
+            text = text.replace("~", " ")
+        if self.collapse_line_breaks:
+            text = re.sub(r"\n{2,}", "\n", text)
+        if self.collapse_spaces:
+            text = re.sub(r" {2,}", " ", text)
+        return text
+
+    # Streaming
+
+    def normalize_chunks(self, chunks):
+        # Yields the normalised text of a stream of chunks, joined they are the same as normalize of the whole text.
+        # Chunks are cut after the last line too long to be part of a contents list, so a text without one is held whole
+        pending = ""
+        searched = 0
+        for chunk in chunks:
+            pending += chunk
+            cut = self.safe_cut(pending, searched)
+            if cut == 0:
+                searched = pending.rfind("\n") + 1 if self.contents_lists else 0
+                continue
+            yield self.normalize(pending[:cut])
+            pending = pending[cut:]
+            searched = 0
+        if pending:
+            yield self.normalize(pending)
+
+    def normalize_stream(self, stream):
+        # Reads chunk_size characters at a time from an open text file
+        return self.normalize_chunks(iter(lambda: stream.read(self.chunk_size), ""))
+
+    def safe_cut(self, text, searched=0):
+        # Position text can be cut at without changing the result, 0 when there is none yet.
+        # searched is the start of a line, every complete line before it is known to be short
+        cut = len(text)
+        if self.contents_lists:
+            line_end = text.rfind("\n")
+            while line_end >= searched:
+                line_start = max(text.rfind("\n", searched, line_end) + 1, searched)
+                if line_end - line_start > CONTENTS_LINE_LENGTH:
+                    break
+                line_end = line_start - 1
+            else:
+                return 0
+            cut = line_end
+        while cut > 0 and (text[cut - 1].isspace() or text[cut - 1] in joining_characters):
+            cut -= 1
+        return cut
+
+
+def benchmark_normalizer(normalizer, text, repeats=5):
+    # Median milliseconds per MB of UTF-8 text for the fused passes, the one pass per rule reference and streamed chunks
+    megabytes = len(text.encode("UTF-8")) / 1048576
+    chunks = [text[start:start + normalizer.chunk_size] for start in range(0, len(text), normalizer.chunk_size)]
+    results = {'megabytes': round(megabytes, 3), 'identical': normalizer.normalize(text) == normalizer.normalize_stepwise(text) == "".join(normalizer.normalize_chunks(chunks))}
+    for name, function in [('fused', lambda: normalizer.normalize(text)), ('stepwise', lambda: normalizer.normalize_stepwise(text)),
+                           ('streamed', lambda: "".join(normalizer.normalize_chunks(chunks)))]:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        seconds = sorted(timings)[len(timings) // 2]
+        results[f'{name}_ms_per_mb'] = round(seconds * 1000 / megabytes, 3) if megabytes > 0 else None
+    return results
@@ -0,0 +1,291 @@
+# CASS Token Index #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# SQLite inverted index of annotated output, built while documents are written.
+#   terms (term_id, field, value) - word forms are lower cased, every PyMUSAS tag of a token is its own term
+#   postings (term_id, doc_id, sentence, token) - clustered by term so a query reads only its own postings
+#   sentences (doc_id, sentence, words) - the words of each sentence joined by \x1f, used for concordance context
+#   docs (doc_id, name, n_sentences, n_tokens, live) and facets (doc_id, name, value) from the metadata header
+# A document indexed again replaces its earlier entry, the old one is no longer live.
+# Runs sharing the index through a work queue write part files of their own with a rollback journal, WAL needs every process on one host.
+# Queries are whitespace separated conditions on consecutive tokens, each "field:value" or a bare word form, * matches any characters.
+
+
+import os
+import glob
+import socket
+import sqlite3
+import threading
+from array import array
+
+
+WORD_SEPARATOR = "\x1f"
+INDEX_FIELDS = ['word', 'lemma', 'pos', 'pymusas']
+
+
+class tokenIndex:
+
+    def __init__(self, index_file, fields=['word', 'lemma', 'pos', 'pymusas'], journal_mode="WAL"):
+        self.index_file = index_file
+        self.fields = [field for field in fields if field in INDEX_FIELDS]
+        self.journal_mode = journal_mode
+        self.connection = None
+        self.term_cache = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['term_cache'] = {}
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        if self.connection is None:
+            # Pipelined runs store documents from their writer threads
+            self.connection = sqlite3.connect(self.index_file, timeout=60, check_same_thread=False)
+            self.connection.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS terms (term_id INTEGER PRIMARY KEY, field TEXT, value TEXT, UNIQUE (field, value));
+                CREATE TABLE IF NOT EXISTS postings (term_id INTEGER, doc_id INTEGER, sentence INTEGER, token INTEGER, PRIMARY KEY (term_id, doc_id, sentence, token)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS sentences (doc_id INTEGER, sentence INTEGER, words TEXT, PRIMARY KEY (doc_id, sentence)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS docs (doc_id INTEGER PRIMARY KEY, name TEXT, n_sentences INTEGER, n_tokens INTEGER, live INTEGER);
+                CREATE INDEX IF NOT EXISTS docs_name ON docs (name);
+                CREATE TABLE IF NOT EXISTS facets (doc_id INTEGER, name TEXT, value TEXT);
+                CREATE INDEX IF NOT EXISTS facets_value ON facets (name, value);
+            """)
+            self.connection.commit()
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # Building
+
+    def document(self, name, facets=None):
+        return tokenIndexDocument(self, name, facets or {})
+
+    def term_ID(self, connection, term):
+        term_ID = self.term_cache.get(term)
+        if term_ID is None:
+            connection.execute("INSERT OR IGNORE INTO terms (field, value) VALUES (?, ?)", term)
+            term_ID = connection.execute("SELECT term_id FROM terms WHERE field = ? AND value = ?", term).fetchone()[0]
+            self.term_cache[term] = term_ID
+        return term_ID
+
+    def store(self, document):
+        # One transaction per document, its local term numbers are mapped onto the index's term IDs
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("UPDATE docs SET live = 0 WHERE name = ?", (document.name,))
+                doc_ID = connection.execute("INSERT INTO docs (name, n_sentences, n_tokens, live) VALUES (?, ?, ?, 1)",
+                                            (document.name, len(document.sentences), document.n_tokens)).lastrowid
+                term_IDs = [self.term_ID(connection, term) for term in document.terms]
+                connection.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?, ?, ?)",
+                                       ((term_IDs[term], doc_ID, sentence, token) for term, sentence, token in zip(document.posting_terms, document.posting_sentences, document.posting_tokens)))
+                connection.executemany("INSERT INTO sentences VALUES (?, ?, ?)", ((doc_ID, sentence, words) for sentence, words in enumerate(document.sentences)))
+                connection.executemany("INSERT INTO facets VALUES (?, ?, ?)", ((doc_ID, name, str(value)) for name, value in document.facets.items()))
+
+    def merge(self, index_files, remove=False):
+        # Folds other indexes (other runs or worker part files) into this one, their documents replace any of the same name
+        connection = self.connect()
+        with self.lock:
+            for index_file in index_files:
+                connection.execute("ATTACH DATABASE ? AS other", (index_file,))
+                try:
+                    with connection:
+                        offset = connection.execute("SELECT COALESCE(MAX(doc_id), 0) FROM docs").fetchone()[0]
+                        connection.execute("UPDATE docs SET live = 0 WHERE name IN (SELECT name FROM other.docs WHERE live = 1)")
+                        connection.execute("INSERT OR IGNORE INTO terms (field, value) SELECT field, value FROM other.terms")
+                        connection.execute("INSERT INTO docs SELECT doc_id + ?, name, n_sentences, n_tokens, live FROM other.docs", (offset,))
+                        connection.execute("""INSERT OR IGNORE INTO postings SELECT terms.term_id, posting.doc_id + ?, posting.sentence, posting.token
+                                              FROM other.postings AS posting JOIN other.terms AS other_terms ON other_terms.term_id = posting.term_id
+                                              JOIN terms ON terms.field = other_terms.field AND terms.value = other_terms.value""", (offset,))
+                        connection.execute("INSERT INTO sentences SELECT doc_id + ?, sentence, words FROM other.sentences", (offset,))
+                        connection.execute("INSERT INTO facets SELECT doc_id + ?, name, value FROM other.facets", (offset,))
+                finally:
+                    connection.execute("DETACH DATABASE other")
+                if remove:
+                    for file in [index_file, index_file + "-wal", index_file + "-shm", index_file + "-journal"]:
+                        if os.path.exists(file):
+                            os.remove(file)
+            self.term_cache = {}
+
+    def compact(self):
+        # Drops the entries of replaced documents
+        connection = self.connect()
+        with self.lock, connection:
+            for table in ["postings", "sentences", "facets"]:
+                connection.execute(f"DELETE FROM {table} WHERE doc_id IN (SELECT doc_id FROM docs WHERE live = 0)")
+            connection.execute("DELETE FROM docs WHERE live = 0")
+        connection.execute("VACUUM")
+
+    # Queries
+
+    def parse_query(self, query):
+        conditions = []
+        for item in query.split():
+            field, _, value = item.rpartition(":")
+            field = field or "word"
+            if field not in INDEX_FIELDS:
+                raise ValueError(f"Unknown query field '{field}', available fields: {', '.join(INDEX_FIELDS)}")
+            conditions.append((field, value.lower() if field == "word" else value))
+        if len(conditions) == 0:
+            raise ValueError("Empty query")
+        return conditions
+
+    def term_condition(self, alias, field, value):
+        operator = "GLOB" if "*" in value else "="
+        return f"{alias}.term_id IN (SELECT term_id FROM terms WHERE field = ? AND value {operator} ?)", [field, value]
+
+    def doc_condition(self, facets):
+        sql = "SELECT doc_id FROM docs WHERE live = 1"
+        params = []
+        for name, value in (facets or {}).items():
+            sql += " AND doc_id IN (SELECT doc_id FROM facets WHERE name = ? AND value = ?)"
+            params += [name, str(value)]
+        return sql, params
+
+    def match_query(self, query, facets=None):
+        # Phrases join the postings of each condition on the following token positions
+        conditions = self.parse_query(query)
+        joins = ["postings AS p0"]
+        where = []
+        params = []
+        for position, (field, value) in enumerate(conditions):
+            alias = f"p{position}"
+            if position > 0:
+                joins.append(f"JOIN postings AS {alias} ON {alias}.doc_id = p0.doc_id AND {alias}.sentence = p0.sentence AND {alias}.token = p0.token + {position}")
+            condition, condition_params = self.term_condition(alias, field, value)
+            where.append(condition)
+            params += condition_params
+        doc_sql, doc_params = self.doc_condition(facets)
+        where.append(f"p0.doc_id IN ({doc_sql})")
+        params += doc_params
+        return " ".join(joins), " AND ".join(where), params, len(conditions)
+
+    def matches(self, query, facets=None, limit=None):
+        # Returns (doc_id, sentence, token, length) of each match in document order
+        joins, where, params, length = self.match_query(query, facets)
+        sql = f"SELECT p0.doc_id, p0.sentence, p0.token FROM {joins} WHERE {where} ORDER BY p0.doc_id, p0.sentence, p0.token"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [(doc_ID, sentence, token, length) for doc_ID, sentence, token in self.connect().execute(sql, params)]
+
+    def frequency(self, query, facets=None):
+        joins, where, params, _ = self.match_query(query, facets)
+        return self.connect().execute(f"SELECT COUNT(*) FROM {joins} WHERE {where}", params).fetchone()[0]
+
+    def document_frequency(self, query, facets=None):
+        joins, where, params, _ = self.match_query(query, facets)
+        return self.connect().execute(f"SELECT COUNT(DISTINCT p0.doc_id) FROM {joins} WHERE {where}", params).fetchone()[0]
+
+    def frequencies(self, field, facets=None, limit=20, pattern=None):
+        # Most frequent values of a field, optionally only those matching a * pattern
+        doc_sql, doc_params = self.doc_condition(facets)
+        sql = f"SELECT terms.value, COUNT(*) AS frequency FROM postings JOIN terms ON terms.term_id = postings.term_id WHERE terms.field = ?"
+        params = [field]
+        if pattern is not None:
+            sql += " AND terms.value GLOB ?"
+            params.append(pattern.lower() if field == "word" else pattern)
+        sql += f" AND postings.doc_id IN ({doc_sql}) GROUP BY postings.term_id ORDER BY frequency DESC"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self.connect().execute(sql, params + doc_params).fetchall()
+
+    def concordance(self, query, context=5, limit=100, facets=None):
+        # Keyword in context lines, {'document', 'sentence', 'token', 'left', 'node', 'right'}
+        connection = self.connect()
+        names = {}
+        lines = []
+        for doc_ID, sentence, token, length in self.matches(query, facets, limit):
+            if doc_ID not in names:
+                names[doc_ID] = connection.execute("SELECT name FROM docs WHERE doc_id = ?", (doc_ID,)).fetchone()[0]
+            words = connection.execute("SELECT words FROM sentences WHERE doc_id = ? AND sentence = ?", (doc_ID, sentence)).fetchone()[0].split(WORD_SEPARATOR)
+            lines.append({'document': names[doc_ID], 'sentence': sentence, 'token': token,
+                          'left': " ".join(words[max(0, token - context):token]), 'node': " ".join(words[token:token + length]),
+                          'right': " ".join(words[token + length:token + length + context])})
+        return lines
+
+    def documents(self):
+        return [row[0] for row in self.connect().execute("SELECT name FROM docs WHERE live = 1 ORDER BY name")]
+
+
+class tokenIndexDocument:
+
+    # Collects one document's postings as it is written, stored in the index on close
+    def __init__(self, index, name, facets):
+        self.index = index
+        self.name = name
+        self.facets = facets
+        self.term_numbers = {}
+        self.terms = []
+        self.posting_terms = array('I')
+        self.posting_sentences = array('I')
+        self.posting_tokens = array('I')
+        self.sentences = []
+        self.n_tokens = 0
+
+    def term_number(self, term):
+        number = self.term_numbers.get(term)
+        if number is None:
+            number = len(self.terms)
+            self.term_numbers[term] = number
+            self.terms.append(term)
+        return number
+
+    def add(self, term, sentence, token):
+        self.posting_terms.append(self.term_number(term))
+        self.posting_sentences.append(sentence)
+        self.posting_tokens.append(token)
+
+    def write_sentence(self, sentence):
+        sentence_number = len(self.sentences)
+        fields = self.index.fields
+        index_word = 'word' in fields
+        for token, (text, _, attributes) in enumerate(sentence):
+            if index_word:
+                self.add(('word', text.lower()), sentence_number, token)
+            for field in fields:
+                value = attributes.get(field)
+                if value is None or field == 'word':
+                    continue
+                if isinstance(value, (list, tuple)):
+                    for item in value:
+                        self.add((field, item), sentence_number, token)
+                else:
+                    self.add((field, value), sentence_number, token)
+        self.sentences.append(WORD_SEPARATOR.join(text for text, _, _ in sentence))
+        self.n_tokens += len(sentence)
+
+    def close(self):
+        self.index.store(self)
+        self.sentences = []
+
+
+def part_file(index_file):
+    # Named by host and process, workers on other nodes sharing the index file write parts of their own
+    return f"{index_file}.{socket.gethostname()}.{os.getpid()}.part"
+
+def part_files(index_file):
+    # Index files written by this host's worker processes, merged into index_file once the workers finish
+    return sorted(glob.glob(glob.escape(f"{index_file}.{socket.gethostname()}.") + "*.part"))
+
+def shared_part_files(index_file):
+    # Part files of every host sharing index_file, merged in one step once the work queue is finished
+    return sorted(glob.glob(glob.escape(f"{index_file}.") + "*.part"))
@@ -0,0 +1,47 @@
+# CASS Warning Summary #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+
+class warningSummary:
+
+    # Per-file warnings are counted by category with a few examples, every warning can also be written to a report file
+    def __init__(self, report_file=None, examples=3):
+        self.report_file = report_file
+        self.examples = examples
+        self.counts = {}
+        self.samples = {}
+        self.report = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['report'] = None
+        return state
+
+    def add(self, category, detail):
+        if category not in self.counts:
+            self.counts[category] = 0
+            self.samples[category] = []
+        self.counts[category] += 1
+        if len(self.samples[category]) < self.examples:
+            self.samples[category].append(detail)
+        if self.report_file is not None:
+            if self.report is None:
+                self.report = open(self.report_file, "a")
+            self.report.write(f"{category}: {detail}\n")
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def summary(self):
+        lines = []
+        for category, count in self.counts.items():
+            more = f", ... ({count - len(self.samples[category])} more)" if count > len(self.samples[category]) else ""
+            lines.append(f"{category}: {count} (e.g. {', '.join(self.samples[category])}{more})")
+        return lines
+
+    def close(self):
+        if self.report is not None:
+            self.report.close()
+            self.report = None
@@ -0,0 +1,268 @@
+# CASS Work Queue #
+# Institution: Lancaster University #
+# Author: Samuel Hollands #
+# Contact: shollands1@sheffield.ac.uk #
+
+# A work queue shared by CorpusForge runs on any number of nodes. A coordinator registers the corpus once, each worker claims
+# files under a lease it renews from a heartbeat thread and marks them done once their outputs are written. A lease that is not
+# renewed (its worker died or lost the shared filesystem) expires and the file is queued again, up to max_attempts claims.
+# Completion is fenced by the worker and claim number, a worker whose lease was taken over cannot mark the file done.
+# The queue is an SQLite file on a filesystem every node mounts at the same path, with a rollback journal since WAL needs every
+# process on one host. Lease expiry compares wall clocks across nodes, lease_seconds has to stay well above any clock skew.
+# Indexes shared by the workers are written as part files per host and process, the first worker to find the queue finished merges them.
+
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+from uuid import uuid4
+
+
+class workQueue:
+
+    def __init__(self, queue_file, lease_seconds=300, claim_size=1, max_attempts=3, poll_seconds=None):
+        self.queue_file = queue_file
+        self.lease_seconds = lease_seconds
+        self.claim_size = claim_size
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds if poll_seconds is not None else max(lease_seconds / 10, 1)
+        self.worker = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}"
+        # Worker processes hand the files they finish to the parent, which holds the leases
+        self.buffered = False
+        self.pending = []
+        self.leases = {}
+        self.lost = []
+        self.connection = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.heartbeat_thread = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['connection', 'lock', 'stopping', 'heartbeat_thread']:
+            state[name] = None
+        state['pending'] = []
+        state['leases'] = {}
+        state['lost'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        if self.connection is None:
+            # Transactions are opened explicitly, claims take the write lock before reading so two workers never claim one file
+            self.connection = sqlite3.connect(self.queue_file, timeout=60, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=DELETE")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS work (file TEXT PRIMARY KEY, static_id INTEGER, bytes INTEGER, state TEXT, worker TEXT, "
+                                    "expires REAL, attempts INTEGER DEFAULT 0, error TEXT, updated REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS work_state ON work (state, static_id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, host TEXT, pid INTEGER, started REAL, heartbeat REAL, files INTEGER DEFAULT 0)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS merges (merged INTEGER PRIMARY KEY, worker TEXT, time REAL)")
+        return self.connection
+
+    # Coordinator
+
+    def register(self, jobs):
+        # jobs are (static_ID, file) pairs, files already in the queue keep their state so the corpus can be registered again as it grows
+        connection = self.connect()
+        now = time.time()
+        with self.lock:
+            before = connection.total_changes
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany("INSERT OR IGNORE INTO work (file, static_id, bytes, state, updated) VALUES (?, ?, ?, 'queued', ?)",
+                                       ((file, static_ID, os.path.getsize(file), now) for static_ID, file in jobs))
+                if connection.total_changes > before:
+                    # New files make new parts, they are merged again once the queue is finished
+                    connection.execute("DELETE FROM merges")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            return connection.total_changes - before
+
+    def retry_failed(self):
+        with self.lock:
+            connection = self.connect()
+            retried = connection.execute("UPDATE work SET state = 'queued', attempts = 0, error = NULL, updated = ? WHERE state = 'failed'", (time.time(),)).rowcount
+            if retried > 0:
+                connection.execute("DELETE FROM merges")
+            return retried
+
+    def status(self):
+        connection = self.connect()
+        now = time.time()
+        with self.lock:
+            states = dict(connection.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall())
+            remaining_bytes = connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM work WHERE state IN ('queued', 'leased')").fetchone()[0]
+            expired = connection.execute("SELECT COUNT(*) FROM work WHERE state = 'leased' AND expires < ?", (now,)).fetchone()[0]
+            workers = connection.execute("SELECT worker, host, pid, files, heartbeat FROM workers WHERE heartbeat >= ? ORDER BY worker", (now - self.lease_seconds,)).fetchall()
+            failed = connection.execute("SELECT file, error FROM work WHERE state = 'failed' ORDER BY static_id").fetchall()
+        return {'states': {state: states.get(state, 0) for state in ['queued', 'leased', 'done', 'failed']}, 'expired_leases': expired,
+                'remaining_bytes': remaining_bytes, 'failed': [{'file': file, 'error': error} for file, error in failed],
+                'workers': [{'worker': worker, 'host': host, 'pid': pid, 'files': files, 'seconds_since_heartbeat': round(now - heartbeat, 1)}
+                            for worker, host, pid, files, heartbeat in workers]}
+
+    # Worker
+
+    def claim(self, n=1):
+        # Returns up to n (static_ID, file) pairs now leased to this worker, expired leases are queued again first
+        connection = self.connect()
+        now = time.time()
+        with self.lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("UPDATE work SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, worker = NULL, expires = NULL, "
+                                   "error = CASE WHEN attempts >= ? THEN 'Lease expired on every attempt' ELSE error END, updated = ? "
+                                   "WHERE state = 'leased' AND expires < ?", (self.max_attempts, self.max_attempts, now, now))
+                claimed = connection.execute("SELECT file, static_id, attempts + 1 FROM work WHERE state = 'queued' ORDER BY static_id LIMIT ?", (n,)).fetchall()
+                connection.executemany("UPDATE work SET state = 'leased', worker = ?, expires = ?, attempts = attempts + 1, updated = ? WHERE file = ?",
+                                       ((self.worker, now + self.lease_seconds, now, file) for file, _, _ in claimed))
+                connection.execute("INSERT INTO workers (worker, host, pid, started, heartbeat) VALUES (?, ?, ?, ?, ?) ON CONFLICT (worker) DO UPDATE SET heartbeat = excluded.heartbeat",
+                                   (self.worker, socket.gethostname(), os.getpid(), now, now))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            for file, _, attempt in claimed:
+                self.leases[file] = attempt
+        if len(claimed) > 0:
+            self.start_heartbeat()
+        return [(static_ID, file) for file, static_ID, _ in claimed]
+
+    def jobs(self):
+        # Claims files until none are left to claim, files leased by live workers elsewhere are left to them
+        while True:
+            claimed = self.claim(self.claim_size)
+            if len(claimed) == 0:
+                return
+            for job in claimed:
+                yield job
+
+    def wait_for_work(self):
+        # Called once this worker holds no leases, waits while other workers hold leases that may still expire.
+        # True once there is a file to claim, False when every file is done or failed
+        connection = self.connect()
+        while True:
+            with self.lock:
+                waiting, leased = connection.execute("SELECT SUM(state = 'queued' OR (state = 'leased' AND expires < ?)), SUM(state = 'leased') FROM work",
+                                                     (time.time(),)).fetchone()
+            if waiting:
+                return True
+            if not leased:
+                return False
+            time.sleep(self.poll_seconds)
+
+    def claim_merge(self):
+        # True for the one worker that merges the part files, once every file is done or failed
+        connection = self.connect()
+        with self.lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                unfinished = connection.execute("SELECT COUNT(*) FROM work WHERE state IN ('queued', 'leased')").fetchone()[0]
+                claimed = 0
+                if unfinished == 0:
+                    claimed = connection.execute("INSERT OR IGNORE INTO merges VALUES (1, ?, ?)", (self.worker, time.time())).rowcount
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return claimed == 1
+
+    def holds(self, file):
+        return file in self.leases
+
+    def complete(self, file):
+        if self.buffered:
+            self.pending.append((file, None))
+            return
+        self.finish(file, "done")
+
+    def fail(self, file, error):
+        if self.buffered:
+            self.pending.append((file, error))
+            return
+        self.finish(file, "failed", error)
+
+    def finish(self, file, state, error=None):
+        with self.lock:
+            attempt = self.leases.pop(file, None)
+            if attempt is None:
+                return
+            connection = self.connect()
+            if state == "done":
+                updated = connection.execute("UPDATE work SET state = 'done', expires = NULL, error = NULL, updated = ? WHERE file = ? AND worker = ? AND attempts = ? AND state = 'leased'",
+                                             (time.time(), file, self.worker, attempt)).rowcount
+                connection.execute("UPDATE workers SET files = files + 1 WHERE worker = ?", (self.worker,))
+            else:
+                # A failed file is queued again for another worker until it has been claimed max_attempts times
+                updated = connection.execute("UPDATE work SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, worker = NULL, expires = NULL, error = ?, updated = ? "
+                                             "WHERE file = ? AND worker = ? AND attempts = ? AND state = 'leased'",
+                                             (self.max_attempts, error, time.time(), file, self.worker, attempt)).rowcount
+            if updated == 0:
+                # The lease expired and the file was handed to another worker, its outputs are written atomically by whichever finishes last
+                self.lost.append(file)
+
+    def append(self, records):
+        for file, error in records:
+            if error is None:
+                self.finish(file, "done")
+            else:
+                self.finish(file, "failed", error)
+
+    def take_pending(self):
+        records, self.pending = self.pending, []
+        return records
+
+    # Heartbeat
+
+    def start_heartbeat(self):
+        if self.heartbeat_thread is None or not self.heartbeat_thread.is_alive():
+            self.stopping.clear()
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
+            self.heartbeat_thread.start()
+
+    def heartbeat_loop(self):
+        # Leases are renewed three times per lease period, a missed renewal or two does not lose them
+        while not self.stopping.wait(self.lease_seconds / 3):
+            self.heartbeat()
+
+    def heartbeat(self):
+        now = time.time()
+        with self.lock:
+            if len(self.leases) == 0:
+                return
+            connection = self.connect()
+            try:
+                connection.execute("UPDATE work SET expires = ? WHERE worker = ? AND state = 'leased'", (now + self.lease_seconds, self.worker))
+                connection.execute("UPDATE workers SET heartbeat = ? WHERE worker = ?", (now, self.worker))
+            except sqlite3.OperationalError:
+                # A busy or briefly unreachable queue is retried at the next beat
+                pass
+
+    def release(self):
+        # Leases still held when a run stops are given back, counting as an attempt in case the file is what stopped the run
+        for file in list(self.leases):
+            self.finish(file, "failed", "Released by a stopped worker")
+
+    def close(self):
+        if self.stopping is not None:
+            self.stopping.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        if self.connection is not None:
+            self.release()
+            self.connection.close()
+            self.connection = None
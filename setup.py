@@ -43,6 +43,7 @@ setup(
                       'tqdm',
                       'bs4',
                       'lxml',
+                      'ebooklib',
                       'scikit-learn'],
     setup_requires=[
         'spacy',
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from CorpusForge.Columnar_Output_Class import columnarWriter, columnarReader
+
+
+SENTENCES = [
+    [("Tom", 0, {'lemma': "Tom", 'pos': "PROPN", 'is_stop': False, 'pymusas': ["Z1mf", "Z3c"]}),
+     ("ran", 4, {'lemma': "run", 'pos': "VERB", 'is_stop': False, 'pymusas': ["M1"]})],
+    [("It", 9, {'lemma': "it", 'pos': "PRON", 'is_stop': True, 'pymusas': ["Z8"]}),
+     ("rained", 12, {'lemma': "rain", 'pos': "VERB", 'is_stop': False, 'pymusas': ["W4"], 'dep': "ROOT"}),
+     ("é", 2 ** 40, {'lemma': "é", 'pos': "X", 'is_stop': False, 'pymusas': ["Z99"], 'dep': "punct"}),
+     ("!", 2 ** 40 + 2, {'lemma': "!", 'is_stop': False, 'pymusas': ["Z99"], 'dep': "punct"})],
+]
+
+
+def write(output_file, stream=None):
+    writer = columnarWriter(output_file, stream=stream)
+    writer.open({'ID': "doc0", 'year': np.int64(1900)})
+    for sentence in SENTENCES:
+        writer.write_sentence(sentence)
+    writer.close()
+    return writer
+
+
+def test_round_trip(tmp_path):
+    output_file = str(tmp_path / "doc0.cfc")
+    writer = write(output_file)
+    assert writer.output_digest['size'] == writer.file_size
+    with columnarReader(output_file) as reader:
+        assert reader.metadata == {'ID': "doc0", 'year': 1900}
+        assert (reader.n_tokens, len(reader)) == (6, 2)
+        first = reader.sentence(0)
+        assert first['word'] == ["Tom", "ran"]
+        assert first['pymusas'] == ["Z1mf Z3c", "M1"]
+        second = reader.sentence(1, columns=['word', 'offset', 'is_stop', 'dep'])
+        assert second == {'word': ["It", "rained", "é", "!"], 'offset': [9, 12, 2 ** 40, 2 ** 40 + 2], 'is_stop': [True, False, False, False],
+                          'dep': ["", "ROOT", "punct", "punct"]}
+        # A column first seen part way through is back filled for the earlier tokens
+        assert reader.column('dep', decode=True)[:2] == ["", ""]
+        assert reader.column('is_stop').tolist() == [0, 0, 1, 0, 0, 0]
+        assert reader.sentence(1, columns=['pos'])['pos'] == ["PRON", "VERB", "X", ""]
+        with pytest.raises(KeyError):
+            reader.column('tag')
+
+
+def test_read_from_offset_within_a_file(tmp_path):
+    shard_file = str(tmp_path / "shard.bin")
+    with open(shard_file, "wb") as shard_write:
+        shard_write.write(b"\0" * 24)
+        write(None, stream=shard_write)
+    with columnarReader(shard_file, offset=24) as reader:
+        assert reader.sentence(1)['lemma'] == ["it", "rain", "é", "!"]
+    with pytest.raises(ValueError):
+        columnarReader(shard_file)
@@ -0,0 +1,63 @@
+import json
+import math
+from CorpusForge.Metadata_Index_Class import metadataIndex
+from CorpusForge.SpaCy_Pipeline_Class import spacyPipeline
+
+
+METADATA = """ID,title,year,flag,score,count,gappy_flag,other_id
+doc0,First,1900,True,1.5,3,True,a0
+doc1,Second,1901,False,,4,,a1
+doc2,Third,1902,True,2.25,,False,a2
+doc3,Fourth,1903,False,3.0,6,True,a3
+doc4,Fifth,1904,True,,7,False,a4
+"""
+
+
+def make_corpus(directory):
+    (directory / "data").mkdir()
+    for index in range(5):
+        (directory / "data" / f"doc{index}.txt").write_text(f"Document {index} has a sentence.")
+    (directory / "metadata").mkdir()
+    (directory / "metadata" / "metadata.csv").write_text(METADATA)
+
+
+def comparable(row):
+    return json.dumps(row, sort_keys=True)
+
+
+def test_sqlite_rows_match_memory_rows(tmp_path):
+    make_corpus(tmp_path)
+    metadata_file = str(tmp_path / "metadata" / "metadata.csv")
+    memory = metadataIndex(metadata_file)
+    # Chunks of two rows, so columns that only have gaps in some chunks are read with different dtypes per chunk
+    sqlite = metadataIndex(metadata_file, backend="sqlite", chunksize=2)
+    assert memory.ids == sqlite.ids
+    for key in sorted(memory.ids):
+        assert comparable(memory.get_row(key)) == comparable(sqlite.get_row(key))
+        assert [type(value) for value in memory.get_row(key).values()] == [type(value) for value in sqlite.get_row(key).values()]
+
+
+def test_headers_match_between_backends(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_corpus(tmp_path)
+    headers = {}
+    for backend in ["memory", "sqlite"]:
+        pipeline = spacyPipeline(output_dir=f"output_{backend}", create_output_folder=True, warnings=False, metadata_backend=backend)
+        assert pipeline.init_status
+        headers[backend] = []
+        for index in range(5):
+            input_file = f"data/doc{index}.txt"
+            soup, _, _ = pipeline.prepare_xml(input_file, open(input_file).read(), False, index)
+            headers[backend].append((str(soup), comparable(soup.find(pipeline.xml_metadata_node).attrs)))
+    assert headers["memory"] == headers["sqlite"]
+    assert 'flag="True"' in headers["sqlite"][0][0]
+
+
+def test_sqlite_cache_rebuilt_for_new_id_column(tmp_path):
+    make_corpus(tmp_path)
+    metadata_file = str(tmp_path / "metadata" / "metadata.csv")
+    assert metadataIndex(metadata_file, backend="sqlite").get_row("doc0")['title'] == "First"
+    switched = metadataIndex(metadata_file, id_column="other_id", backend="sqlite")
+    assert switched.ids == {"a0", "a1", "a2", "a3", "a4"}
+    assert switched.get_row("a1")['title'] == "Second"
+    assert math.isnan(switched.get_row("a1")['score'])
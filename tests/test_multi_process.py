@@ -0,0 +1,66 @@
+import os
+import multiprocessing
+
+import pytest
+
+import CorpusForge.SpaCy_Pipeline_Class as spacy_pipeline
+from CorpusForge.Run_Manifest_Class import runManifest
+from CorpusForge.SpaCy_Pipeline_Class import spacyPipeline
+
+
+def make_nested_data(directory, n_directories, n_files):
+    for directory_index in range(n_directories):
+        sub_directory = directory / "data" / f"part{directory_index}" / "chapters"
+        sub_directory.mkdir(parents=True)
+        for file_index in range(n_files):
+            (sub_directory / f"doc{file_index}.txt").write_text(f"Text {file_index} of part {directory_index}.")
+
+
+def output_files(output_dir):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(output_dir) for name in names if not name.startswith("."))
+
+
+def test_workers_write_every_file_of_a_nested_corpus(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_nested_data(tmp_path, 200, 4)
+    pipeline = spacyPipeline(output_dir="output", create_output_folder=True, file_type="txt", metadata=False, warnings=False,
+                             spacy_features=False, multi_process=True, worker_nodes=8)
+    assert pipeline.init_status
+    pipeline.job_handler()
+    written = output_files("output")
+    assert len(written) == 800
+    assert os.path.join("output", "part199", "chapters", "doc3.xml") in written
+
+
+process_worker = spacy_pipeline._process_worker
+
+
+def dying_worker(group):
+    # The first worker given part2/chapters/doc1.txt dies without returning, as one killed by the OOM killer would
+    if any(input_file.endswith(os.path.join("part2", "chapters", "doc1.txt")) for _, input_file in group) and not os.path.exists("died"):
+        open("died", "w").close()
+        os._exit(1)
+    return process_worker(group)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="the dying worker is patched in before the pool forks")
+def test_run_continues_after_a_worker_dies(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_nested_data(tmp_path, 4, 4)
+    monkeypatch.setattr(spacy_pipeline, "_process_worker", dying_worker)
+
+    settings = dict(output_dir="output", file_type=".txt", metadata=False, warnings=False, spacy_features=False, multi_process=True, worker_nodes=2)
+    pipeline = spacyPipeline(create_output_folder=True, **settings)
+    pipeline.job_handler()
+    manifest = runManifest("output", pipeline.manifest.config)
+    failed = sorted(input_file for input_file, record in manifest.records.items() if 'error' in record)
+    assert os.path.join("data", "part2", "chapters", "doc1.txt") in failed
+    assert len(manifest.records) == 16
+    assert len(output_files("output")) == 16 - len(failed)
+    assert any("BrokenProcessPool" in str(warning) for warning in pipeline.warnings)
+
+    # Resume processes the files lost with the worker
+    spacyPipeline(resume=True, use_nonempty_output_folder=True, **settings).job_handler()
+    assert len(output_files("output")) == 16
+    manifest = runManifest("output", pipeline.manifest.config)
+    assert not any('error' in record for record in manifest.records.values())
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from CorpusForge.Pipelined_Executor_Class import pipelinedExecutor, STREAM_BATCH_TOKENS
+
+
+class slowPipeline:
+
+    # Stands in for spacyPipeline, its writer is slower than annotation so sentences pile up for it
+    def __init__(self):
+        self.telemetry = None
+        self.shard_writer = None
+        self.pipelined_executor = None
+        self.written = {}
+        self.recorded = []
+        self.executor = None
+        self.peak_tokens = 0
+
+    def write_output(self, soup, sentences, output_file):
+        tokens = []
+        for sentence in sentences:
+            self.peak_tokens = max(self.peak_tokens, self.executor.held_tokens)
+            time.sleep(0.0002)
+            tokens.extend(sentence)
+        self.written[output_file] = tokens
+        return {}
+
+    def record_output(self, input_file, output_file, digests={}):
+        self.recorded.append(input_file)
+
+
+def sentences(n_sentences, words=10):
+    for index in range(n_sentences):
+        yield [f"word{index}"] * words
+
+
+def test_tokens_waiting_for_writers_stay_within_budget():
+    pipeline = slowPipeline()
+    with pipelinedExecutor(pipeline, writer_threads=2, write_queue_size=4, write_queue_tokens=5000) as executor:
+        pipeline.executor = executor
+        for index in range(3):
+            executor.submit(None, sentences(2000), f"doc{index}.txt", f"doc{index}.xml")
+    assert sorted(pipeline.recorded) == ["doc0.txt", "doc1.txt", "doc2.txt"]
+    assert all(len(tokens) == 20000 for tokens in pipeline.written.values())
+    assert pipeline.written["doc1.xml"][-1] == "word1999"
+    assert 0 < pipeline.peak_tokens <= 5000 + STREAM_BATCH_TOKENS
+    assert pipeline.pipelined_executor is None
+
+
+def test_annotation_error_is_not_recorded():
+    def failing():
+        yield from sentences(500)
+        raise ValueError("model failed")
+
+    pipeline = slowPipeline()
+    with pytest.raises(ValueError):
+        with pipelinedExecutor(pipeline, write_queue_tokens=1000) as executor:
+            pipeline.executor = executor
+            executor.submit(None, failing(), "doc0.txt", "doc0.xml")
+    assert pipeline.recorded == []
@@ -0,0 +1,30 @@
+from CorpusForge.SpaCy_Pipeline_Class import spacyPipeline
+
+
+def make_data(directory):
+    (directory / "data").mkdir()
+    (directory / "data" / "doc0.txt").write_text("A sentence to annotate.")
+
+
+def manifest_hash(output_dir, **kwargs):
+    pipeline = spacyPipeline(output_dir=output_dir, create_output_folder=True, use_nonempty_output_folder=True,
+                             metadata=False, warnings=False, **kwargs)
+    assert pipeline.init_status
+    return pipeline.manifest.config_hash
+
+
+def test_normalize_changes_config_hash(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_data(tmp_path)
+    plain = manifest_hash("output")
+    fiction = manifest_hash("output", normalize="fiction")
+    basic = manifest_hash("output", normalize="basic")
+    assert len({plain, fiction, basic}) == 3
+    assert manifest_hash("output", normalize="fiction") == fiction
+
+
+def test_manifest_records_normalizer_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_data(tmp_path)
+    pipeline = spacyPipeline(output_dir="output", create_output_folder=True, metadata=False, warnings=False, normalize="basic")
+    assert pipeline.manifest.config['normalize'] == pipeline.normalizer.config()
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+import CorpusForge.Run_Manifest_Class as run_manifest
+from CorpusForge.Run_Manifest_Class import runManifest, file_hash
+from CorpusForge.SpaCy_Pipeline_Class import spacyPipeline
+
+
+def test_failed_file_is_processed_again(tmp_path):
+    input_file = tmp_path / "doc0.txt"
+    input_file.write_text("A sentence to annotate.")
+    output_file = tmp_path / "doc0.xml"
+    output_file.write_text("<doc/>")
+    manifest = runManifest(str(tmp_path), {'attributes': ['lemma']})
+    manifest.add(str(input_file), [str(output_file)])
+    assert manifest.needs_processing(str(input_file), [str(output_file)]) is None
+    # A worker that died leaves a failure after the completion, it must not count as done on resume
+    manifest.fail(str(input_file), "BrokenProcessPool")
+    reloaded = runManifest(str(tmp_path), {'attributes': ['lemma']})
+    assert reloaded.needs_processing(str(input_file), [str(output_file)]) == "failed"
+    reloaded.add(str(input_file), [str(output_file)])
+    assert runManifest(str(tmp_path), {'attributes': ['lemma']}).needs_processing(str(input_file), [str(output_file)]) is None
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_outputs_hashed_as_written(tmp_path, monkeypatch, compress):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data" / "sub").mkdir(parents=True)
+    for index in range(3):
+        (tmp_path / "data" / "sub" / f"doc{index}.txt").write_text(f"Text {index} to keep.")
+    pipeline = spacyPipeline(output_dir="output", create_output_folder=True, file_type=".txt", metadata=False, warnings=False,
+                             spacy_features=False, output_format="both", compress=compress)
+
+    def no_reads(file):
+        raise AssertionError(f"'{file}' read back to be hashed")
+    # Neither the outputs nor the inputs are read again to record them
+    with monkeypatch.context() as patched:
+        patched.setattr(run_manifest, "file_hash", no_reads)
+        pipeline.job_handler()
+
+    manifest = runManifest("output", pipeline.manifest.config)
+    assert len(manifest.records) == 3
+    for input_file, record in manifest.records.items():
+        assert len(record['outputs']) == 2
+        for output_file, digest in record['outputs'].items():
+            assert digest == {'hash': file_hash(output_file), 'size': os.path.getsize(output_file)}
+        assert manifest.needs_processing(input_file, sorted(record['outputs'])) is None
@@ -0,0 +1,37 @@
+import json
+import time
+
+from CorpusForge.Run_Telemetry_Class import runTelemetry, PYMUSAS_COMPONENT
+
+
+def read_records(metrics_file):
+    with open(metrics_file) as metrics_read:
+        return [json.loads(line) for line in metrics_read]
+
+
+def test_summaries_written_while_a_document_is_in_progress(tmp_path):
+    metrics_file = str(tmp_path / "metrics.jsonl")
+    telemetry = runTelemetry(metrics_file, interval=0.05)
+    telemetry.start_summaries()
+    telemetry.start("doc0")
+    time.sleep(0.3)
+    records = read_records(metrics_file)
+    telemetry.close()
+    assert len(records) > 0
+    assert all(record['type'] == "summary" for record in records)
+
+
+def test_annotate_is_net_of_nested_components(tmp_path):
+    metrics_file = str(tmp_path / "metrics.jsonl")
+    telemetry = runTelemetry(metrics_file)
+    telemetry.start("doc0")
+    telemetry.component("tokenizer", 0.5)
+    telemetry.component(PYMUSAS_COMPONENT, 0.25)
+    telemetry.add("doc0", "annotate", 1.0)
+    telemetry.take_components("doc0")
+    telemetry.finish("doc0", 10, 1)
+    telemetry.close()
+    stages = [record for record in read_records(metrics_file) if record['type'] == "file"][0]['stages']
+    assert stages == {'annotate': 0.25, 'nlp': 0.5, 'pymusas': 0.25}
+    summary = [record for record in read_records(metrics_file) if record['type'] == "summary"][-1]
+    assert sum(summary['stages'].values()) == 1.0
@@ -0,0 +1,78 @@
+import os
+import zlib
+
+from CorpusForge.Shard_Output_Class import shardWriter, shardReader
+
+
+def write_record(writer, doc_id, kind, payload, compressed=False):
+    stream = writer.begin(doc_id, kind, compressed)
+    stream.write(zlib.compress(payload) if compressed else payload)
+    writer.commit(doc_id, kind, compressed)
+
+
+def shard_files(output_dir):
+    return sorted(name for name in os.listdir(output_dir) if name.endswith(".cfs"))
+
+
+def test_records_read_back_by_index_and_by_framing(tmp_path):
+    output_dir = str(tmp_path)
+    writer = shardWriter(output_dir)
+    # Small shards so the documents roll over onto a second shard
+    writer.max_bytes = 200
+    documents = {f"sub/doc{index}": f"<text>Document {index} {'word ' * index * 10}</text>".encode("UTF-8") for index in range(6)}
+    for index, (doc_id, payload) in enumerate(documents.items()):
+        write_record(writer, doc_id, "xml", payload, compressed=index % 2 == 1)
+    write_record(writer, "sub/doc0", "cfc", b"CFCOL\x00\x01\x00columns")
+    writer.close()
+    assert len(shard_files(output_dir)) > 1
+
+    with shardReader(output_dir) as reader:
+        assert len(reader) == 6
+        assert reader.ids() == sorted(documents)
+        assert "sub/doc3" in reader and "sub/doc9" not in reader
+        for doc_id, payload in documents.items():
+            assert reader.get(doc_id) == payload.decode("UTF-8")
+        assert reader.read("sub/doc0", "cfc") == b"CFCOL\x00\x01\x00columns"
+        # Walking the record headers finds every record the index holds, payloads aligned to 8 bytes
+        walked = {}
+        for shard in shard_files(output_dir):
+            for doc_id, kind, compressed, offset, length in reader.records(shard):
+                assert offset % 8 == 0
+                walked[(doc_id, kind)] = (shard, offset, length, int(compressed))
+        keys = [(doc_id, "xml") for doc_id in documents] + [("sub/doc0", "cfc")]
+        assert walked == {(doc_id, kind): reader.locate(doc_id, kind) for doc_id, kind in keys}
+
+
+def test_partial_record_truncated_when_shard_reopened(tmp_path):
+    output_dir = str(tmp_path)
+    writer = shardWriter(output_dir)
+    write_record(writer, "doc0", "xml", b"<text>kept</text>")
+    indexed_end = writer.file.tell()
+    # A run killed part way through a document leaves an unindexed record at the end of its shard
+    writer.begin("doc1", "xml").write(b"<text>partial")
+    writer.close()
+    shard = shard_files(output_dir)[0]
+    assert os.path.getsize(os.path.join(output_dir, shard)) > indexed_end
+
+    writer = shardWriter(output_dir)
+    write_record(writer, "doc2", "xml", b"<text>after restart</text>")
+    writer.close()
+    assert shard_files(output_dir) == [shard]
+    with shardReader(output_dir) as reader:
+        assert [doc_id for doc_id, *_ in reader.records(shard)] == ["doc0", "doc2"]
+        assert reader.get("doc2") == "<text>after restart</text>"
+        assert "doc1" not in reader
+
+
+def test_aborted_document_leaves_nothing(tmp_path):
+    output_dir = str(tmp_path)
+    writer = shardWriter(output_dir)
+    write_record(writer, "doc0", "xml", b"<text>kept</text>")
+    size = writer.file.tell()
+    writer.begin("doc1", "xml").write(b"<text>failed")
+    writer.abort()
+    write_record(writer, "doc2", "xml", b"<text>next</text>")
+    writer.close()
+    with shardReader(output_dir) as reader:
+        assert [doc_id for doc_id, *_ in reader.records(shard_files(output_dir)[0])] == ["doc0", "doc2"]
+        assert reader.locate("doc2", "xml")[1] > size
@@ -0,0 +1,54 @@
+import pickle
+import zlib
+
+import pytest
+from bs4 import BeautifulSoup as bs4
+
+from CorpusForge.Stream_XML_Writer_Class import streamXMLWriter
+
+
+DOCUMENT = '<TEI><teiHeader><title>A &amp; B</title></teiHeader><text author="O\'Brien" year="1900"/></TEI>'
+
+SENTENCES = [
+    [("Tom", 0, {'lemma': "Tom", 'pos': "PROPN", 'is_alpha': True, 'is_stop': False, 'pymusas': ["Z1mf", "Z3c"]}),
+     ("&", 4, {'lemma': "&", 'pos': "CCONJ", 'is_alpha': False, 'is_stop': False, 'pymusas': ["Z5"]}),
+     ("<Jerry>", 6, {'lemma': 'say "hi"', 'pos': "PROPN", 'is_alpha': False, 'is_stop': False, 'pymusas': ["Z99"]})],
+    [("  ", 14, {'lemma': "  ", 'pos': "SPACE", 'is_alpha': False, 'is_stop': False, 'pymusas': ["Z99"]}),
+     ("it's", 16, {'lemma': "it's", 'pos': "PRON", 'is_alpha': False, 'is_stop': True, 'pymusas': ["Z8"]})],
+]
+
+
+def prettified(sentences):
+    # The document as the BeautifulSoup pipeline built it, tag by tag
+    soup = bs4(DOCUMENT, features="xml")
+    main_tag = soup.find("text")
+    for sentence in sentences:
+        sentence_tag = soup.new_tag("s")
+        for text, _, attributes in sentence:
+            word_tag = soup.new_tag("w")
+            word_tag.string = text
+            word_tag.attrs.update(attributes)
+            sentence_tag.append(word_tag)
+        main_tag.append(sentence_tag)
+    soup.append(main_tag)
+    return soup.prettify()
+
+
+def streamed(tmp_path, sentences, compress=False):
+    output_file = str(tmp_path / ("doc.pkl" if compress else "doc.xml"))
+    writer = streamXMLWriter(output_file, compress=compress)
+    writer.open(bs4(DOCUMENT, features="xml"), "text")
+    for sentence in sentences:
+        writer.write_sentence(sentence)
+    writer.close()
+    with open(output_file, "rb") as output_read:
+        return output_read.read()
+
+
+@pytest.mark.parametrize("sentences", [SENTENCES, []])
+def test_streamed_output_matches_prettify(tmp_path, sentences):
+    assert streamed(tmp_path, sentences) == prettified(sentences).encode("UTF-8")
+
+
+def test_compressed_output_matches_prettify(tmp_path):
+    assert zlib.decompress(pickle.loads(streamed(tmp_path, SENTENCES, compress=True))) == prettified(SENTENCES).encode("UTF-8")
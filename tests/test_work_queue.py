@@ -0,0 +1,61 @@
+import time
+
+from CorpusForge.Work_Queue_Class import workQueue
+
+
+def make_files(directory, n_files):
+    files = []
+    for index in range(n_files):
+        path = directory / f"doc{index}.txt"
+        path.write_text(f"Text {index}.")
+        files.append(str(path))
+    return files
+
+
+def stop_heartbeat(queue):
+    # A worker that died stops renewing its leases without releasing them
+    queue.stopping.set()
+    queue.heartbeat_thread.join()
+
+
+def test_expired_lease_claimed_by_another_worker(tmp_path):
+    files = make_files(tmp_path, 2)
+    queue_file = str(tmp_path / "queue.sqlite")
+    workQueue(queue_file).register(list(enumerate(files)))
+    first = workQueue(queue_file, lease_seconds=0.3, max_attempts=3)
+    second = workQueue(queue_file, lease_seconds=0.3, max_attempts=3)
+
+    assert first.claim() == [(0, files[0])]
+    stop_heartbeat(first)
+    # Live leases are left to their worker
+    assert second.claim() == [(1, files[1])]
+    assert second.claim() == []
+    time.sleep(0.5)
+    assert second.claim() == [(0, files[0])]
+
+    # The first worker's completion is fenced off, the file is done once its new holder finishes it
+    first.complete(files[0])
+    assert first.lost == [files[0]]
+    assert second.status()['states'] == {'queued': 0, 'leased': 2, 'done': 0, 'failed': 0}
+    second.complete(files[0])
+    second.complete(files[1])
+    assert second.status()['states']['done'] == 2
+    assert second.claim_merge()
+    second.close()
+
+
+def test_lease_expiring_on_every_attempt_fails_the_file(tmp_path):
+    files = make_files(tmp_path, 1)
+    queue_file = str(tmp_path / "queue.sqlite")
+    workQueue(queue_file).register([(0, files[0])])
+    for _ in range(2):
+        worker = workQueue(queue_file, lease_seconds=0.2, max_attempts=2)
+        assert worker.claim() == [(0, files[0])]
+        stop_heartbeat(worker)
+        time.sleep(0.3)
+    observer = workQueue(queue_file, lease_seconds=0.2, max_attempts=2)
+    assert observer.claim() == []
+    status = observer.status()
+    assert status['states']['failed'] == 1
+    assert status['failed'] == [{'file': files[0], 'error': "Lease expired on every attempt"}]
+    assert not observer.wait_for_work()